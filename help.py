@@ -4,29 +4,29 @@ package com.example.mcpapp
 
 import android.app.*
 import android.content.Intent
+import android.net.ConnectivityManager
+import android.net.Network
 import android.os.Binder
 import android.os.IBinder
 import android.os.PowerManager
 import android.os.PowerManager.WakeLock
+import android.os.SystemClock
 import android.util.Log
 import androidx.core.app.NotificationCompat
-import com.google.ai.client.generativeai.GenerativeModel
+import kotlinx.coroutines.CancellationException
 import kotlinx.coroutines.CoroutineScope
 import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.Job
 import kotlinx.coroutines.SupervisorJob
-import kotlinx.coroutines.launch
-import kotlinx.coroutines.withContext
-import kotlinx.coroutines.channels.Channel
 import kotlinx.coroutines.delay
+import kotlinx.coroutines.isActive
+import kotlinx.coroutines.launch
+import kotlinx.coroutines.withTimeoutOrNull
 import okhttp3.*
-import okhttp3.MediaType.Companion.toMediaTypeOrNull
-import okhttp3.RequestBody.Companion.toRequestBody
 import org.json.JSONObject
-import java.io.BufferedReader
+import java.io.File
 import java.io.IOException
-import java.io.InputStreamReader
 import java.util.concurrent.TimeUnit
-import java.util.concurrent.Executors
 import java.util.concurrent.atomic.AtomicBoolean
 
 class GeminiMcpService : Service() {
@@ -35,6 +35,10 @@ class GeminiMcpService : Service() {
         private const val NOTIFICATION_ID = 1
         private const val CHANNEL_ID = "GeminiMcpServiceChannel"
         private const val CHANNEL_NAME = "Gemini MCP Service"
+        private const val MODEL_NAME = "gemini-2.5-flash"
+        // Takes over after rejected calls or steps that make no progress
+        private const val STRONG_MODEL_NAME = "gemini-2.5-pro"
+        private const val API_KEY = "API_KEY"
     }
 
     private val client = OkHttpClient.Builder()
@@ -52,49 +56,116 @@ class GeminiMcpService : Service() {
         }
         .build()
 
-    private val executor = Executors.newSingleThreadExecutor()
     private val mcpUrl = "http://10.0.2.2:8000/mcp/"
+    private val defaultDevice = DeviceInfo("emulator-5554", "android")
+    // Shared by all sessions: they talk to the same server
+    private val circuitBreaker = CircuitBreaker()
+    private val tracer = Tracer()
+    private val jsonRpcPoster = JsonRpcPoster(client, circuitBreaker, tracer)
+    // Settled by the first session that connects; later sessions skip the probe
+    @Volatile
+    private var negotiatedTransport: TransportKind? = null
 
     private val binder = GeminiMcpBinder()
-    private lateinit var generativeModel: GenerativeModel
+    private lateinit var agentModel: ModelRouter
+    private lateinit var agentRunner: AgentRunner
+    private lateinit var planCache: PlanCache
+    private val appIndexCache = AppIndexCache()
+    // Large tool results of running jobs live on disk; cacheDir because the OS may reclaim them
+    private lateinit var resultStore: ResultStore
+    private lateinit var checkpoints: JobCheckpoints
     private val serviceScope = CoroutineScope(Dispatchers.IO + SupervisorJob())
 
     // Wake lock to prevent system from sleeping
     private lateinit var wakeLock: WakeLock
 
-    private var requestId = 1
-    private var pendingRequestId: Int? = null
-    private var responseChannel: Channel<String>? = null
-    private val isListening = AtomicBoolean(false)
-    private val shouldReconnect = AtomicBoolean(true)
-
-    private var currentUserQuery = ""
     private var maxIterations = 15
-    private var currentIteration = 0
-    private val maxRetries = 3
 
-    private var isProcessing = false
+    private val maxQueuedQueries = 16
+    private val jobTimeoutMs = 5 * 60_000L
+    // Upper bound on parallel agent loops; the real parallelism is the number of healthy devices
+    private val maxParallelJobs = 8
+    private val scheduler = QueryScheduler(serviceScope, maxQueuedQueries, ::runQueryJob) { query ->
+        QueryJobState(query, resultStore)
+    }
+    private val devicePool = DevicePool(serviceScope, ::createSession, ::discoverDevices)
+    @Volatile
+    private var lastStartedJob: QueryJob? = null
+
+    private val maxActionsPerTurn = 5
+
+    // COLD until the first warm-up starts; READY once devices, tool catalog and model client are up
+    enum class ReadyState { COLD, WARMING, READY, FAILED }
+
+    @Volatile
+    private var readyState = ReadyState.COLD
+    private var warmUpJob: Job? = null
+    private var watchdogJob: Job? = null
+    private val watchdogIntervalMs = 60_000L
+    // Idle HTTP connections are evicted after a few minutes; re-prime the model client before that
+    private val modelKeepaliveMs = 4 * 60_000L
+    private val warmUpLeaseTimeoutMs = 10_000L
+    @Volatile
+    private var modelWarmedAt = 0L
+
+    private var networkCallback: ConnectivityManager.NetworkCallback? = null
+    @Volatile
+    private var defaultNetwork: Network? = null
+    @Volatile
+    private var hadNetwork = false
 
     interface GeminiMcpCallback {
         fun onStatusUpdate(status: String)
         fun onResponse(response: String)
         fun onError(error: String)
         fun onCompleted()
+        fun onReadyStateChanged(state: ReadyState) {}
     }
 
     private var callback: GeminiMcpCallback? = null
 
     inner class GeminiMcpBinder : Binder() {
         fun getService(): GeminiMcpService = this@GeminiMcpService
+        fun getReadyState(): ReadyState = readyState
+        fun isReady(): Boolean = readyState == ReadyState.READY
     }
 
     override fun onCreate() {
         super.onCreate()
 
-        generativeModel = GenerativeModel(
-            modelName = "gemini-2.5-flash",
-            apiKey = "API_KEY"
+        val parser = ModelTurnParser(tracer, maxActionsPerTurn)
+        agentModel = ModelRouter(
+            listOf(
+                ModelTier("fast", GeminiAgentModel(MODEL_NAME, API_KEY, parser, tracer) { toolCatalog }, timeoutMs = 30_000),
+                ModelTier("strong", GeminiAgentModel(STRONG_MODEL_NAME, API_KEY, parser, tracer) { toolCatalog }, timeoutMs = 60_000)
+            ),
+            tracer
         )
+        planCache = PlanCache(File(filesDir, "plan_cache"))
+        resultStore = ResultStore(BlobStore(File(cacheDir, "tool_results")))
+        checkpoints = JobCheckpoints(File(filesDir, "checkpoints"))
+        agentRunner = AgentRunner(
+            agentModel,
+            tracer,
+            maxIterations,
+            planCache,
+            IntentResolver(appIndexCache),
+            ScreenPrefetcher(tracer),
+            ScreenshotObserver(tracer),
+            checkpoints
+        ) { toolCatalog }
+
+        toolCatalogCache = ToolCatalogCache(File(filesDir, "mcp_cache"))
+        // Leftover logs are read on serviceScope's IO threads and before any worker runs, so no
+        // live job's log is mistaken for one; queries sent meanwhile wait in the queue
+        serviceScope.launch {
+            val resumed = checkpoints.recover { query -> QueryJobState(query, resultStore) }
+            scheduler.start(maxParallelJobs)
+            resumeCheckpointedJobs(resumed)
+        }
+        warmUp()
+        watchdogJob = serviceScope.launch { keepaliveLoop() }
+        registerNetworkCallback()
 
         // Create notification channel
         createNotificationChannel()
@@ -111,6 +182,8 @@ class GeminiMcpService : Service() {
     override fun onStartCommand(intent: Intent?, flags: Int, startId: Int): Int {
         // Start as foreground service
         startForeground(NOTIFICATION_ID, createNotification("MCP Service Running"))
+        // A sticky restart or a start after a failed warm-up goes through here without onCreate
+        if (readyState == ReadyState.COLD || readyState == ReadyState.FAILED) warmUp()
 
         return START_STICKY // Restart service if killed
     }
@@ -160,6 +233,7 @@ class GeminiMcpService : Service() {
 
     fun setCallback(callback: GeminiMcpCallback) {
         this.callback = callback
+        callback.onReadyStateChanged(readyState)
     }
 
     fun removeCallback() {
@@ -172,392 +246,345 @@ class GeminiMcpService : Service() {
             return
         }
 
-        if (isProcessing) {
-            callback?.onError("Another query is already being processed")
+        val job = scheduler.submit(query)
+        if (job == null) {
+            callback?.onError("Query queue is full ($maxQueuedQueries waiting), try again later")
             return
         }
 
-        isProcessing = true
-        currentUserQuery = query
-        currentIteration = 0
-        shouldReconnect.set(true)
-
-        serviceScope.launch {
-            try {
-                updateNotification("Processing: $query")
-                callback?.onStatusUpdate("Initializing automation...")
-
-                // Start SSE listener first
-                startSSEListener()
-
-                // Small delay to ensure connection is established
-                delay(2000)
-
-                callback?.onStatusUpdate("Selecting device...")
-                selectDevice()
-                Log.d("selectDevice", "device selected")
-
-                getToolsList()
-                Log.d("getToolsList", "got tools $toolsList")
-
-                startGeminiMcpLoop()
-            } catch (e: Exception) {
-                isProcessing = false
-                updateNotification("Error: ${e.message}")
-                callback?.onError("Error processing query: ${e.message}")
-                Log.e("GeminiMcpService", "Error in processUserQuery", e)
-            }
+        Log.d("GeminiMcpService", "Queued job ${job.id}, queue depth ${scheduler.queueDepth}")
+        if (scheduler.runningJobs >= maxOf(1, devicePool.size)) {
+            callback?.onStatusUpdate("Queued until a device is free (${scheduler.queueDepth} waiting)")
         }
     }
 
-    private suspend fun selectDevice() {
-        val currentRequestId = requestId++
-        pendingRequestId = currentRequestId
+    fun getQueueDepth(): Int = scheduler.queueDepth
 
-        val deviceSelection = JSONObject().apply {
-            put("jsonrpc", "2.0")
-            put("id", currentRequestId)
-            put("method", "tools/call")
-            put("params", JSONObject().apply {
-                put("name", "mobile_use_device")
-                put("arguments", JSONObject().apply {
-                    put("device", "emulator-5554")
-                    put("deviceType", "android")
-                })
-            })
-        }
+    fun getDeviceIds(): List<String> = devicePool.deviceIds
 
-        sendJsonRpcRequestWithRetry(deviceSelection)
-        waitForResponse()
-        pendingRequestId = null
+    // Recorded plans are replayed without calling the model; clear them after the app under test changes
+    fun clearPlanCache() = planCache.clear()
+
+    // While tracing is enabled, spans feed the histograms behind getLatencyStats(); with
+    // writeTraceFile they are also written to rolling Chrome trace files under filesDir/traces.
+    // Nothing is recorded while it is off.
+    fun setTracingEnabled(enabled: Boolean, writeTraceFile: Boolean = true) {
+        // Waits for the old writer to let go of trace-0.json before a new one may open it
+        tracer.sink?.close()
+        tracer.sink = if (enabled && writeTraceFile) ChromeTraceWriter(File(filesDir, "traces")) else null
+        tracer.enabled = enabled
     }
 
-    private var prevResponse = ""
-    private var toolsList = ""
+    // Latency per phase (model.generate, mcp.post, ui.settle, ...) since tracing was enabled
+    fun getLatencyStats(): Map<String, LatencySummary> = tracer.latencySummaries()
 
-    private suspend fun getToolsList() {
-        val currentRequestId = requestId++
-        pendingRequestId = currentRequestId
+    // Calls, timeouts, hedges and latency per model tier since the service started
+    fun getModelTierStats(): List<ModelTierStats> = agentModel.stats()
 
-        val toolsListRequest = JSONObject().apply {
-            put("jsonrpc", "2.0")
-            put("id", currentRequestId)
-            put("method", "tools/list")
-            put("params", JSONObject())
-        }
+    fun getReadyState(): ReadyState = readyState
 
-        sendJsonRpcRequestWithRetry(toolsListRequest)
-        val response = waitForResponse()
-        toolsList = response
-        pendingRequestId = null
+    private fun setReadyState(state: ReadyState) {
+        if (readyState == state) return
+        readyState = state
+        Log.d("GeminiMcpService", "Ready state: $state")
+        callback?.onReadyStateChanged(state)
     }
 
-    private suspend fun waitForResponse(): String {
-        return withContext(Dispatchers.IO) {
-            responseChannel = Channel(Channel.UNLIMITED)
+    // Brings up the device pool, tool catalog and model client in the background so a query
+    // starts at step 1; a warm-up that is already running is not started twice
+    @Synchronized
+    private fun warmUp() {
+        if (warmUpJob?.isActive == true) return
+        warmUpJob = serviceScope.launch { runWarmUp() }
+    }
 
-            // Wait for response with timeout
-            var attempts = 0
-            while (attempts < maxRetries) {
+    private suspend fun runWarmUp() {
+        setReadyState(ReadyState.WARMING)
+        val start = tracer.now()
+        try {
+            if (devicePool.warmUp() == 0) throw IOException("No devices available")
+            // All devices busy means jobs are running, and they load the catalog themselves
+            val session = withTimeoutOrNull(warmUpLeaseTimeoutMs) { devicePool.lease() }
+            if (session != null) {
+                var suspect = false
                 try {
-                    val response = responseChannel!!.receive()
-                    return@withContext response
+                    prepareSession(session)
                 } catch (e: Exception) {
-                    attempts++
-                    Log.e("GeminiMcpService", "Error waiting for response, attempt $attempts", e)
-                    if (attempts < maxRetries) {
-                        delay(3000) // Wait before retry
-                        restartSSEListener()
-                    }
+                    suspect = true
+                    throw e
+                } finally {
+                    devicePool.release(session, suspect)
                 }
             }
-            throw Exception("Failed to receive response after $maxRetries attempts")
+            agentModel.warmUp()
+            modelWarmedAt = SystemClock.elapsedRealtime()
+            tracer.record("service.warm_up", start, mapOf("devices" to devicePool.size))
+            setReadyState(ReadyState.READY)
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.e("GeminiMcpService", "Warm-up failed: ${e.message}")
+            setReadyState(ReadyState.FAILED)
         }
     }
 
-    private fun startSSEListener() {
-        if (isListening.get()) return
-
-        isListening.set(true)
-
-        executor.execute {
-            while (shouldReconnect.get() && !executor.isShutdown) {
+    // The pool's health check keeps MCP streams alive; this re-warms once the pool has emptied
+    // or a warm-up failed, and keeps the model connection from going idle between queries
+    private suspend fun keepaliveLoop() {
+        while (serviceScope.isActive) {
+            delay(watchdogIntervalMs)
+            if (readyState != ReadyState.WARMING && (readyState != ReadyState.READY || devicePool.size == 0)) {
+                warmUp()
+            } else if (readyState == ReadyState.READY && scheduler.runningJobs == 0 &&
+                SystemClock.elapsedRealtime() - modelWarmedAt >= modelKeepaliveMs) {
                 try {
-                    val getRequest = Request.Builder()
-                        .url(mcpUrl)
-                        .get()
-                        .header("Cache-Control", "no-cache")
-                        .header("Accept", "text/event-stream")
-                        .header("Connection", "keep-alive")
-                        .build()
+                    agentModel.warmUp()
+                    modelWarmedAt = SystemClock.elapsedRealtime()
+                } catch (e: Exception) {
+                    Log.w("GeminiMcpService", "Model keepalive failed: ${e.message}")
+                }
+            }
+        }
+    }
 
-                    client.newCall(getRequest).execute().use { response ->
-                        if (!response.isSuccessful) {
-                            Log.e("MCPService", "❌ Failed SSE connection: ${response.code}")
-                            Thread.sleep(5000)
-                            return@use
-                        }
+    // onAvailable also fires right after registration; only a different or returning network
+    // re-warms. Pooled connections belong to the old network, so they are evicted first.
+    private fun registerNetworkCallback() {
+        val connectivityManager = getSystemService(ConnectivityManager::class.java) ?: return
+        val networkCallback = object : ConnectivityManager.NetworkCallback() {
+            override fun onAvailable(network: Network) {
+                val previous = defaultNetwork
+                defaultNetwork = network
+                if (hadNetwork && previous != network) onNetworkChanged()
+                hadNetwork = true
+            }
 
-                        Log.d("MCPService", "✅ SSE connection established")
+            override fun onLost(network: Network) {
+                if (defaultNetwork == network) defaultNetwork = null
+            }
+        }
+        connectivityManager.registerDefaultNetworkCallback(networkCallback)
+        this.networkCallback = networkCallback
+    }
 
-                        val reader = BufferedReader(InputStreamReader(response.body?.byteStream()))
-                        var event: String? = null
-                        val dataBuilder = StringBuilder()
-                        var line: String?
+    private fun onNetworkChanged() {
+        Log.d("GeminiMcpService", "Network changed, re-warming")
+        setReadyState(ReadyState.COLD)
+        client.connectionPool.evictAll()
+        serviceScope.launch {
+            devicePool.revalidate()
+            warmUp()
+        }
+    }
 
-                        while (reader.readLine().also { line = it } != null && shouldReconnect.get()) {
-                            line = line?.trim()
-                            when {
-                                line!!.startsWith("event:") -> {
-                                    event = line!!.removePrefix("event:").trim()
-                                }
+    // Jobs the previous process was running when it was killed, continued after their last
+    // logged step. A resumed job skips the local fast path and plan replay and is not recorded
+    // as a plan, since its recording would miss the steps before the kill.
+    private fun resumeCheckpointedJobs(resumed: List<QueryJobState>) {
+        for (state in resumed) {
+            val job = scheduler.submit(state.query, state)
+            if (job == null) {
+                Log.w("GeminiMcpService", "Queue full, dropping checkpointed job \"${state.query}\"")
+                checkpoints.finish(state)
+                continue
+            }
+            Log.d("GeminiMcpService", "Resuming job ${job.id} \"${state.query}\" after step ${state.iteration}")
+            callback?.onStatusUpdate("Resuming \"${state.query}\" at step ${state.iteration + 1}")
+        }
+    }
 
-                                line!!.startsWith("data:") -> {
-                                    dataBuilder.append(line!!.removePrefix("data:").trim())
-                                }
+    // The checkpoint log is dropped once the job ends in any way except cancellation, which
+    // only happens when the service itself goes away; such a job resumes on the next start
+    private suspend fun runQueryJob(job: QueryJob) {
+        checkpoints.begin(job.state)
+        var cancelled = false
+        try {
+            runCheckpointedJob(job)
+        } catch (e: CancellationException) {
+            cancelled = true
+            throw e
+        } finally {
+            if (!cancelled) checkpoints.finish(job.state)
+        }
+    }
 
-                                line!!.isEmpty() -> {
-                                    val fullData = dataBuilder.toString()
-                                    if (event != null && fullData.isNotEmpty()) {
-                                        Log.d("SSE_RAW", "event=$event, data=$fullData")
+    private suspend fun runCheckpointedJob(job: QueryJob) {
+        callback?.onStatusUpdate("Selecting device...")
+        val session = try {
+            devicePool.lease()
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            updateNotification("Error: ${e.message}")
+            callback?.onError("Error processing query: ${e.message}")
+            return
+        }
 
-                                        // Handle different event types properly
-                                        when (event) {
-                                            "endpoint" -> {
-                                                // This is session metadata, just log it
-                                                Log.d("MCPService", "Session endpoint: $fullData")
-                                            }
+        lastStartedJob = job
+        Log.d("GeminiMcpService", "Starting job ${job.id} on ${session.deviceId} after ${System.currentTimeMillis() - job.enqueuedAt}ms in queue")
+        var suspect = false
+        try {
+            updateNotification("Processing: ${job.query}")
+            postStatus(session, "Initializing automation...")
 
-                                            "message" -> {
-                                                // This is the actual JSON response we need
-                                                try {
-                                                    val responseJson = JSONObject(fullData)
-                                                    val responseId = responseJson.optInt("id", -1)
-
-                                                    if (pendingRequestId != null && responseId == pendingRequestId) {
-                                                        Log.d("MCPService", "✅ Received response for request $responseId")
-                                                        responseChannel?.trySend(fullData)
-                                                    } else {
-                                                        Log.d("MCPService", "Response ID $responseId doesn't match pending $pendingRequestId")
-                                                    }
-                                                } catch (e: Exception) {
-                                                    Log.e("MCPService", "Error parsing message response: ${e.message}")
-                                                    // For malformed JSON in message events, still try to send
-                                                    if (pendingRequestId != null) {
-                                                        responseChannel?.trySend(fullData)
-                                                    }
-                                                }
-                                            }
+            val outcome = withTimeoutOrNull(jobTimeoutMs) {
+                prepareSession(session)
+                agentRunner.run(session, job.state, jobListener(session))
+            }
+            if (outcome == null) {
+                suspect = true
+                updateNotification("Task timed out")
+                callback?.onError("Task did not finish within ${jobTimeoutMs / 1000}s")
+            }
+            Log.d("GeminiMcpService", "Job ${job.id} finished: ${outcome ?: JobOutcome.TIMED_OUT} after ${job.state.iteration} steps")
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            suspect = true
+            updateNotification("Error: ${e.message}")
+            callback?.onError("Error processing query: ${e.message}")
+            Log.e("GeminiMcpService", "Error in job ${job.id}", e)
+        } finally {
+            devicePool.release(session, suspect)
+        }
+    }
 
-                                            "error" -> {
-                                                // Handle error events
-                                                Log.e("MCPService", "Server error: $fullData")
-                                                responseChannel?.trySend(fullData)
-                                            }
+    private fun jobListener(session: McpSession) = object : AgentListener {
+        override fun onStep(step: Int, maxSteps: Int) {
+            val statusText = "Processing step $step of $maxSteps..."
+            updateNotification(statusText)
+            postStatus(session, if (scheduler.queueDepth > 0) "$statusText (${scheduler.queueDepth} queued)" else statusText)
+        }
 
-                                            else -> {
-                                                // Unknown event type, log but don't process
-                                                Log.d("MCPService", "Unknown event type '$event': $fullData")
-                                            }
-                                        }
+        override fun onCompleted() {
+            updateNotification("Task completed successfully")
+            callback?.onResponse("Task completed successfully!")
+            callback?.onCompleted()
+        }
 
-                                        prevResponse = fullData
-                                    }
-                                    event = null
-                                    dataBuilder.setLength(0)
-                                }
-                            }
-                        }
-                    }
-                } catch (e: Exception) {
-                    Log.e("MCPService", "❌ SSE error: ${e.message}")
-                    if (shouldReconnect.get()) {
-                        Thread.sleep(5000)
-                    }
-                }
-            }
-            isListening.set(false)
+        override fun onError(summary: String, message: String) {
+            updateNotification(summary)
+            callback?.onError(message)
         }
     }
 
-    private fun restartSSEListener() {
-        Log.d("MCPService", "Restarting SSE listener...")
-        isListening.set(false)
-        Thread.sleep(2000) // Brief pause
-        startSSEListener()
+    // The session is already connected with its device selected when it joined the pool;
+    // connect() only re-establishes a stream that dropped since the last job
+    private suspend fun prepareSession(session: McpSession) {
+        session.connect()
+        ensureToolCatalog(session)
+        Log.d("getToolsList", "using ${toolCatalog?.tools?.size} tools, hash ${toolCatalog?.schemaHash}")
     }
 
-    private var fullMcpResponses = ""
+    private fun createSession(device: DeviceInfo): McpSession {
+        return McpSession(::openTransport, device.id, device.type, ::handleServerNotification)
+    }
 
-    private suspend fun startGeminiMcpLoop() {
-        if (currentIteration >= maxIterations) {
-            isProcessing = false
-            updateNotification("Max iterations reached")
-            callback?.onError("Maximum iterations reached. Task may be too complex.")
-            return
+    private suspend fun openTransport(onNotification: (String) -> Unit): McpTransport {
+        val transport = openMcpTransport(client, mcpUrl, jsonRpcPoster, tracer, onNotification, negotiatedTransport)
+        if (negotiatedTransport == null) {
+            negotiatedTransport = transport.kind
+            Log.d("MCPService", "Using ${transport.kind} transport for $mcpUrl")
         }
+        return transport
+    }
 
-        currentIteration++
-        val statusText = "Processing step $currentIteration of $maxIterations..."
-        updateNotification(statusText)
-        callback?.onStatusUpdate(statusText)
-
-        val geminiPrompt = createGeminiPrompt()
-        Log.d("Gemini", "Prompt: $geminiPrompt")
-
+    // Lists devices through a short-lived session; falls back to the default emulator
+    private suspend fun discoverDevices(): List<DeviceInfo> {
+        val probe = McpSession(::openTransport, "discovery", "", ::handleServerNotification)
         try {
-            val response = generativeModel.generateContent(geminiPrompt)
-            val responseText = response.text ?: ""
-
-            Log.d("GeminiMcpService", "Gemini response: $responseText")
-
-            if (responseText.contains("TASK_COMPLETED") ||
-                responseText.contains("\"status\": \"completed\"") ||
-                responseText.contains("task is complete")) {
-                isProcessing = false
-                updateNotification("Task completed successfully")
-                callback?.onResponse("Task completed successfully!")
-                callback?.onCompleted()
-                return
-            }
+            probe.connect()
+            val devices = DevicePool.parseDeviceList(probe.callTool("mobile_list_available_devices"))
+            return devices.ifEmpty { listOf(defaultDevice) }
+        } finally {
+            probe.close()
+        }
+    }
+
+    private fun postStatus(session: McpSession, status: String) {
+        callback?.onStatusUpdate(if (devicePool.size > 1) "[${session.deviceId}] $status" else status)
+    }
 
-            val jsonResponse = extractJsonFromResponse(responseText)
-            if (jsonResponse != null) {
-                val currentRequestId = requestId++
-                pendingRequestId = currentRequestId
-                jsonResponse.put("id", currentRequestId)
+    private lateinit var toolCatalogCache: ToolCatalogCache
+    @Volatile
+    private var toolCatalog: ToolCatalog? = null
+    private val catalogRevalidated = AtomicBoolean(false)
 
-                sendJsonRpcRequestWithRetry(jsonResponse)
-                val mcpResponse = waitForResponse()
-                fullMcpResponses += "\n" + mcpResponse
-                pendingRequestId = null
+    // Server identity for the catalog cache; the schema hash covers changes on the same server
+    private val mcpServerId: String
+        get() = mcpUrl
 
-                Log.i("requestId: $requestId", "full response: $fullMcpResponses")
+    private suspend fun getToolsList(session: McpSession): ToolCatalog {
+        val toolsListRequest = JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("method", "tools/list")
+            put("params", JSONObject())
+        }
 
-                // Add delay between iterations to prevent overwhelming the system
-                delay(2000)
+        return ToolCatalog.fromToolsListResponse(mcpServerId, session.sendAndAwait(toolsListRequest))
+    }
 
-                // Continue the loop
-                startGeminiMcpLoop()
-            } else {
-                isProcessing = false
-                updateNotification("Error parsing response")
-                callback?.onError("Failed to parse Gemini response as JSON: $responseText")
-            }
+    // Uses the cached catalog when there is one; a disk copy is re-checked once per service
+    // lifetime in the background, so no query waits on tools/list unless nothing is cached
+    private suspend fun ensureToolCatalog(session: McpSession) {
+        val cached = toolCatalogCache.get(mcpServerId)
+        if (cached == null) {
+            val fresh = getToolsList(session)
+            toolCatalogCache.put(fresh)
+            toolCatalog = fresh
+            catalogRevalidated.set(true)
+            return
+        }
 
-        } catch (e: Exception) {
-            isProcessing = false
-            updateNotification("Error: ${e.message}")
-            Log.e("GeminiMcpService", "Error in Gemini loop", e)
-            callback?.onError("Error communicating with Gemini: ${e.message}")
+        toolCatalog = cached
+        if (catalogRevalidated.compareAndSet(false, true)) {
+            refreshToolCatalogInBackground(session)
         }
     }
 
-    private suspend fun sendJsonRpcRequestWithRetry(params: JSONObject) {
-        var attempts = 0
-        while (attempts < maxRetries) {
+    private fun refreshToolCatalogInBackground(session: McpSession) {
+        serviceScope.launch {
             try {
-                sendJsonRpcRequest(params)
-                return
-            } catch (e: Exception) {
-                attempts++
-                Log.e("MCPService", "Send request failed, attempt $attempts", e)
-                if (attempts < maxRetries) {
-                    delay(3000)
+                val fresh = getToolsList(session)
+                if (toolCatalogCache.put(fresh)) {
+                    Log.d("MCPService", "Tool schemas changed, now ${fresh.schemaHash}")
                 }
+                toolCatalog = fresh
+            } catch (e: Exception) {
+                catalogRevalidated.set(false)
+                Log.e("MCPService", "Tool catalog refresh failed: ${e.message}")
             }
         }
-        throw Exception("Failed to send request after $maxRetries attempts")
     }
 
-    private fun sendJsonRpcRequest(params: JSONObject) {
-        val requestBody = params.toString()
-            .toRequestBody("application/json".toMediaTypeOrNull())
-
-        val postRequest = Request.Builder()
-            .url(mcpUrl)
-            .post(requestBody)
-            .build()
-
-        client.newCall(postRequest).enqueue(object : Callback {
-            override fun onFailure(call: Call, e: IOException) {
-                Log.e("MCPService", "❌ JSON-RPC POST failed: ${e.message}")
-            }
-
-            override fun onResponse(call: Call, response: Response) {
-                response.use {
-                    if (it.isSuccessful) {
-                        Log.d("MCPService", "✅ Sent request successfully")
-                    } else {
-                        Log.e("MCPService", "❌ JSON-RPC error: ${it.code}")
-                    }
-                }
+    private fun handleServerNotification(session: McpSession, method: String) {
+        when (method) {
+            "notifications/tools/list_changed" -> {
+                Log.d("MCPService", "Tool list changed, refetching catalog")
+                toolCatalogCache.invalidate(mcpServerId)
+                catalogRevalidated.set(true)
+                refreshToolCatalogInBackground(session)
             }
-        })
-    }
 
-    private fun createGeminiPrompt(): String {
-        return """
-            You are an AI assistant that controls mobile devices through an MCP server.
-            Your task is to help execute user queries by calling the appropriate mobile device tools.
-            Remember that the device is already selected and start with the user query.
-            
-            AVAILABLE TOOLS:
-            $toolsList
-            
-            USER QUERY: $currentUserQuery
-            
-            PREVIOUS MCP RESPONSES:
-            $fullMcpResponses
-            
-            CRITICAL INSTRUCTIONS:
-            1. Respond with ONLY valid JSON - no markdown formatting, no code blocks, no extra text
-            2. If task is complete, respond with: {"status": "completed", "message": "Task completed successfully"}
-            3. Otherwise, respond with the exact MCP JSON format shown below
-            
-            RESPONSE FORMAT (choose one):
-            
-            For MCP tool call:
-            {"jsonrpc": "2.0", "id": ${requestId}, "method": "tools/call", "params": {"name": "tool_name", "arguments": {"param": "value"}}}
-            
-            For completion:
-            {"status": "completed", "message": "Task completed successfully"}
-            
-            IMPORTANT: 
-            - NO markdown formatting (no ```
-            - NO additional text or explanations
-            - ONLY JSON response
-            - Use exact tool names from the tools list
-            - Think about what action is needed next based on user query and previous responses
-        """.trimIndent()
+            else -> Log.d("MCPService", "Ignoring notification $method")
+        }
     }
 
-    private fun extractJsonFromResponse(response: String): JSONObject? {
-        return try {
-            val trimmed = response.trim()
-            val startIndex = trimmed.indexOf('{')
-            val endIndex = trimmed.lastIndexOf('}')
-
-            if (startIndex != -1 && endIndex != -1 && endIndex > startIndex) {
-                val jsonString = trimmed.substring(startIndex, endIndex + 1)
-                JSONObject(jsonString)
-            } else {
-                null
-            }
-        } catch (e: Exception) {
-            Log.e("GeminiMcpService", "Failed to parse JSON: ${e.message}")
-            null
-        }
+    // Per-step input size of the most recently started query, for comparing prompt modes
+    fun getStepTokenUsage(): List<StepTokenUsage> {
+        val usage = lastStartedJob?.state?.tokenUsage ?: return emptyList()
+        return synchronized(usage) { usage.toList() }
     }
 
     override fun onDestroy() {
         super.onDestroy()
-        isProcessing = false
+        networkCallback?.let { getSystemService(ConnectivityManager::class.java)?.unregisterNetworkCallback(it) }
+        watchdogJob?.cancel()
+        scheduler.shutdown()
+        devicePool.shutdown()
+        checkpoints.close()
+        tracer.sink?.close()
         callback = null
-        shouldReconnect.set(false)
-        isListening.set(false)
-        responseChannel?.close()
-        executor.shutdown()
 
         if (::wakeLock.isInitialized && wakeLock.isHeld) {
             wakeLock.release()
@@ -567,57 +594,4800 @@ class GeminiMcpService : Service() {
 
 
 
-// MainActivity.kt
+// AgentRunner.kt
 
 package com.example.mcpapp
 
-import android.content.ComponentName
-import android.content.Context
-import android.content.Intent
-import android.content.ServiceConnection
-import android.os.Bundle
-import android.os.IBinder
-import android.widget.Button
-import android.widget.EditText
-import android.widget.TextView
-import androidx.appcompat.app.AppCompatActivity
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.CoroutineScope
+import kotlinx.coroutines.coroutineScope
+import org.json.JSONArray
+import org.json.JSONObject
 
-class MainActivity : AppCompatActivity() {
+// Progress of one job, reported by AgentRunner. summary is short enough for a notification.
+interface AgentListener {
+    fun onStep(step: Int, maxSteps: Int)
+    fun onCompleted()
+    fun onError(summary: String, message: String)
+}
 
-    private lateinit var editTextPrompt: EditText
-    private lateinit var buttonSend: Button
-    private lateinit var textViewStatus: TextView
-    private lateinit var textViewResponse: TextView
+// The agent loop, independent of the Service: it only needs an AgentModel and an McpSession, so
+// it runs just as well against a scripted model and a fake server. Holds no per-job state, so
+// one runner serves every job.
+class AgentRunner(
+    private val model: AgentModel,
+    private val tracer: Tracer,
+    private val maxIterations: Int = 15,
+    private val planCache: PlanCache? = null,
+    // Simple intents ("open YouTube") are answered without the model when this is set
+    private val intentResolver: IntentResolver? = null,
+    // Reads the screen after each acting step while the step results are put together
+    private val prefetcher: ScreenPrefetcher? = null,
+    // Adds screenshots to observations when the element listing is empty or larger than an image
+    private val screenshots: ScreenshotObserver? = null,
+    // Logs every completed step so a killed job can resume after it
+    private val checkpoints: JobCheckpoints? = null,
+    // Calls are checked against this catalog's schemas before dispatch; none means unchecked
+    private val catalogProvider: () -> ToolCatalog? = { null }
+) {
 
-    private var geminiMcpService: GeminiMcpService? = null
-    private var bound = false
+    private class ActionResults(val records: List<StepHistory.StepRecord>, val failed: Boolean)
 
-    private val connection = object : ServiceConnection {
-        override fun onServiceConnected(className: ComponentName, service: IBinder) {
-            val binder = service as GeminiMcpService.GeminiMcpBinder
-            geminiMcpService = binder.getService()
-            bound = true
+    // One iteration per model turn until the task completes, fails or runs out of steps
+    suspend fun run(session: McpSession, state: QueryJobState, listener: AgentListener): JobOutcome = coroutineScope {
+        try {
+            runSteps(this, session, state, listener)
+        } finally {
+            state.prefetch?.cancel()
+            state.prefetch = null
+        }
+    }
 
-            // Set callback for service responses
-            geminiMcpService?.setCallback(object : GeminiMcpService.GeminiMcpCallback {
-                override fun onStatusUpdate(status: String) {
-                    runOnUiThread {
-                        textViewStatus.text = status
+    private suspend fun runSteps(scope: CoroutineScope, session: McpSession, state: QueryJobState, listener: AgentListener): JobOutcome {
+        try {
+            if (intentResolver != null && state.iteration == 0) {
+                val resolved = runFastPath(intentResolver, session, state, listener)
+                if (resolved != null) return resolved
+                if (state.iteration > 0) checkpoints?.stepCompleted(state)
+            }
+
+            if (planCache != null && state.iteration == 0) {
+                val replayed = replayPlan(planCache, session, state, listener)
+                if (replayed != null) return replayed
+            }
+
+            while (state.iteration < maxIterations) {
+                state.iteration++
+                tracer.span("agent.step") { stepSpan ->
+                    stepSpan.set("step", state.iteration)
+                    listener.onStep(state.iteration, maxIterations)
+
+                    val turn = model.nextTurn(session, state)
+                    val responseText = turn.text
+                    Log.d("GeminiMcpService", "Gemini response: $responseText")
+
+                    if (turn.completed) {
+                        savePlan(state)
+                        listener.onCompleted()
+                        return JobOutcome.COMPLETED
                     }
-                }
 
-                override fun onResponse(response: String) {
-                    runOnUiThread {
-                        textViewResponse.text = response
-                        buttonSend.isEnabled = true
+                    val parsedCalls = turn.calls
+                    if (parsedCalls.isNullOrEmpty()) {
+                        listener.onError("Error parsing response", "Failed to parse Gemini response as JSON: $responseText")
+                        return JobOutcome.FAILED
                     }
-                }
 
-                override fun onError(error: String) {
-                    runOnUiThread {
-                        textViewResponse.text = "Error: $error"
-                        textViewStatus.text = "Ready"
-                        buttonSend.isEnabled = true
+                    // A turn with any call that cannot be fixed runs nothing; the model answers again at once
+                    val calls = validateCalls(state, parsedCalls)
+                    if (calls == null) {
+                        state.rejectedTurns++
+                        val rejected = state.stepHistory.steps.filter { it.step == state.iteration }
+                        val results = rejected.joinToString("\n") { state.stepHistory.render(it) }
+                        model.onToolResults(state, turn, "TOOL RESULTS\n$results\n(no action was run; answer again with corrected calls)")
+                        return@span
+                    }
+
+                    val screenBefore = session.settleDetector.lastFingerprint
+                    val result = executeActions(session, state, calls)
+                    val records = result.records
+                    trackProgress(state, calls, result.failed, screenBefore, session.settleDetector.lastFingerprint)
+                    if (!result.failed) {
+                        state.planSteps.add(PlanStep(JSONArray(calls), session.lastSettledSignature))
+                        if (prefetcher != null && calls.any { !RetryPolicy.isIdempotent(it) }) {
+                            val catalog = catalogProvider()
+                            state.prefetch = prefetcher.start(scope, session, state.iteration) { catalog == null || catalog.get(it) != null }
+                        }
+                    }
+
+                    val skipped = calls.size - records.size
+                    val results = (records + attachPrefetched(session, state, records.size)).joinToString("\n") { state.stepHistory.render(it) }
+                    val note = StringBuilder()
+                    if (skipped > 0) note.append("\n(aborted: $skipped remaining actions were not run)")
+                    if (turn.droppedCalls > 0) {
+                        note.append("\n(${turn.droppedCalls} actions past the first ${calls.size} of the batch were not run)")
+                    }
+                    model.onToolResults(state, turn, "TOOL RESULTS\n$results$note")
+                }
+                checkpoints?.stepCompleted(state)
+            }
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.e("GeminiMcpService", "Error in Gemini loop", e)
+            listener.onError("Error: ${e.message}", "Error communicating with Gemini: ${e.message}")
+            return JobOutcome.FAILED
+        }
+
+        listener.onError("Max iterations reached", "Maximum iterations reached. Task may be too complex.")
+        return JobOutcome.STEP_BUDGET_EXHAUSTED
+    }
+
+    // COMPLETED when the query resolved locally and its calls ran cleanly; null hands it to the
+    // model, with anything that did run already in the step history
+    private suspend fun runFastPath(resolver: IntentResolver, session: McpSession, state: QueryJobState, listener: AgentListener): JobOutcome? {
+        val intent = try {
+            resolver.resolve(session, state.query)
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.w("GeminiMcpService", "Local intent resolution failed: ${e.message}")
+            null
+        } ?: return null
+
+        val catalog = catalogProvider()
+        if (catalog != null && intent.calls.any { catalog.get(it.optJSONObject("params")?.optString("name") ?: "") == null }) {
+            return null
+        }
+
+        return tracer.span("intent.fast_path") { span ->
+            span.set("intent", intent.description).set("confidence", intent.confidence)
+            Log.d("GeminiMcpService", "Resolved \"${state.query}\" locally: ${intent.description} (${intent.confidence})")
+            state.iteration++
+            listener.onStep(state.iteration, maxIterations)
+
+            val calls = validateCalls(state, intent.calls) ?: return@span null
+            if (executeActions(session, state, calls).failed) {
+                span.set("failed", true)
+                return@span null
+            }
+            listener.onCompleted()
+            JobOutcome.COMPLETED
+        }
+    }
+
+    // Replays the plan recorded for this query and starting screen, checking each step's settled
+    // screen against the recording. COMPLETED if the whole plan ran; null on a miss or at the
+    // first divergence, leaving the replayed steps in the job state for the model to continue from.
+    private suspend fun replayPlan(cache: PlanCache, session: McpSession, state: QueryJobState, listener: AgentListener): JobOutcome? {
+        val startScreen = try {
+            session.screenSignature()
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.w("GeminiMcpService", "No starting screen for plan lookup: ${e.message}")
+            return null
+        }
+        val key = cache.keyFor(state.query, startScreen)
+        state.planKey = key
+        val plan = cache.get(key) ?: return null
+
+        return tracer.span("plan.replay") { span ->
+            span.set("steps", plan.steps.size)
+            Log.d("GeminiMcpService", "Replaying ${plan.steps.size}-step plan for \"${state.query}\"")
+            for (step in plan.steps) {
+                if (state.iteration >= maxIterations) return@span null
+                state.iteration++
+                listener.onStep(state.iteration, maxIterations)
+
+                val result = executeActions(session, state, step.callObjects())
+                val screen = session.lastSettledSignature
+                if (result.failed || (step.screenAfter != null && screen != step.screenAfter)) {
+                    Log.d("GeminiMcpService", "Plan diverged at step ${state.iteration}, handing over to the model")
+                    span.set("divergedAt", state.iteration)
+                    cache.invalidate(key)
+                    checkpoints?.stepCompleted(state)
+                    return@span null
+                }
+                state.planSteps.add(step)
+                checkpoints?.stepCompleted(state)
+            }
+            listener.onCompleted()
+            JobOutcome.COMPLETED
+        }
+    }
+
+    // Records what this step's prefetch brought back as extra actions of the step, so the model
+    // sees the new screen without asking for it
+    private suspend fun attachPrefetched(session: McpSession, state: QueryJobState, actionsRun: Int): List<StepHistory.StepRecord> {
+        val prefetch = state.prefetch?.takeIf { it.step == state.iteration } ?: return emptyList()
+        val arrived = prefetch.collect(prefetcher?.attachTimeoutMs ?: 0L)
+        return arrived.entries.mapIndexed { index, (tool, response) ->
+            val request = JSONObject().apply {
+                put("jsonrpc", "2.0")
+                put("method", "tools/call")
+                put("params", JSONObject().put("name", tool).put("arguments", JSONObject()))
+            }
+            recordObservation(state, request, tool, observe(session, state, tool, response, prefetched = true), actionsRun + index + 1)
+        }
+    }
+
+    // A step that only read the screen neither counts as progress nor as a stall
+    private fun trackProgress(state: QueryJobState, calls: List<JSONObject>, failed: Boolean, screenBefore: String?, screenAfter: String?) {
+        state.rejectedTurns = 0
+        val acted = calls.any { !RetryPolicy.isIdempotent(it) }
+        when {
+            failed || (acted && screenAfter != null && screenAfter == screenBefore) -> state.stalledSteps++
+            acted -> state.stalledSteps = 0
+        }
+    }
+
+    // Element listings are kept as a diff against the previous screen the model saw; screenshot
+    // images go to the model as images, with a short note in their place in the history
+    private suspend fun observe(session: McpSession, state: QueryJobState, toolName: String, response: String, prefetched: Boolean): String {
+        if (toolName == ScreenshotObserver.TOOL) return screenshots?.attach(state, response) ?: response
+        if (toolName != "mobile_list_elements_on_screen") return response
+
+        // A diff is only sent while the listing it is based on is still in the prompt whole; a
+        // listing cut at the raw-result limit is no base, as the model never saw its tail
+        val baseVisible = state.screenBaseRecord?.let { state.stepHistory.isRenderedInFull(it) } ?: false
+        val listing = tracer.span("screen.diff") { state.screenStateStore.ingest(response, baseVisible) } ?: return response
+        val snapshot = state.screenStateStore.latest
+        if (screenshots == null || prefetched || snapshot == null || !state.screenStateStore.lastRenderedFull) return listing
+        val catalog = catalogProvider()
+        if (catalog != null && catalog.get(ScreenshotObserver.TOOL) == null) return listing
+        return screenshots.afterListing(session, state, listing, snapshot) ?: listing
+    }
+
+    private fun recordObservation(state: QueryJobState, request: JSONObject, toolName: String, observed: String, action: Int?): StepHistory.StepRecord {
+        val record = state.stepHistory.record(state.iteration, request, observed, action)
+        if (toolName == "mobile_list_elements_on_screen" && state.screenStateStore.lastRenderedFull) {
+            state.screenBaseRecord = record
+        }
+        return record
+    }
+
+    // Normalized calls, or null when one of them is invalid; the invalid ones are then recorded in
+    // the step history with the error the model needs to fix them
+    private fun validateCalls(state: QueryJobState, calls: List<JSONObject>): List<JSONObject>? {
+        val validator = catalogProvider()?.validator ?: return calls
+        return tracer.span("calls.validate") { span ->
+            val checked = calls.map { validator.validate(it) }
+            if (checked.all { it.call != null }) {
+                checked.forEach { if (it.fixes.isNotEmpty()) Log.d("GeminiMcpService", "Normalized call: ${it.fixes.joinToString()}") }
+                return@span checked.map { it.call!! }
+            }
+
+            span.set("rejected", checked.count { it.call == null })
+            for ((index, check) in checked.withIndex()) {
+                val error = check.error ?: continue
+                val action = if (calls.size > 1) index + 1 else null
+                state.stepHistory.record(state.iteration, calls[index], invalidCallResponse(error), action)
+                Log.w("GeminiMcpService", "Rejected call before dispatch: $error")
+            }
+            null
+        }
+    }
+
+    private fun invalidCallResponse(message: String): String {
+        return JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("error", JSONObject().apply {
+                put("code", -32602)
+                put("message", "Invalid tool call: $message")
+            })
+        }.toString()
+    }
+
+    private fun savePlan(state: QueryJobState) {
+        val cache = planCache ?: return
+        val key = state.planKey ?: return
+        if (state.planSteps.isEmpty()) return
+        cache.put(Plan(key, state.query, state.planSteps.toList(), System.currentTimeMillis()))
+    }
+
+    // Runs one turn's actions back to back; the first action that fails aborts the rest.
+    // maxIterations counts model turns, so a batch costs a single step.
+    private suspend fun executeActions(session: McpSession, state: QueryJobState, calls: List<JSONObject>): ActionResults {
+        val records = ArrayList<StepHistory.StepRecord>(calls.size)
+        for ((index, call) in calls.withIndex()) {
+            val action = if (calls.size > 1) index + 1 else null
+            val toolName = call.optJSONObject("params")?.optString("name") ?: ""
+            var prefetched: String? = null
+            val mcpResponse = tracer.span("mcp.tool_call") { span ->
+                span.set("step", state.iteration).set("action", action).set("tool", toolName)
+                prefetched = prefetchedRead(state, call, toolName)
+                span.set("prefetched", prefetched != null)
+                (prefetched ?: session.sendAndAwait(call)).also { span.set("responseBytes", it.length) }
+            }
+
+            val observed = observe(session, state, toolName, mcpResponse, prefetched != null)
+            val record = recordObservation(state, call, toolName, observed, action)
+            records.add(record)
+
+            Log.i("requestId: ${call.optInt("id")}", "step result: ${record.summary}")
+
+            if (isErrorResponse(mcpResponse)) {
+                if (index < calls.size - 1) {
+                    Log.w("GeminiMcpService", "${record.label} failed, skipping ${calls.size - index - 1} remaining actions")
+                }
+                return ActionResults(records, true)
+            }
+
+            // Let the UI settle before the next action or before the model looks at the screen again
+            val settledMs = tracer.span("ui.settle") { span ->
+                session.settleDetector.awaitSettled(toolName).also { span.set("tool", toolName).set("waitedMs", it) }
+            }
+            Log.d("GeminiMcpService", "UI settled after $toolName in ${settledMs}ms")
+        }
+        return ActionResults(records, false)
+    }
+
+    // A read the last prefetch already made, as long as nothing has acted on the screen since;
+    // the first acting call drops the prefetch
+    private suspend fun prefetchedRead(state: QueryJobState, call: JSONObject, toolName: String): String? {
+        val prefetch = state.prefetch ?: return null
+        if (!RetryPolicy.isIdempotent(call)) {
+            prefetch.cancel()
+            state.prefetch = null
+            return null
+        }
+        val arguments = call.optJSONObject("params")?.optJSONObject("arguments")
+        if (toolName !in prefetch.tools || (arguments != null && arguments.length() > 0)) return null
+        return prefetch.take(toolName)?.also { Log.d("GeminiMcpService", "Answered $toolName from the step ${prefetch.step} prefetch") }
+    }
+
+    private fun isErrorResponse(response: String): Boolean {
+        return try {
+            val json = JSONObject(response)
+            json.has("error") || json.optJSONObject("result")?.optBoolean("isError") == true
+        } catch (e: Exception) {
+            true
+        }
+    }
+}
+
+
+
+
+// AgentModel.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import org.json.JSONArray
+import org.json.JSONObject
+
+// The decision-making half of the agent loop. Implementations build their own prompt from the
+// job state and keep whatever conversation state they need in it; AgentRunner only sees turns.
+interface AgentModel {
+
+    // May run twice at once for the same step when ModelRouter hedges; only the turn passed to
+    // onToolResults() was acted on
+    suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn
+
+    // The calls of [turn] have run; [toolResults] is what the model should see about them
+    fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String)
+
+    // Called by the service's warm-up before any query so the first nextTurn() does not pay
+    // for client setup or a cold connection
+    suspend fun warmUp() {}
+}
+
+// calls holds one or more tool calls (a JSON array answer is a multi-action turn);
+// callText is the exact JSON the calls were parsed from, and droppedCalls counts the calls in it
+// past the per-turn limit, which are not run
+class ModelTurn(
+    val text: String,
+    val calls: List<JSONObject>?,
+    val completed: Boolean,
+    val promptTokens: Int? = null,
+    val callText: String? = null,
+    val droppedCalls: Int = 0
+)
+
+// Turns raw model output into a ModelTurn; shared by every AgentModel so they judge text alike
+class ModelTurnParser(
+    private val tracer: Tracer,
+    private val maxActionsPerTurn: Int = 5
+) {
+
+    fun fromText(text: String, promptTokens: Int? = null): ModelTurn {
+        if (isCompletion(text)) {
+            return ModelTurn(text, null, true, promptTokens)
+        }
+        val callText = extractJson(text)
+        val calls = callText?.let { parseCalls(it) } ?: return ModelTurn(text, null, false, promptTokens, callText)
+        return callTurn(text, calls, promptTokens, callText)
+    }
+
+    // For a complete JSON value cut out of a stream; null if it is not a usable answer yet
+    fun fromCandidate(text: String, candidate: String, promptTokens: Int?): ModelTurn? {
+        val calls = parseCalls(candidate) ?: return null
+        return if (calls.size == 1 && calls[0].optString("status") == "completed") {
+            ModelTurn(text, null, true, promptTokens)
+        } else {
+            callTurn(text, calls, promptTokens, candidate)
+        }
+    }
+
+    // Keeps the first maxActionsPerTurn calls of a batch and counts the rest
+    private fun callTurn(text: String, calls: List<JSONObject>, promptTokens: Int?, callText: String): ModelTurn {
+        val dropped = maxOf(0, calls.size - maxActionsPerTurn)
+        if (dropped > 0) {
+            Log.w("GeminiMcpService", "Model batched ${calls.size} actions, running the first $maxActionsPerTurn")
+        }
+        return ModelTurn(text, calls.take(maxActionsPerTurn), false, promptTokens, callText, dropped)
+    }
+
+    fun isCompletion(text: CharSequence): Boolean {
+        return text.contains("TASK_COMPLETED") ||
+            text.contains("\"status\": \"completed\"") ||
+            text.contains("task is complete")
+    }
+
+    // A single call object or an ordered array of them; null if it is neither
+    fun parseCalls(json: String): List<JSONObject>? = tracer.span("model.parse_calls") { span ->
+        span.set("chars", json.length)
+        try {
+            if (json.trimStart().startsWith("[")) {
+                val array = JSONArray(json)
+                (0 until array.length()).mapNotNull { array.optJSONObject(it) }.ifEmpty { null }
+            } else {
+                listOf(JSONObject(json))
+            }
+        } catch (e: Exception) {
+            Log.e("GeminiMcpService", "Failed to parse JSON: ${e.message}")
+            null
+        }
+    }
+
+    // Slices the outermost object, or array when the answer starts with one, out of the text
+    private fun extractJson(response: String): String? {
+        val trimmed = response.trim()
+        val objectStart = trimmed.indexOf('{')
+        val arrayStart = trimmed.indexOf('[')
+        val isArray = arrayStart != -1 && (objectStart == -1 || arrayStart < objectStart)
+
+        val startIndex = if (isArray) arrayStart else objectStart
+        val endIndex = if (isArray) trimmed.lastIndexOf(']') else trimmed.lastIndexOf('}')
+
+        return if (startIndex != -1 && endIndex != -1 && endIndex > startIndex) {
+            trimmed.substring(startIndex, endIndex + 1)
+        } else {
+            null
+        }
+    }
+}
+
+
+
+
+// ModelRouter.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.Deferred
+import kotlinx.coroutines.async
+import kotlinx.coroutines.coroutineScope
+import kotlinx.coroutines.selects.select
+import kotlinx.coroutines.withTimeoutOrNull
+import java.io.IOException
+import java.util.Collections
+import java.util.WeakHashMap
+import java.util.concurrent.atomic.AtomicLong
+
+// One model behind a ModelRouter. timeoutMs bounds a whole generation, hedge included; a
+// generation still running at hedgePercentile of the tier's observed latency is hedged.
+class ModelTier(
+    val name: String,
+    val model: AgentModel,
+    val timeoutMs: Long,
+    val hedgePercentile: Double = 0.90
+)
+
+data class ModelTierStats(
+    val tier: String,
+    val calls: Long,
+    val timeouts: Long,
+    val errors: Long,
+    val hedged: Long,
+    // Hedges whose second request answered first
+    val hedgeWins: Long,
+    val latency: LatencySummary
+)
+
+// AgentModel that spreads turns over [tiers], fastest first. Routine steps go to the first tier;
+// every [escalateAfterRejections] turns rejected by validation and every [escalateAfterStalls]
+// acting steps without progress move the job one tier up, until a step makes progress again.
+// A tier that times out or fails hands the turn to the next one. Works with any AgentModel
+// whose nextTurn() only commits conversation state in onToolResults(), so a hedge is harmless.
+class ModelRouter(
+    private val tiers: List<ModelTier>,
+    private val tracer: Tracer,
+    private val escalateAfterRejections: Int = 1,
+    private val escalateAfterStalls: Int = 2,
+    // No hedging until the tier's percentile is based on this many generations
+    private val hedgeMinSamples: Int = 20,
+    private val hedgeMinDelayMs: Long = 500L
+) : AgentModel {
+
+    init {
+        require(tiers.isNotEmpty()) { "ModelRouter needs at least one tier" }
+    }
+
+    private class TierCounters {
+        val latency = LatencyHistogram()
+        val calls = AtomicLong()
+        val timeouts = AtomicLong()
+        val errors = AtomicLong()
+        val hedged = AtomicLong()
+        val hedgeWins = AtomicLong()
+    }
+
+    private val counters = tiers.associate { it.name to TierCounters() }
+    // Results go back to the tier that produced the turn
+    private val turnTiers = Collections.synchronizedMap(WeakHashMap<ModelTurn, ModelTier>())
+
+    override suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn {
+        var index = tierIndexFor(state)
+        while (true) {
+            val tier = tiers[index]
+            val failure = try {
+                val turn = generate(tier, session, state)
+                if (turn != null) {
+                    turnTiers[turn] = tier
+                    return turn
+                }
+                IOException("Model tier ${tier.name} did not answer within ${tier.timeoutMs}ms")
+            } catch (e: CancellationException) {
+                throw e
+            } catch (e: Exception) {
+                counters.getValue(tier.name).errors.incrementAndGet()
+                e
+            }
+            if (index == tiers.lastIndex) throw failure
+            Log.w("ModelRouter", "Step ${state.iteration}: ${failure.message}, escalating to ${tiers[index + 1].name}")
+            index++
+        }
+    }
+
+    override fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String) {
+        val tier = turnTiers.remove(turn) ?: tiers.first()
+        tier.model.onToolResults(state, turn, toolResults)
+    }
+
+    // The first tier must come up; the others are primed on a best-effort basis
+    override suspend fun warmUp() {
+        tiers.first().model.warmUp()
+        for (tier in tiers.drop(1)) {
+            try {
+                tier.model.warmUp()
+            } catch (e: CancellationException) {
+                throw e
+            } catch (e: Exception) {
+                Log.w("ModelRouter", "Could not warm up ${tier.name}: ${e.message}")
+            }
+        }
+    }
+
+    fun stats(): List<ModelTierStats> {
+        return tiers.map { tier ->
+            val c = counters.getValue(tier.name)
+            ModelTierStats(tier.name, c.calls.get(), c.timeouts.get(), c.errors.get(), c.hedged.get(), c.hedgeWins.get(), c.latency.summary())
+        }
+    }
+
+    private fun tierIndexFor(state: QueryJobState): Int {
+        val level = state.rejectedTurns / maxOf(1, escalateAfterRejections) + state.stalledSteps / maxOf(1, escalateAfterStalls)
+        return level.coerceAtMost(tiers.lastIndex)
+    }
+
+    // null when the tier ran out of time
+    private suspend fun generate(tier: ModelTier, session: McpSession, state: QueryJobState): ModelTurn? {
+        val c = counters.getValue(tier.name)
+        c.calls.incrementAndGet()
+        val hedgeAfterMs = hedgeDelayMs(tier, c)
+        val start = System.nanoTime()
+        return tracer.span("model.route") { span ->
+            span.set("tier", tier.name).set("step", state.iteration)
+            val turn = withTimeoutOrNull(tier.timeoutMs) {
+                if (hedgeAfterMs == null) tier.model.nextTurn(session, state) else hedged(tier, c, session, state, hedgeAfterMs, span)
+            }
+            if (turn == null) {
+                c.timeouts.incrementAndGet()
+                span.set("timedOut", true)
+            } else {
+                c.latency.record((System.nanoTime() - start) / 1_000L)
+            }
+            turn
+        }
+    }
+
+    // Fires a second identical request once the first has run for [hedgeAfterMs], or as soon as
+    // it fails, and takes the first answer; the other request is then cancelled. A failed
+    // request leaves the other one running, so the hedge only fails when both have failed.
+    private suspend fun hedged(
+        tier: ModelTier,
+        c: TierCounters,
+        session: McpSession,
+        state: QueryJobState,
+        hedgeAfterMs: Long,
+        span: Span
+    ): ModelTurn = coroutineScope {
+        val primary = async { attempt(tier, session, state) }
+        val early = withTimeoutOrNull(hedgeAfterMs) { primary.await() }
+        early?.getOrNull()?.let { return@coroutineScope it }
+
+        c.hedged.incrementAndGet()
+        span.set("hedgedAfterMs", hedgeAfterMs)
+        val backup = async { attempt(tier, session, state) }
+        val running = if (early == null) mutableListOf(primary, backup) else mutableListOf(backup)
+        var failure = early?.exceptionOrNull()
+        while (running.isNotEmpty()) {
+            val (request, result) = select<Pair<Deferred<Result<ModelTurn>>, Result<ModelTurn>>> {
+                running.forEach { request -> request.onAwait { request to it } }
+            }
+            running.remove(request)
+            val turn = result.getOrNull()
+            if (turn != null) {
+                if (request === backup) c.hedgeWins.incrementAndGet()
+                running.forEach { it.cancel() }
+                return@coroutineScope turn
+            }
+            if (failure == null) failure = result.exceptionOrNull()
+        }
+        throw failure!!
+    }
+
+    // A failure as a value, so that one failed request of a hedge does not cancel the other
+    private suspend fun attempt(tier: ModelTier, session: McpSession, state: QueryJobState): Result<ModelTurn> {
+        return try {
+            Result.success(tier.model.nextTurn(session, state))
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Result.failure(e)
+        }
+    }
+
+    private fun hedgeDelayMs(tier: ModelTier, c: TierCounters): Long? {
+        if (c.latency.summary().count < hedgeMinSamples) return null
+        val delayMs = maxOf(hedgeMinDelayMs, c.latency.percentileMs(tier.hedgePercentile).toLong())
+        return if (delayMs < tier.timeoutMs) delayMs else null
+    }
+}
+
+
+
+
+// QueryScheduler.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.CoroutineScope
+import kotlinx.coroutines.Job
+import kotlinx.coroutines.channels.Channel
+import kotlinx.coroutines.launch
+import java.util.concurrent.atomic.AtomicInteger
+
+enum class JobOutcome {
+    COMPLETED,
+    FAILED,
+    STEP_BUDGET_EXHAUSTED,
+    TIMED_OUT
+}
+
+// Everything one query needs while it runs; nothing in here is shared between jobs
+class QueryJobState(val query: String, resultStore: ResultStore = ResultStore.IN_MEMORY) {
+    var iteration = 0
+    val stepHistory = StepHistory(resultStore = resultStore)
+    val screenStateStore = ScreenStateStore()
+    // The step record holding the full listing that screen diffs are taken against
+    var screenBaseRecord: StepHistory.StepRecord? = null
+    var chatSession: ChatSession? = null
+    val tokenUsage = ArrayList<StepTokenUsage>()
+    // Plan cache key and the turns that worked, recorded for replay once the task completes
+    var planKey: String? = null
+    val planSteps = ArrayList<PlanStep>()
+    // Screen reads started after the latest acting step
+    var prefetch: ScreenPrefetch? = null
+    // Since the last step that made progress: turns rejected by validation, and acting steps
+    // that failed or left the screen unchanged. ModelRouter escalates on these.
+    var rejectedTurns = 0
+    var stalledSteps = 0
+    // Latest screenshot queued for the model, shown with the results of screenshotStep
+    var screenshot: Screenshot? = null
+    var screenshotStep = 0
+    // Name of the job's checkpoint log while it runs; set before the job starts when it is resumed
+    var checkpointId: String? = null
+}
+
+class QueryJob(val id: Int, val query: String, val state: QueryJobState) {
+    val enqueuedAt = System.currentTimeMillis()
+}
+
+// Bounded FIFO of query jobs drained by worker coroutines. A worker takes the next job as soon
+// as its current one ends, so bursts are queued instead of rejected.
+class QueryScheduler(
+    private val scope: CoroutineScope,
+    capacity: Int,
+    private val runJob: suspend (QueryJob) -> Unit,
+    private val newState: (String) -> QueryJobState = { QueryJobState(it) }
+) {
+    private val queue = Channel<QueryJob>(capacity)
+    private val nextJobId = AtomicInteger(1)
+    private val queued = AtomicInteger(0)
+    private val running = AtomicInteger(0)
+    private val workers = ArrayList<Job>()
+
+    val queueDepth: Int
+        get() = queued.get()
+
+    val runningJobs: Int
+        get() = running.get()
+
+    fun start(workerCount: Int = 1) {
+        repeat(workerCount) { worker ->
+            workers.add(scope.launch {
+                for (job in queue) {
+                    queued.decrementAndGet()
+                    running.incrementAndGet()
+                    try {
+                        runJob(job)
+                    } catch (e: CancellationException) {
+                        throw e
+                    } catch (e: Exception) {
+                        Log.e("QueryScheduler", "Worker $worker: job ${job.id} crashed", e)
+                    } finally {
+                        running.decrementAndGet()
+                    }
+                }
+            })
+        }
+    }
+
+    // Returns null when the queue is full. A job resumed from a checkpoint brings its own state.
+    fun submit(query: String, state: QueryJobState = newState(query)): QueryJob? {
+        val job = QueryJob(nextJobId.getAndIncrement(), query, state)
+        queued.incrementAndGet()
+        if (queue.trySend(job).isSuccess) return job
+        queued.decrementAndGet()
+        return null
+    }
+
+    fun shutdown() {
+        queue.close()
+        workers.forEach { it.cancel() }
+        workers.clear()
+    }
+}
+
+
+
+
+// ScreenStateStore.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import java.util.TreeSet
+
+class ScreenElement(
+    val type: String,
+    val text: String,
+    val label: String,
+    val identifier: String,
+    val value: String,
+    val bounds: String
+) {
+    // Identity of the element across snapshots; bounds and value are what may change
+    val key: String
+        get() = "$type|$identifier|$label|$text"
+
+    fun describe(): String {
+        val builder = StringBuilder(type.substringAfterLast('.'))
+        if (text.isNotEmpty()) builder.append(" \"").append(text).append('"')
+        if (label.isNotEmpty() && label != text) builder.append(" label=\"").append(label).append('"')
+        if (identifier.isNotEmpty()) builder.append(" id=").append(identifier)
+        if (value.isNotEmpty()) builder.append(" value=\"").append(value).append('"')
+        builder.append(" @").append(bounds)
+        return builder.toString()
+    }
+
+    fun sameState(other: ScreenElement): Boolean = bounds == other.bounds && value == other.value
+
+    companion object {
+        fun fromJson(json: JSONObject): ScreenElement {
+            val rect = json.optJSONObject("rect") ?: json.optJSONObject("coordinates")
+            val bounds = if (rect != null) {
+                "${rect.optInt("x")},${rect.optInt("y")} ${rect.optInt("width")}x${rect.optInt("height")}"
+            } else {
+                "?"
+            }
+            return ScreenElement(
+                type = json.optString("type"),
+                text = json.optString("text"),
+                label = json.optString("label", json.optString("name")),
+                identifier = json.optString("identifier"),
+                value = json.optString("value"),
+                bounds = bounds
+            )
+        }
+    }
+}
+
+class ScreenSnapshot(
+    val id: String,
+    val elements: LinkedHashMap<String, ScreenElement>
+) {
+    // UTF-8 size of the snapshot rendered as a full listing, whatever was actually sent
+    val fullBytes: Int by lazy { elements.values.sumOf { it.describe().toByteArray(Charsets.UTF_8).size + 1 } }
+}
+
+// Turns mobile_list_elements_on_screen results into keyed snapshots and hands the prompt only
+// what changed since the last snapshot it rendered in full (the base) instead of the whole
+// listing every time. A diff is only useful while the model can still see its base, so the
+// caller says whether it can.
+class ScreenStateStore {
+
+    private var current: ScreenSnapshot? = null
+    private var base: ScreenSnapshot? = null
+    private var counter = 0
+
+    val latest: ScreenSnapshot?
+        get() = current
+
+    // Whether the last ingest() rendered the full listing, which is then the new base
+    var lastRenderedFull = false
+        private set
+
+    fun clear() {
+        current = null
+        base = null
+        counter = 0
+        lastRenderedFull = false
+    }
+
+    // Compact text for the prompt, or null when the result is not an element listing
+    fun ingest(result: String, baseVisible: Boolean = true): String? {
+        lastRenderedFull = false
+        val elements = parseElements(result) ?: return null
+        val previous = base
+        val snapshot = ScreenSnapshot("s${++counter}", elements)
+        current = snapshot
+
+        if (previous == null || !baseVisible) return renderFull(snapshot)
+
+        val added = ArrayList<ScreenElement>()
+        val changed = ArrayList<Pair<ScreenElement, ScreenElement>>()
+        for ((key, element) in elements) {
+            val before = previous.elements[key]
+            when {
+                before == null -> added.add(element)
+                !before.sameState(element) -> changed.add(before to element)
+            }
+        }
+        val removed = previous.elements.filterKeys { it !in elements }.values
+
+        if (added.isEmpty() && removed.isEmpty() && changed.isEmpty()) {
+            return "Screen ${snapshot.id}: unchanged since ${previous.id} (${elements.size} elements)"
+        }
+        // A mostly new screen reads better as a plain listing than as a diff
+        if (added.size + removed.size > elements.size) {
+            return renderFull(snapshot)
+        }
+
+        val builder = StringBuilder()
+        builder.append("Screen ${snapshot.id} (${elements.size} elements; vs ${previous.id}: ")
+            .append("+${added.size} -${removed.size} ~${changed.size}):")
+        added.forEach { builder.append("\n+ ").append(it.describe()) }
+        removed.forEach { builder.append("\n- ").append(it.describe()) }
+        changed.forEach { (before, after) ->
+            builder.append("\n~ ").append(after.describe())
+            if (before.bounds != after.bounds) builder.append(" (was @").append(before.bounds).append(')')
+            if (before.value != after.value) builder.append(" (was value=\"").append(before.value).append("\")")
+        }
+        return builder.toString()
+    }
+
+    private fun renderFull(snapshot: ScreenSnapshot): String {
+        base = snapshot
+        lastRenderedFull = true
+        val builder = StringBuilder("Screen ${snapshot.id} (${snapshot.elements.size} elements):")
+        snapshot.elements.values.forEach { builder.append("\n").append(it.describe()) }
+        return builder.toString()
+    }
+
+    companion object {
+        private val DIGITS = Regex("\\d+")
+
+        // Identity of a screen for plan lookup and replay checks: the set of its element keys with
+        // every run of digits masked. Bounds and values are left out and a clock, a counter or a
+        // battery level reads the same at any value, so only a different screen changes it.
+        // Null when [result] is not an element listing.
+        fun signature(result: String): String? {
+            val elements = parseElements(result) ?: return null
+            val keys = elements.values.mapTo(TreeSet()) { it.key.replace(DIGITS, "#") }
+            return sha1Hex(keys.joinToString("\n").toByteArray(Charsets.UTF_8), 16)
+        }
+
+        // The tool answers with text like "Found these elements on screen: [...]"
+        private fun parseElements(result: String): LinkedHashMap<String, ScreenElement>? {
+            return try {
+                val content = JSONObject(result).optJSONObject("result")?.optJSONArray("content") ?: return null
+                val text = content.optJSONObject(0)?.optString("text") ?: return null
+                val start = text.indexOf('[')
+                val end = text.lastIndexOf(']')
+                if (start == -1 || end < start) return null
+
+                val array = JSONArray(text.substring(start, end + 1))
+                val elements = LinkedHashMap<String, ScreenElement>(array.length() * 2)
+                for (i in 0 until array.length()) {
+                    val element = ScreenElement.fromJson(array.optJSONObject(i) ?: continue)
+                    // Identical-looking elements (e.g. unlabeled rows) are told apart by occurrence
+                    var key = element.key
+                    var occurrence = 1
+                    while (elements.containsKey(key)) {
+                        key = "${element.key}#${++occurrence}"
+                    }
+                    elements[key] = element
+                }
+                elements
+            } catch (e: Exception) {
+                null
+            }
+        }
+    }
+}
+
+
+
+
+// GeminiAgentModel.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import com.google.ai.client.generativeai.GenerativeModel
+import com.google.ai.client.generativeai.type.Content
+import com.google.ai.client.generativeai.type.content
+import kotlinx.coroutines.flow.collect
+import kotlinx.coroutines.flow.takeWhile
+
+// AgentModel backed by Gemini. In CHAT_SESSION mode the instructions and tool catalog go into a
+// per-catalog system instruction and each step appends one turn; SINGLE_PROMPT rebuilds the
+// whole prompt every step. The tool catalog is read through [catalogProvider] on every turn so a
+// refreshed catalog is picked up mid-task. A conversation whose history outgrows
+// [maxChatHistoryChars] restarts from the bounded StepHistory render, so both modes keep the
+// prompt within the same budget.
+class GeminiAgentModel(
+    private val modelName: String,
+    private val apiKey: String,
+    private val parser: ModelTurnParser,
+    private val tracer: Tracer,
+    private val maxChatHistoryChars: Int = StepHistoryPolicy().maxRenderedChars,
+    private val catalogProvider: () -> ToolCatalog?
+) : AgentModel {
+
+    enum class PromptMode {
+        SINGLE_PROMPT, // rebuild the whole prompt every step
+        CHAT_SESSION   // static system instruction, one new turn per step
+    }
+
+    @Volatile
+    var promptMode = PromptMode.CHAT_SESSION
+    @Volatile
+    var useStreamingGeneration = true
+
+    private val generativeModel = GenerativeModel(
+        modelName = modelName,
+        apiKey = apiKey
+    )
+
+    // Chat sessions of all jobs on the same catalog share one client, so the system instruction
+    // is built once and warmUp() primes the client the jobs actually use
+    @Volatile
+    private var chatModel: Pair<String, GenerativeModel>? = null
+
+    // countTokens is free and goes through the same client and connection as generateContent
+    override suspend fun warmUp() {
+        val catalog = catalogProvider()
+        val model = if (promptMode == PromptMode.CHAT_SESSION && catalog != null) chatModelFor(catalog) else generativeModel
+        tracer.span("model.warm_up") { model.countTokens("ping") }
+    }
+
+    override suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn {
+        val catalog = if (promptMode == PromptMode.CHAT_SESSION) catalogProvider() else null
+        val chat = catalog?.let { ensureChatSession(state, it) }
+        val model = if (catalog != null) chatModelFor(catalog) else generativeModel
+        val contents = chat?.contents() ?: listOf(content {
+            // The screenshot taken with the previous step's results
+            state.screenshot?.takeIf { state.screenshotStep == state.iteration - 1 }?.let { blob("image/jpeg", it.jpeg) }
+            text(createGeminiPrompt(session, state))
+        })
+        val promptChars = contents.textLength()
+        Log.d("Gemini", "Prompt (${promptModeName(chat)}): $promptChars chars")
+
+        val turn = tracer.span("model.generate") { span ->
+            span.set("step", state.iteration).set("mode", promptModeName(chat)).set("promptChars", promptChars)
+            generateTurn(model, contents).also {
+                span.set("promptTokens", it.promptTokens).set("calls", it.calls?.size ?: 0)
+            }
+        }
+        recordTokenUsage(state, StepTokenUsage(state.iteration, promptModeName(chat), turn.promptTokens, promptChars))
+        return turn
+    }
+
+    // The turn enters the conversation only here, once it has been acted on: nextTurn() leaves
+    // the conversation alone, so a hedged duplicate generation that loses leaves no trace
+    override fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String) {
+        if (promptMode != PromptMode.CHAT_SESSION) return
+        val chat = state.chatSession ?: return
+        // Only the part we act on is kept in the conversation
+        turn.calls?.firstOrNull()?.let { chat.commit(turn.callText ?: it.toString()) }
+        val jpeg = state.screenshot?.takeIf { state.screenshotStep == state.iteration }?.jpeg
+        if (chat.historyChars <= maxChatHistoryChars) {
+            chat.addToolResults(toolResults, jpeg)
+            return
+        }
+        // The history render already holds this step's results, with older ones collapsed
+        Log.d("Gemini", "Chat history at ${chat.historyChars} chars, restarting from the step history")
+        synchronized(state) { state.chatSession = newChatSession(state, chat.catalogHash, jpeg) }
+    }
+
+    // One conversation per job and tool catalog. It holds no model, so a job routed to another
+    // tier mid-task carries its conversation over.
+    private fun ensureChatSession(state: QueryJobState, catalog: ToolCatalog): ChatSession {
+        synchronized(state) {
+            state.chatSession?.let { if (it.catalogHash == catalog.schemaHash) return it }
+
+            // A catalog change mid-task restarts the conversation; replay what already happened
+            val session = newChatSession(state, catalog.schemaHash)
+            state.chatSession = session
+            return session
+        }
+    }
+
+    private fun newChatSession(state: QueryJobState, catalogHash: String, jpeg: ByteArray? = null): ChatSession {
+        val session = ChatSession(catalogHash)
+        session.start(state.query)
+        if (state.stepHistory.size > 0) {
+            session.addToolResults("PREVIOUS MCP RESPONSES:\n${state.stepHistory.render()}", jpeg)
+        }
+        return session
+    }
+
+    private fun chatModelFor(catalog: ToolCatalog): GenerativeModel {
+        chatModel?.let { (hash, model) -> if (hash == catalog.schemaHash) return model }
+        val model = GenerativeModel(
+            modelName = modelName,
+            apiKey = apiKey,
+            systemInstruction = content { text(createChatSystemInstruction(catalog)) }
+        )
+        chatModel = catalog.schemaHash to model
+        return model
+    }
+
+    private fun promptModeName(session: ChatSession?): String {
+        return if (session != null) "chat" else "single-prompt"
+    }
+
+    private fun recordTokenUsage(state: QueryJobState, usage: StepTokenUsage) {
+        synchronized(state.tokenUsage) { state.tokenUsage.add(usage) }
+        Log.d("GeminiMcpService", "Step ${usage.step} [${usage.mode}] input: ${usage.promptTokens ?: "?"} tokens, ${usage.promptChars} chars")
+    }
+
+    // With streaming on, generation is cancelled as soon as the first complete JSON object
+    // (or a completion marker) has arrived, so the tool call is dispatched without waiting
+    // for the rest of the model output
+    private suspend fun generateTurn(model: GenerativeModel, contents: List<Content>): ModelTurn {
+        if (!useStreamingGeneration) {
+            val response = model.generateContent(*contents.toTypedArray())
+            return parser.fromText(response.text ?: "", response.usageMetadata?.promptTokenCount)
+        }
+
+        val detector = IncrementalJsonDetector()
+        var turn: ModelTurn? = null
+        var promptTokens: Int? = null
+        model.generateContentStream(*contents.toTypedArray())
+            .takeWhile { chunk ->
+                chunk.usageMetadata?.let { promptTokens = it.promptTokenCount }
+                var candidate = detector.feed(chunk.text ?: "")
+                while (turn == null && candidate != null) {
+                    turn = parser.fromCandidate(detector.accumulated.toString(), candidate, promptTokens)
+                    if (turn == null) candidate = detector.next()
+                }
+                if (turn == null && parser.isCompletion(detector.accumulated)) {
+                    turn = ModelTurn(detector.accumulated.toString(), null, true, promptTokens)
+                }
+                turn == null
+            }
+            .collect()
+
+        // The stream ended without a usable object; judge the full text like the blocking path
+        return turn ?: parser.fromText(detector.accumulated.toString(), promptTokens)
+    }
+
+    private fun createGeminiPrompt(session: McpSession, state: QueryJobState): String {
+        return """
+            You are an AI assistant that controls mobile devices through an MCP server.
+            Your task is to help execute user queries by calling the appropriate mobile device tools.
+            Remember that the device is already selected and start with the user query.
+            
+            AVAILABLE TOOLS:
+            ${catalogProvider()?.promptText ?: "(unavailable)"}
+            
+            USER QUERY: ${state.query}
+            
+            PREVIOUS MCP RESPONSES:
+            ${state.stepHistory.render()}
+            
+            CRITICAL INSTRUCTIONS:
+            1. Respond with ONLY valid JSON - no markdown formatting, no code blocks, no extra text
+            2. If task is complete, respond with: {"status": "completed", "message": "Task completed successfully"}
+            3. Otherwise, respond with the exact MCP JSON format shown below
+            
+            RESPONSE FORMAT (choose one):
+            
+            For MCP tool call:
+            {"jsonrpc": "2.0", "id": ${session.peekNextRequestId()}, "method": "tools/call", "params": {"name": "tool_name", "arguments": {"param": "value"}}}
+            
+            For a short sequence of actions whose outcome you can predict (e.g. tap a field, type text, press ENTER),
+            an ordered array of MCP tool calls; they run in order and stop at the first error:
+            [{"jsonrpc": "2.0", "id": 1, "method": "tools/call", "params": {...}}, {"jsonrpc": "2.0", "id": 2, "method": "tools/call", "params": {...}}]
+            
+            For completion:
+            {"status": "completed", "message": "Task completed successfully"}
+            
+            IMPORTANT: 
+            - NO markdown formatting (no ```
+            - NO additional text or explanations
+            - ONLY JSON response
+            - Use exact tool names from the tools list
+            - Think about what action is needed next based on user query and previous responses
+        """.trimIndent()
+    }
+
+    // Everything that does not change between steps, sent once as the chat's system instruction
+    private fun createChatSystemInstruction(catalog: ToolCatalog): String {
+        return """
+            You are an AI assistant that controls mobile devices through an MCP server.
+            Your task is to help execute user queries by calling the appropriate mobile device tools.
+            Remember that the device is already selected and start with the user query.
+            The first user turn carries the query; every later user turn carries the result of your previous tool call.
+            
+            AVAILABLE TOOLS:
+            ${catalog.promptText}
+            
+            CRITICAL INSTRUCTIONS:
+            1. Respond with ONLY valid JSON - no markdown formatting, no code blocks, no extra text
+            2. If task is complete, respond with: {"status": "completed", "message": "Task completed successfully"}
+            3. Otherwise, respond with the exact MCP JSON format shown below
+            
+            RESPONSE FORMAT (choose one):
+            
+            For MCP tool call:
+            {"jsonrpc": "2.0", "id": 1, "method": "tools/call", "params": {"name": "tool_name", "arguments": {"param": "value"}}}
+            
+            For a short sequence of actions whose outcome you can predict (e.g. tap a field, type text, press ENTER),
+            an ordered array of MCP tool calls; they run in order and stop at the first error:
+            [{"jsonrpc": "2.0", "id": 1, "method": "tools/call", "params": {...}}, {"jsonrpc": "2.0", "id": 2, "method": "tools/call", "params": {...}}]
+            
+            For completion:
+            {"status": "completed", "message": "Task completed successfully"}
+            
+            IMPORTANT: 
+            - NO markdown formatting (no ```
+            - NO additional text or explanations
+            - ONLY JSON response
+            - Use exact tool names from the tools list
+            - Think about what action is needed next based on user query and previous responses
+        """.trimIndent()
+    }
+}
+
+
+
+
+// ChatSession.kt
+
+package com.example.mcpapp
+
+import com.google.ai.client.generativeai.type.Content
+import com.google.ai.client.generativeai.type.TextPart
+import com.google.ai.client.generativeai.type.content
+
+// Multi-turn alternative to rebuilding one big prompt per step. The instructions and tool catalog
+// live in the model's system instruction, so the request prefix is identical on every step and
+// can be served from the implicit context cache; each step only appends the newest tool result.
+// History is kept here rather than in the SDK's Chat because a streamed turn is cut short as soon
+// as the tool call is complete, and Chat drops turns whose stream did not finish.
+class ChatSession(val catalogHash: String) {
+
+    private val history = ArrayList<Content>()
+    // Text of the user turn the model has not answered yet. Results added before an answer are
+    // appended to it, so the query of a chat restarted with history is never lost.
+    private var pendingText: String? = null
+    // Sent with the pending turn only; the turn goes into history without it
+    private var pendingImage: ByteArray? = null
+
+    val turns: Int
+        get() = history.size / 2
+
+    // Size of the answered turns, which every later request re-sends
+    val historyChars: Int
+        get() = history.textLength()
+
+    fun start(query: String) {
+        history.clear()
+        pendingText = "USER QUERY: $query"
+        pendingImage = null
+    }
+
+    fun addToolResults(text: String, jpeg: ByteArray? = null) {
+        pendingText = pendingText?.let { "$it\n\n$text" } ?: text
+        if (jpeg != null) pendingImage = jpeg
+    }
+
+    fun contents(): List<Content> {
+        val turnText = pendingText ?: return history
+        val image = pendingImage
+        return history + content("user") {
+            if (image != null) blob("image/jpeg", image)
+            text(turnText)
+        }
+    }
+
+    // Records what the model answered to the pending user turn; only the part we acted on is kept
+    fun commit(modelText: String) {
+        val turnText = pendingText ?: return
+        history.add(content("user") { text(turnText) })
+        history.add(content("model") { text(modelText) })
+        pendingText = null
+        pendingImage = null
+    }
+}
+
+data class StepTokenUsage(
+    val step: Int,
+    val mode: String,
+    val promptTokens: Int?,
+    val promptChars: Int
+)
+
+internal fun List<Content>.textLength(): Int {
+    return sumOf { content -> content.parts.sumOf { part -> (part as? TextPart)?.text?.length ?: 0 } }
+}
+
+
+
+
+// IncrementalJsonDetector.kt
+
+package com.example.mcpapp
+
+// Finds the first complete, bracket-balanced JSON object or array in text that arrives in
+// chunks, so a streamed model answer can be acted on before generation finishes
+class IncrementalJsonDetector {
+
+    private val text = StringBuilder()
+    private var scanned = 0
+    private var start = -1
+    private var depth = 0
+    private var inString = false
+    private var escaped = false
+
+    val accumulated: CharSequence
+        get() = text
+
+    // Returns the next complete top-level value once it is available, null until then
+    fun feed(chunk: CharSequence): String? {
+        text.append(chunk)
+        while (scanned < text.length) {
+            val c = text[scanned++]
+            if (start < 0) {
+                if (c == '{' || c == '[') {
+                    start = scanned - 1
+                    depth = 1
+                }
+            } else if (inString) {
+                when {
+                    escaped -> escaped = false
+                    c == '\\' -> escaped = true
+                    c == '"' -> inString = false
+                }
+            } else {
+                when (c) {
+                    '"' -> inString = true
+                    '{', '[' -> depth++
+                    '}', ']' -> {
+                        depth--
+                        if (depth == 0) {
+                            val candidate = text.substring(start, scanned)
+                            start = -1
+                            return candidate
+                        }
+                    }
+                }
+            }
+        }
+        return null
+    }
+
+    // Continues scanning after a candidate the caller could not use (e.g. braces in prose)
+    fun next(): String? = feed("")
+}
+
+
+
+
+// SseDecoder.kt
+
+package com.example.mcpapp
+
+import java.io.InputStream
+
+class SseEvent(
+    val type: String,
+    val data: String,
+    val id: String?,
+    val retryMs: Long?
+)
+
+// Incremental text/event-stream decoder that works on the raw byte stream.
+// Follows the SSE spec: CR, LF or CRLF line endings, multi-line data joined with LF, comments,
+// `id:` (sticky across events) and `retry:`. Lines and data are accumulated in reusable byte
+// buffers, so the only per-event allocations are the data string and an unusual event type.
+class SseDecoder(private val input: InputStream, bufferSize: Int = 16 * 1024) {
+
+    private val buffer = ByteArray(bufferSize)
+    private var pos = 0
+    private var limit = 0
+    // Bytes of a leading byte order mark matched so far; -1 once past the start of the stream
+    private var bomMatched = 0
+    private var skipLineFeed = false
+
+    private var line = ByteArray(1024)
+    private var lineLength = 0
+
+    private var data = ByteArray(4096)
+    private var dataLength = 0
+    private var eventType: String? = null
+
+    var lastEventId: String? = null
+        private set
+    var retryMs: Long? = null
+        private set
+
+    // Blocks until the next complete event; null at end of stream (a trailing partial event is dropped)
+    fun next(): SseEvent? {
+        while (readLine()) {
+            if (lineLength == 0) {
+                dispatch()?.let { return it }
+            } else {
+                processLine()
+            }
+        }
+        return null
+    }
+
+    private fun dispatch(): SseEvent? {
+        val type = eventType
+        eventType = null
+        if (dataLength == 0) return null
+
+        // Every data line appended a LF; the last one is not part of the payload
+        val payload = String(data, 0, dataLength - 1, Charsets.UTF_8)
+        dataLength = 0
+        return SseEvent(type ?: "message", payload, lastEventId, retryMs)
+    }
+
+    private fun processLine() {
+        if (line[0] == COLON) return // comment
+
+        var colon = -1
+        for (i in 0 until lineLength) {
+            if (line[i] == COLON) {
+                colon = i
+                break
+            }
+        }
+        val fieldEnd = if (colon < 0) lineLength else colon
+        var valueStart = if (colon < 0) lineLength else colon + 1
+        if (valueStart < lineLength && line[valueStart] == SPACE) valueStart++
+
+        when {
+            fieldIs(DATA, fieldEnd) -> {
+                appendData(valueStart)
+            }
+
+            fieldIs(EVENT, fieldEnd) -> {
+                eventType = when {
+                    valueIs(MESSAGE, valueStart) -> "message"
+                    valueIs(ENDPOINT, valueStart) -> "endpoint"
+                    else -> String(line, valueStart, lineLength - valueStart, Charsets.UTF_8)
+                }
+            }
+
+            fieldIs(ID, fieldEnd) -> {
+                var hasNull = false
+                for (i in valueStart until lineLength) {
+                    if (line[i].toInt() == 0) hasNull = true
+                }
+                if (!hasNull) {
+                    lastEventId = String(line, valueStart, lineLength - valueStart, Charsets.UTF_8)
+                }
+            }
+
+            fieldIs(RETRY, fieldEnd) -> {
+                var value = 0L
+                var valid = valueStart < lineLength
+                for (i in valueStart until lineLength) {
+                    val digit = line[i] - ZERO
+                    if (digit !in 0..9) {
+                        valid = false
+                        break
+                    }
+                    value = value * 10 + digit
+                }
+                if (valid) retryMs = value
+            }
+            // Unknown fields are ignored per spec
+        }
+    }
+
+    private fun appendData(valueStart: Int) {
+        val length = lineLength - valueStart
+        data = ensureCapacity(data, dataLength + length + 1)
+        System.arraycopy(line, valueStart, data, dataLength, length)
+        dataLength += length
+        data[dataLength++] = LF
+    }
+
+    // Reads one line into `line`; false at end of stream
+    private fun readLine(): Boolean {
+        lineLength = 0
+        while (true) {
+            if (pos >= limit) {
+                if (!fill()) return false
+                continue
+            }
+            if (skipLineFeed) {
+                skipLineFeed = false
+                if (buffer[pos] == LF) {
+                    pos++
+                    continue
+                }
+            }
+
+            val start = pos
+            while (pos < limit) {
+                val b = buffer[pos]
+                if (b == LF || b == CR) {
+                    appendLine(start, pos)
+                    pos++
+                    skipLineFeed = b == CR
+                    return true
+                }
+                pos++
+            }
+            appendLine(start, limit)
+        }
+    }
+
+    private fun fill(): Boolean {
+        val read = input.read(buffer, 0, buffer.size)
+        if (read <= 0) {
+            limit = 0
+            pos = 0
+            return false
+        }
+        pos = 0
+        limit = read
+        if (bomMatched >= 0) skipByteOrderMark()
+        return true
+    }
+
+    // Skips a UTF-8 byte order mark, which may arrive split over several reads. Bytes that only
+    // begin one are dropped too; they could only have started an unknown field.
+    private fun skipByteOrderMark() {
+        while (pos < limit && bomMatched < BOM.size) {
+            if (buffer[pos] != BOM[bomMatched]) {
+                bomMatched = -1
+                return
+            }
+            bomMatched++
+            pos++
+        }
+        if (bomMatched == BOM.size) bomMatched = -1
+    }
+
+    private fun appendLine(from: Int, to: Int) {
+        val length = to - from
+        if (length == 0) return
+        line = ensureCapacity(line, lineLength + length)
+        System.arraycopy(buffer, from, line, lineLength, length)
+        lineLength += length
+    }
+
+    private fun fieldIs(name: ByteArray, fieldEnd: Int): Boolean {
+        if (fieldEnd != name.size) return false
+        for (i in name.indices) {
+            if (line[i] != name[i]) return false
+        }
+        return true
+    }
+
+    private fun valueIs(value: ByteArray, valueStart: Int): Boolean {
+        if (lineLength - valueStart != value.size) return false
+        for (i in value.indices) {
+            if (line[valueStart + i] != value[i]) return false
+        }
+        return true
+    }
+
+    private fun ensureCapacity(array: ByteArray, required: Int): ByteArray {
+        if (required <= array.size) return array
+        return array.copyOf(maxOf(required, array.size * 2))
+    }
+
+    private companion object {
+        const val LF: Byte = 0x0A
+        const val CR: Byte = 0x0D
+        const val COLON: Byte = 0x3A
+        const val SPACE: Byte = 0x20
+        const val ZERO: Byte = 0x30
+        val DATA = "data".toByteArray(Charsets.US_ASCII)
+        val EVENT = "event".toByteArray(Charsets.US_ASCII)
+        val ID = "id".toByteArray(Charsets.US_ASCII)
+        val RETRY = "retry".toByteArray(Charsets.US_ASCII)
+        val MESSAGE = "message".toByteArray(Charsets.US_ASCII)
+        val ENDPOINT = "endpoint".toByteArray(Charsets.US_ASCII)
+        val BOM = byteArrayOf(0xEF.toByte(), 0xBB.toByte(), 0xBF.toByte())
+    }
+}
+
+// Reads top-level members of a JSON-RPC message without building a JSONObject, so routing a
+// response costs one scan and the consumer does the only full parse
+object JsonRpcPeek {
+
+    // Numeric (or numeric string) top-level "id"; null when absent, null or not an int
+    fun id(json: String): Int? {
+        var i = topLevelValueStart(json, "id")
+        if (i < 0) return null
+
+        val quoted = json[i] == '"'
+        if (quoted) i++
+        val negative = i < json.length && json[i] == '-'
+        if (negative) i++
+
+        var value = 0L
+        var digits = 0
+        while (i < json.length && json[i] in '0'..'9') {
+            value = value * 10 + (json[i] - '0')
+            if (value > Int.MAX_VALUE) return null
+            digits++
+            i++
+        }
+        if (digits == 0) return null
+        if (quoted && (i >= json.length || json[i] != '"')) return null
+        return (if (negative) -value else value).toInt()
+    }
+
+    fun hasMember(json: String, key: String): Boolean = topLevelValueStart(json, key) >= 0
+
+    // Index of the first character of the value of top-level member [key], or -1
+    private fun topLevelValueStart(json: String, key: String): Int {
+        val n = json.length
+        var depth = 0
+        var expectKey = false
+        var i = 0
+        while (i < n) {
+            when (json[i]) {
+                '{' -> {
+                    depth++
+                    expectKey = depth == 1
+                }
+                '[' -> depth++
+                '}', ']' -> depth--
+                ',' -> if (depth == 1) expectKey = true
+                '"' -> {
+                    val end = stringEnd(json, i)
+                    if (depth == 1 && expectKey) {
+                        expectKey = false
+                        if (end - i - 1 == key.length && json.regionMatches(i + 1, key, 0, key.length)) {
+                            var j = end + 1
+                            while (j < n && json[j].isWhitespace()) j++
+                            if (j < n && json[j] == ':') {
+                                j++
+                                while (j < n && json[j].isWhitespace()) j++
+                                return if (j < n) j else -1
+                            }
+                        }
+                    }
+                    i = end
+                }
+            }
+            i++
+        }
+        return -1
+    }
+
+    private fun stringEnd(json: String, openQuote: Int): Int {
+        var i = openQuote + 1
+        while (i < json.length) {
+            when (json[i]) {
+                '\\' -> i++
+                '"' -> return i
+            }
+            i++
+        }
+        return json.length - 1
+    }
+}
+
+
+
+
+// ScreenPrefetcher.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.CompletableDeferred
+import kotlinx.coroutines.CoroutineScope
+import kotlinx.coroutines.Deferred
+import kotlinx.coroutines.async
+import kotlinx.coroutines.withTimeoutOrNull
+import org.json.JSONObject
+
+// Screen reads started right after one step's actions. Their responses are attached to that
+// step's results and answer the same reads if the model asks before the screen changes again.
+class ScreenPrefetch(val step: Int, private val reads: Map<String, Deferred<String?>>) {
+
+    val tools: Set<String>
+        get() = reads.keys
+
+    // The prefetched response for [toolName]; null if it was not prefetched or the read failed
+    suspend fun take(toolName: String): String? = reads[toolName]?.await()
+
+    // Whatever has arrived within [timeoutMs], in prefetch order
+    suspend fun collect(timeoutMs: Long): Map<String, String> {
+        val arrived = LinkedHashMap<String, String>()
+        withTimeoutOrNull(timeoutMs) {
+            for ((tool, read) in reads) {
+                read.await()?.let { arrived[tool] = it }
+            }
+        }
+        return arrived
+    }
+
+    fun cancel() {
+        reads.values.forEach { it.cancel() }
+    }
+}
+
+// Starts the reads the model most often asks for right after an action, in parallel with each
+// other and with putting the step results together. When the settle wait already sampled the
+// element listing, that listing is reused instead of being fetched again.
+class ScreenPrefetcher(
+    private val tracer: Tracer,
+    private val tools: List<String> = listOf("mobile_list_elements_on_screen", "mobile_get_orientation"),
+    val attachTimeoutMs: Long = 2_000L,
+    private val readTimeoutMs: Long = 5_000L
+) {
+
+    fun start(scope: CoroutineScope, session: McpSession, step: Int, isAvailable: (String) -> Boolean): ScreenPrefetch? {
+        val reads = LinkedHashMap<String, Deferred<String?>>()
+        for (tool in tools) {
+            if (!isAvailable(tool)) continue
+            val settled = if (tool == "mobile_list_elements_on_screen") session.lastSettledListing else null
+            reads[tool] = if (settled != null) {
+                CompletableDeferred(settled)
+            } else {
+                scope.async { read(session, tool, step) }
+            }
+        }
+        return if (reads.isEmpty()) null else ScreenPrefetch(step, reads)
+    }
+
+    // A slow read is cancelled here rather than timed out by the transport, whose timeout path
+    // restarts the connection under every other request in flight
+    private suspend fun read(session: McpSession, tool: String, step: Int): String? {
+        return try {
+            tracer.span("screen.prefetch") { span ->
+                span.set("step", step).set("tool", tool)
+                val response = withTimeoutOrNull(readTimeoutMs) { session.callTool(tool, JSONObject()) }
+                if (response == null) {
+                    span.set("timedOut", true)
+                    Log.d("ScreenPrefetcher", "Prefetch of $tool took over ${readTimeoutMs}ms, dropped")
+                }
+                response
+            }
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.d("ScreenPrefetcher", "Prefetch of $tool failed: ${e.message}")
+            null
+        }
+    }
+}
+
+
+
+
+// ScreenshotObserver.kt
+
+package com.example.mcpapp
+
+import android.graphics.Bitmap
+import android.graphics.BitmapFactory
+import android.graphics.Color
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.channels.Channel
+import kotlinx.coroutines.withContext
+import org.json.JSONObject
+import java.io.ByteArrayOutputStream
+import java.io.IOException
+import java.util.Base64
+import kotlin.math.roundToInt
+
+// A screenshot re-encoded for the model. hash is a 64-bit difference hash of the screen, so
+// screens that differ only in a clock or a blinking cursor hash a few bits apart.
+class Screenshot(val jpeg: ByteArray, val width: Int, val height: Int, val hash: Long) {
+
+    fun looksLike(other: Screenshot, maxDistance: Int): Boolean {
+        return java.lang.Long.bitCount(hash xor other.hash) <= maxDistance
+    }
+}
+
+// Decodes mobile_take_screenshot images, downscales them to [maxDimension] and re-encodes them
+// as JPEG within [byteBudget]. Runs on Dispatchers.Default with at most [poolSize] encodes at a
+// time, each reusing its own decode buffer, bitmap and output stream. Byte-identical captures
+// are answered from a small cache without decoding.
+class ScreenshotEncoder(
+    val byteBudget: Int = 100 * 1024,
+    private val maxDimension: Int = 768,
+    poolSize: Int = 2,
+    private val cacheEntries: Int = 16
+) {
+
+    companion object {
+        private val QUALITIES = intArrayOf(80, 65, 50, 35)
+        private const val MAX_DOWNSCALES = 3
+    }
+
+    private class Buffers {
+        var raw = ByteArray(256 * 1024)
+        val jpeg = ByteArrayOutputStream(128 * 1024)
+        // Reused through inBitmap; decodes into it whenever the screen fits
+        var bitmap: Bitmap? = null
+    }
+
+    private val pool = Channel<Buffers>(poolSize).apply { repeat(poolSize) { trySend(Buffers()) } }
+
+    private val cache = object : LinkedHashMap<String, Screenshot>(cacheEntries, 0.75f, true) {
+        override fun removeEldestEntry(eldest: MutableMap.MutableEntry<String, Screenshot>): Boolean {
+            return size > cacheEntries
+        }
+    }
+
+    suspend fun encode(base64: String): Screenshot {
+        val src = base64.toByteArray(Charsets.ISO_8859_1)
+        val key = sha1Hex(src, 16)
+        synchronized(cache) { cache[key] }?.let { return it }
+
+        val buffers = pool.receive()
+        try {
+            val screenshot = withContext(Dispatchers.Default) { encodeWith(buffers, src) }
+            synchronized(cache) { cache[key] = screenshot }
+            return screenshot
+        } finally {
+            pool.trySend(buffers)
+        }
+    }
+
+    private fun encodeWith(buffers: Buffers, src: ByteArray): Screenshot {
+        val needed = src.size / 4 * 3 + 3
+        if (buffers.raw.size < needed) buffers.raw = ByteArray(needed)
+        val length = Base64.getMimeDecoder().decode(src, buffers.raw)
+
+        val bounds = BitmapFactory.Options().apply { inJustDecodeBounds = true }
+        BitmapFactory.decodeByteArray(buffers.raw, 0, length, bounds)
+        if (bounds.outWidth <= 0 || bounds.outHeight <= 0) throw IOException("Screenshot is not a decodable image")
+
+        val scale = minOf(1.0, maxDimension.toDouble() / maxOf(bounds.outWidth, bounds.outHeight))
+        var width = maxOf(1, (bounds.outWidth * scale).roundToInt())
+        var height = maxOf(1, (bounds.outHeight * scale).roundToInt())
+        var sampleSize = 1
+        while (bounds.outWidth / (sampleSize * 2) >= width && bounds.outHeight / (sampleSize * 2) >= height) sampleSize *= 2
+
+        val decoded = decode(buffers, length, sampleSize)
+        val hash = differenceHash(decoded)
+
+        var scaled = Bitmap.createScaledBitmap(decoded, width, height, true)
+        try {
+            for (attempt in 0..MAX_DOWNSCALES) {
+                for (quality in QUALITIES) {
+                    buffers.jpeg.reset()
+                    scaled.compress(Bitmap.CompressFormat.JPEG, quality, buffers.jpeg)
+                    if (buffers.jpeg.size() <= byteBudget) return Screenshot(buffers.jpeg.toByteArray(), width, height, hash)
+                }
+                if (attempt == MAX_DOWNSCALES) break
+                width = maxOf(1, width * 3 / 4)
+                height = maxOf(1, height * 3 / 4)
+                val smaller = Bitmap.createScaledBitmap(scaled, width, height, true)
+                if (scaled !== decoded) scaled.recycle()
+                scaled = smaller
+            }
+            // Still over budget at the smallest size and quality; send it anyway
+            return Screenshot(buffers.jpeg.toByteArray(), width, height, hash)
+        } finally {
+            if (scaled !== decoded) scaled.recycle()
+        }
+    }
+
+    private fun decode(buffers: Buffers, length: Int, sampleSize: Int): Bitmap {
+        val options = BitmapFactory.Options().apply {
+            inSampleSize = sampleSize
+            inMutable = true
+            inBitmap = buffers.bitmap
+        }
+        val bitmap = try {
+            BitmapFactory.decodeByteArray(buffers.raw, 0, length, options)
+        } catch (e: IllegalArgumentException) {
+            // The pooled bitmap is too small for this screen
+            options.inBitmap = null
+            BitmapFactory.decodeByteArray(buffers.raw, 0, length, options)
+        } ?: throw IOException("Screenshot could not be decoded")
+        buffers.bitmap = bitmap
+        return bitmap
+    }
+
+    // One bit per pair of horizontally adjacent cells of a 9x8 grayscale thumbnail
+    private fun differenceHash(bitmap: Bitmap): Long {
+        val thumbnail = Bitmap.createScaledBitmap(bitmap, 9, 8, true)
+        val pixels = IntArray(9 * 8)
+        thumbnail.getPixels(pixels, 0, 9, 0, 0, 9, 8)
+        if (thumbnail !== bitmap) thumbnail.recycle()
+
+        var hash = 0L
+        for (y in 0 until 8) {
+            for (x in 0 until 8) {
+                if (luma(pixels[y * 9 + x]) > luma(pixels[y * 9 + x + 1])) hash = hash or (1L shl (y * 8 + x))
+            }
+        }
+        return hash
+    }
+
+    private fun luma(pixel: Int): Int {
+        return (Color.red(pixel) * 299 + Color.green(pixel) * 587 + Color.blue(pixel) * 114) / 1000
+    }
+}
+
+// The visual half of observation. A screenshot reaches the model when the model asks for one,
+// and next to a full element listing that is empty (nothing accessible on screen) or larger
+// than the image. Diffed and prefetched listings never trigger a capture. A screenshot that
+// looks like the last one the job queued is not sent again; the model is told which step's
+// screenshot still applies.
+class ScreenshotObserver(
+    private val tracer: Tracer,
+    private val encoder: ScreenshotEncoder = ScreenshotEncoder(),
+    private val maxHashDistance: Int = 6
+) {
+
+    companion object {
+        const val TOOL = "mobile_take_screenshot"
+    }
+
+    // For a listing rendered in full: [listing] with the screenshot note appended, or null when
+    // the listing is kept alone. The listing always stays, since it carries the coordinates the
+    // model acts on; the image only joins it when the listing is empty or outweighs any image
+    // the encoder produces.
+    suspend fun afterListing(session: McpSession, state: QueryJobState, listing: String, snapshot: ScreenSnapshot): String? {
+        if (snapshot.elements.isNotEmpty() && snapshot.fullBytes <= encoder.byteBudget) return null
+
+        val note = try {
+            attach(state, session.callTool(TOOL))
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.w("ScreenshotObserver", "Screenshot for step ${state.iteration} failed: ${e.message}")
+            null
+        } ?: return null
+        return "$listing\n$note"
+    }
+
+    // Queues the image of a mobile_take_screenshot response for the model and returns the text
+    // that stands in for it in the step history; null if the response carries no image
+    suspend fun attach(state: QueryJobState, response: String): String? {
+        val data = imageData(response) ?: return null
+        val screenshot = tracer.span("screenshot.encode") { span ->
+            encoder.encode(data).also { span.set("width", it.width).set("height", it.height).set("bytes", it.jpeg.size) }
+        }
+
+        val previous = state.screenshot
+        if (previous != null && screenshot.looksLike(previous, maxHashDistance)) {
+            return "Screenshot: the screen looks as in the screenshot from step ${state.screenshotStep}"
+        }
+        state.screenshot = screenshot
+        state.screenshotStep = state.iteration
+        return "Screenshot: attached (${screenshot.width}x${screenshot.height}, ${screenshot.jpeg.size / 1024} KB)"
+    }
+
+    private fun imageData(response: String): String? {
+        return try {
+            val content = JSONObject(response).optJSONObject("result")?.optJSONArray("content") ?: return null
+            (0 until content.length())
+                .mapNotNull { content.optJSONObject(it) }
+                .firstOrNull { it.optString("type") == "image" }
+                ?.optString("data")
+                ?.takeIf { it.isNotEmpty() }
+        } catch (e: Exception) {
+            null
+        }
+    }
+}
+
+
+
+
+// UiSettleDetector.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.withTimeoutOrNull
+
+// How long to let the UI settle after a tool: wait initialDelayMs, then sample the screen every
+// pollIntervalMs until two consecutive fingerprints match or maxWaitMs has passed
+data class SettlePolicy(
+    val initialDelayMs: Long,
+    val pollIntervalMs: Long,
+    val maxWaitMs: Long
+) {
+    companion object {
+        val NONE = SettlePolicy(0, 0, 0)
+    }
+}
+
+class UiSettleDetector(
+    private val fingerprint: suspend () -> String,
+    private val policies: Map<String, SettlePolicy> = DEFAULT_POLICIES,
+    private val defaultPolicy: SettlePolicy = SettlePolicy(150, 250, 2_000)
+) {
+
+    companion object {
+        val DEFAULT_POLICIES = mapOf(
+            "mobile_click_on_screen_at_coordinates" to SettlePolicy(100, 200, 1_500),
+            "mobile_type_keys" to SettlePolicy(100, 200, 1_000),
+            "swipe_on_screen" to SettlePolicy(200, 250, 2_000),
+            "mobile_press_button" to SettlePolicy(150, 250, 2_000),
+            "mobile_terminate_app" to SettlePolicy(200, 250, 1_500),
+            "mobile_set_orientation" to SettlePolicy(300, 300, 3_000),
+            "mobile_open_url" to SettlePolicy(500, 400, 5_000),
+            "mobile_launch_app" to SettlePolicy(500, 400, 6_000),
+            "mobile_use_device" to SettlePolicy.NONE,
+            "mobile_use_default_device" to SettlePolicy.NONE,
+            "mobile_take_screenshot" to SettlePolicy.NONE,
+            "mobile_save_screenshot" to SettlePolicy.NONE
+        )
+    }
+
+    fun policyFor(toolName: String): SettlePolicy {
+        policies[toolName]?.let { return it }
+        // Reads never change the screen
+        if (toolName.startsWith("mobile_get_") || toolName.startsWith("mobile_list_")) {
+            return SettlePolicy.NONE
+        }
+        return defaultPolicy
+    }
+
+    // Last fingerprint sampled by the most recent awaitSettled(); null if that call sampled nothing
+    @Volatile
+    var lastFingerprint: String? = null
+        private set
+
+    // Returns how long we waited
+    suspend fun awaitSettled(toolName: String): Long {
+        lastFingerprint = null
+        val policy = policyFor(toolName)
+        if (policy.maxWaitMs <= 0) return 0
+
+        val start = System.currentTimeMillis()
+        val deadline = start + policy.maxWaitMs
+        delay(policy.initialDelayMs)
+
+        var previous = sample(deadline) ?: return System.currentTimeMillis() - start
+        while (System.currentTimeMillis() + policy.pollIntervalMs < deadline) {
+            delay(policy.pollIntervalMs)
+            val current = sample(deadline) ?: break
+            if (current == previous) break
+            previous = current
+        }
+        return System.currentTimeMillis() - start
+    }
+
+    // A sample may not outlive the policy's deadline; a failed sample ends the wait early
+    private suspend fun sample(deadline: Long): String? {
+        val remaining = deadline - System.currentTimeMillis()
+        if (remaining <= 0) return null
+        return try {
+            withTimeoutOrNull(remaining) { fingerprint() }?.also { lastFingerprint = it }
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.e("UiSettleDetector", "Screen fingerprint failed: ${e.message}")
+            null
+        }
+    }
+}
+
+
+
+
+// PlanCache.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.File
+
+// One model turn of a successful run: the calls it made and, for turns that change the screen,
+// the signature (ScreenStateStore.signature) of the settled screen afterwards
+class PlanStep(val calls: JSONArray, val screenAfter: String?) {
+
+    fun toJson(): JSONObject = JSONObject().apply {
+        put("calls", calls)
+        screenAfter?.let { put("screen", it) }
+    }
+
+    // Fresh objects every time: dispatching a call stamps a request id into it
+    fun callObjects(): List<JSONObject> {
+        val copy = JSONArray(calls.toString())
+        return (0 until copy.length()).mapNotNull { copy.optJSONObject(it) }
+    }
+
+    companion object {
+        fun fromJson(json: JSONObject) = PlanStep(
+            json.getJSONArray("calls"),
+            json.optString("screen").ifEmpty { null }
+        )
+    }
+}
+
+class Plan(
+    val key: String,
+    val query: String,
+    val steps: List<PlanStep>,
+    val createdAt: Long
+) {
+    fun toJson(): JSONObject = JSONObject().apply {
+        put("key", key)
+        put("query", query)
+        put("createdAt", createdAt)
+        put("steps", JSONArray().apply { steps.forEach { put(it.toJson()) } })
+    }
+
+    companion object {
+        fun fromJson(json: JSONObject): Plan {
+            val steps = json.getJSONArray("steps")
+            return Plan(
+                json.getString("key"),
+                json.optString("query"),
+                (0 until steps.length()).map { PlanStep.fromJson(steps.getJSONObject(it)) },
+                json.getLong("createdAt")
+            )
+        }
+    }
+}
+
+// Tool-call sequences of successful runs, keyed by normalized query plus the signature of the
+// screen the run started on. LRU-bounded with a TTL, kept in memory and mirrored to one JSON file
+// that is rewritten (tmp file + rename) whenever a plan is added or dropped.
+class PlanCache(
+    private val directory: File,
+    private val maxEntries: Int = 64,
+    private val ttlMs: Long = 7 * 24 * 60 * 60_000L
+) {
+
+    private val plans = object : LinkedHashMap<String, Plan>(16, 0.75f, true) {
+        override fun removeEldestEntry(eldest: MutableMap.MutableEntry<String, Plan>): Boolean = size > maxEntries
+    }
+    private var loaded = false
+
+    val size: Int
+        get() = synchronized(plans) {
+            load()
+            plans.size
+        }
+
+    fun keyFor(query: String, startScreen: String): String {
+        return sha1Hex("${normalize(query)}|$startScreen".toByteArray(Charsets.UTF_8), 24)
+    }
+
+    fun get(key: String): Plan? = synchronized(plans) {
+        load()
+        val plan = plans[key] ?: return null
+        if (System.currentTimeMillis() - plan.createdAt > ttlMs) {
+            plans.remove(key)
+            save()
+            return null
+        }
+        plan
+    }
+
+    fun put(plan: Plan) = synchronized(plans) {
+        load()
+        plans[plan.key] = plan
+        save()
+    }
+
+    fun invalidate(key: String) = synchronized(plans) {
+        load()
+        if (plans.remove(key) != null) save()
+    }
+
+    fun clear() = synchronized(plans) {
+        plans.clear()
+        loaded = true
+        file().delete()
+    }
+
+    private fun load() {
+        if (loaded) return
+        loaded = true
+        val file = file()
+        if (!file.exists()) return
+        try {
+            val root = JSONObject(file.readText())
+            // Plans of another version were keyed by a different screen signature and never match
+            if (root.optInt("version") != VERSION) {
+                file.delete()
+                return
+            }
+            val stored = root.getJSONArray("plans")
+            val now = System.currentTimeMillis()
+            for (i in 0 until stored.length()) {
+                val plan = Plan.fromJson(stored.getJSONObject(i))
+                if (now - plan.createdAt <= ttlMs) plans[plan.key] = plan
+            }
+        } catch (e: Exception) {
+            Log.e("PlanCache", "Dropping unreadable plan cache: ${e.message}")
+            file.delete()
+        }
+    }
+
+    // Least recently used first, so a reload restores the LRU order
+    private fun save() {
+        val json = JSONObject().apply {
+            put("version", VERSION)
+            put("plans", JSONArray().apply { plans.values.forEach { put(it.toJson()) } })
+        }
+        try {
+            directory.mkdirs()
+            val file = file()
+            val tmp = File(file.path + ".tmp")
+            tmp.writeText(json.toString())
+            tmp.renameTo(file)
+        } catch (e: Exception) {
+            Log.e("PlanCache", "Failed to persist plan cache: ${e.message}")
+        }
+    }
+
+    private fun file() = File(directory, "plans.json")
+
+    companion object {
+        private const val VERSION = 2
+        private val NON_WORD = Regex("[^\\p{L}\\p{N}]+")
+
+        // "Open Settings,  and enable Wi-Fi!" and "open settings and enable wi fi" share a plan
+        fun normalize(query: String): String {
+            return query.lowercase().replace(NON_WORD, " ").trim()
+        }
+    }
+}
+
+
+
+
+// IntentResolver.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import org.json.JSONObject
+import java.util.concurrent.ConcurrentHashMap
+
+class InstalledApp(val name: String, val packageName: String)
+
+// Installed apps of one device, from mobile_list_apps, with fuzzy lookup by name
+class AppIndex(val apps: List<InstalledApp>, val fetchedAt: Long = System.currentTimeMillis()) {
+
+    class Match(val app: InstalledApp, val score: Double)
+
+    // Best match first; scores are 0..1
+    fun search(query: String, limit: Int = 2): List<Match> {
+        val wanted = normalizeName(query)
+        if (wanted.isEmpty()) return emptyList()
+        return apps.asSequence()
+            .map { Match(it, score(wanted, it)) }
+            .filter { it.score > 0.0 }
+            .sortedByDescending { it.score }
+            .take(limit)
+            .toList()
+    }
+
+    private fun score(wanted: String, app: InstalledApp): Double {
+        val name = normalizeName(app.name)
+        val packageTail = app.packageName.substringAfterLast('.').lowercase()
+        return when {
+            name == wanted -> 1.0
+            packageTail == wanted.replace(" ", "") -> 0.95
+            name.replace(" ", "") == wanted.replace(" ", "") -> 0.95
+            name.startsWith("$wanted ") || name.split(' ').containsAll(wanted.split(' ')) -> 0.85
+            else -> {
+                val distance = editDistance(name, wanted)
+                1.0 - distance.toDouble() / maxOf(name.length, wanted.length)
+            }
+        }
+    }
+
+    companion object {
+        private val NON_WORD = Regex("[^\\p{L}\\p{N}]+")
+        // "Found these apps on device: Settings (com.android.settings), YouTube (com.google.android.youtube)"
+        private val APP_ENTRY = Regex("""([^,:\n()]+?)\s*\(([A-Za-z][\w]*(?:\.[\w]+)+)\)""")
+
+        fun fromListAppsResponse(response: String): AppIndex {
+            val text = JSONObject(response).optJSONObject("result")
+                ?.optJSONArray("content")?.optJSONObject(0)?.optString("text")
+                ?: throw IllegalArgumentException("mobile_list_apps response has no text: ${response.take(200)}")
+            val apps = APP_ENTRY.findAll(text)
+                .map { InstalledApp(it.groupValues[1].trim(), it.groupValues[2]) }
+                .distinctBy { it.packageName }
+                .toList()
+            return AppIndex(apps)
+        }
+
+        fun normalizeName(name: String): String {
+            return name.lowercase().replace(NON_WORD, " ").trim()
+        }
+    }
+}
+
+// App indexes per device, fetched on first use and again once they are older than [maxAgeMs]
+class AppIndexCache(private val maxAgeMs: Long = 10 * 60_000L) {
+
+    private val indexes = ConcurrentHashMap<String, AppIndex>()
+
+    suspend fun get(session: McpSession, forceRefresh: Boolean = false): AppIndex {
+        val cached = indexes[session.deviceId]
+        if (!forceRefresh && cached != null && System.currentTimeMillis() - cached.fetchedAt < maxAgeMs) {
+            return cached
+        }
+        return AppIndex.fromListAppsResponse(session.callTool("mobile_list_apps")).also {
+            indexes[session.deviceId] = it
+            Log.d("IntentResolver", "Indexed ${it.apps.size} apps on ${session.deviceId}")
+        }
+    }
+
+    fun invalidate(deviceId: String) {
+        indexes.remove(deviceId)
+    }
+}
+
+// A query answered without the model: the calls to run and how sure we are
+class ResolvedIntent(val calls: List<JSONObject>, val confidence: Double, val description: String)
+
+// Answers single, unambiguous intents ("open YouTube", "go home", "open example.com") locally.
+// Anything compound, vague or below [minConfidence] returns null and goes to the model.
+class IntentResolver(
+    private val appIndexCache: AppIndexCache,
+    private val minConfidence: Double = 0.8,
+    private val ambiguityMargin: Double = 0.05
+) {
+
+    companion object {
+        private val FILLER = Regex("""^(please\s+|can you\s+|could you\s+|would you\s+)+|\s+(please|for me|now)$""")
+        private val COMPOUND = Regex("""\b(and|then|after|before|while|search|type|find|send|call|click)\b|[,;]""")
+        // Only buttons mobile_press_button documents; anything else is left to the model
+        private val BUTTONS = mapOf(
+            "home" to "HOME",
+            "back" to "BACK"
+        )
+        private val PRESS = Regex("""^(go|press|tap|hit)?\s*(the\s+)?(home|back)(\s+(button|screen|key))?$""")
+        private val GO_BACK = Regex("""^go\s+back$""")
+        private val OPEN = Regex("""^(open|launch|start|run|go to|show)\s+(the\s+)?(.+?)(\s+(app|application))?$""")
+        private val URL = Regex("""^(https?://\S+|(www\.)?[a-z0-9-]+(\.[a-z0-9-]+)*\.[a-z]{2,}(/\S*)?)$""")
+    }
+
+    suspend fun resolve(session: McpSession, query: String): ResolvedIntent? {
+        val text = query.trim().lowercase().trimEnd('.', '!', '?').replace(FILLER, "").trim()
+        if (text.isEmpty() || COMPOUND.containsMatchIn(text)) return null
+
+        if (GO_BACK.matches(text)) return press("BACK")
+        PRESS.matchEntire(text)?.let { match ->
+            return BUTTONS[match.groupValues[3]]?.let { press(it) }
+        }
+
+        val target = OPEN.matchEntire(text)?.groupValues?.get(3)?.trim() ?: return null
+        if (URL.matches(target)) {
+            val url = if (target.startsWith("http")) target else "https://$target"
+            return ResolvedIntent(listOf(call("mobile_open_url", JSONObject().put("url", url))), 0.9, "open $url")
+        }
+        return launch(session, target)
+    }
+
+    private suspend fun launch(session: McpSession, target: String): ResolvedIntent? {
+        var index = appIndexCache.get(session)
+        var matches = index.search(target)
+        // A miss on an older index may be an app installed since; look once more
+        if ((matches.firstOrNull()?.score ?: 0.0) < minConfidence && System.currentTimeMillis() - index.fetchedAt > 60_000L) {
+            index = appIndexCache.get(session, forceRefresh = true)
+            matches = index.search(target)
+        }
+
+        val best = matches.firstOrNull() ?: return null
+        val runnerUp = matches.getOrNull(1)
+        if (best.score < minConfidence) return null
+        if (runnerUp != null && best.score - runnerUp.score < ambiguityMargin) {
+            Log.d("IntentResolver", "\"$target\" is ambiguous: ${best.app.name} vs ${runnerUp.app.name}")
+            return null
+        }
+        return ResolvedIntent(
+            listOf(call("mobile_launch_app", JSONObject().put("packageName", best.app.packageName))),
+            best.score,
+            "launch ${best.app.name} (${best.app.packageName})"
+        )
+    }
+
+    private fun press(button: String): ResolvedIntent {
+        return ResolvedIntent(listOf(call("mobile_press_button", JSONObject().put("button", button))), 1.0, "press $button")
+    }
+
+    private fun call(tool: String, arguments: JSONObject): JSONObject {
+        return JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("id", 1)
+            put("method", "tools/call")
+            put("params", JSONObject().apply {
+                put("name", tool)
+                put("arguments", arguments)
+            })
+        }
+    }
+}
+
+
+
+
+// ToolCallValidator.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+
+// The call to dispatch, possibly normalized (fixes says how), or why it cannot be dispatched
+class CallValidation(
+    val call: JSONObject?,
+    val fixes: List<String>,
+    val error: String?
+)
+
+// Checks model-written tool calls against the tools/list input schemas before they are sent.
+// Obvious slips (tool-name case or prefix, "5" for a number, "UP" for "up", snake_case keys)
+// are fixed locally; anything else is rejected with a short message for the model.
+class ToolCallValidator(private val catalog: ToolCatalog) {
+
+    private val toolsByKey = catalog.tools.associateBy { nameKey(it.name) }
+
+    fun validate(call: JSONObject): CallValidation {
+        val fixes = ArrayList<String>()
+        val params = paramsOf(call, fixes)
+            ?: return CallValidation(null, fixes, "expected {\"method\": \"tools/call\", \"params\": {\"name\": ..., \"arguments\": {...}}}")
+
+        val requestedName = params.optString("name")
+        val tool = resolveTool(requestedName)
+            ?: return CallValidation(null, fixes, "unknown tool \"$requestedName\"${suggestion(requestedName)}")
+        if (tool.name != requestedName) fixes.add("tool \"$requestedName\" -> \"${tool.name}\"")
+
+        val arguments = argumentsOf(params, fixes)
+            ?: return CallValidation(null, fixes, "${tool.name}: arguments must be a JSON object")
+
+        val normalized = JSONObject()
+        for (key in arguments.keys()) {
+            val property = resolveProperty(tool, key)
+            if (property == null) {
+                fixes.add("dropped unknown argument \"$key\"")
+                continue
+            }
+            if (property != key) fixes.add("argument \"$key\" -> \"$property\"")
+            val schema = tool.properties.optJSONObject(property) ?: JSONObject()
+            val value = coerce(arguments.get(key), schema)
+                ?: return CallValidation(null, fixes, "${tool.name}: \"$property\" must be ${expected(schema)}, got ${JSONObject.quote(arguments.get(key).toString())}")
+            if (value != arguments.get(key)) fixes.add("$property ${arguments.get(key)} -> $value")
+            normalized.put(property, value)
+        }
+
+        val missing = tool.required.filter { !normalized.has(it) }
+        if (missing.isNotEmpty()) {
+            val described = missing.joinToString { "\"$it\" (${expected(tool.properties.optJSONObject(it) ?: JSONObject())})" }
+            return CallValidation(null, fixes, "${tool.name}: missing required $described")
+        }
+
+        val fixed = JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("id", call.opt("id") ?: 1)
+            put("method", "tools/call")
+            put("params", JSONObject().apply {
+                put("name", tool.name)
+                put("arguments", normalized)
+            })
+        }
+        return CallValidation(fixed, fixes, null)
+    }
+
+    // Accepts the full envelope or a bare {"name": ..., "arguments": ...}
+    private fun paramsOf(call: JSONObject, fixes: MutableList<String>): JSONObject? {
+        val method = call.optString("method")
+        call.optJSONObject("params")?.let { params ->
+            if (method == "tools/call") return params
+            if (method.isEmpty() && params.has("name")) {
+                fixes.add("added method tools/call")
+                return params
+            }
+            return null
+        }
+        if (method.isEmpty() && call.has("name")) {
+            fixes.add("wrapped bare call in a tools/call envelope")
+            return call
+        }
+        return null
+    }
+
+    private fun argumentsOf(params: JSONObject, fixes: MutableList<String>): JSONObject? {
+        return when (val arguments = params.opt("arguments")) {
+            null, JSONObject.NULL -> JSONObject()
+            is JSONObject -> arguments
+            is String -> try {
+                JSONObject(arguments).also { fixes.add("parsed arguments given as a string") }
+            } catch (e: Exception) {
+                null
+            }
+            else -> null
+        }
+    }
+
+    private fun resolveTool(name: String): ToolSpec? {
+        catalog.get(name)?.let { return it }
+        val key = nameKey(name)
+        return toolsByKey[key] ?: toolsByKey["mobile$key"]
+    }
+
+    private fun resolveProperty(tool: ToolSpec, key: String): String? {
+        if (tool.properties.has(key)) return key
+        val wanted = nameKey(key)
+        return tool.properties.keys().asSequence().firstOrNull { nameKey(it) == wanted }
+    }
+
+    // Null when the value cannot be made to fit the schema
+    private fun coerce(value: Any, schema: JSONObject): Any? {
+        val allowed = schema.optJSONArray("enum")
+        if (allowed != null) {
+            val values = (0 until allowed.length()).map { allowed.opt(it) }
+            if (values.contains(value)) return value
+            val text = value.toString()
+            return values.firstOrNull { it.toString().equals(text, ignoreCase = true) }
+        }
+        return when (schema.optString("type")) {
+            "number" -> when (value) {
+                is Number -> value
+                is String -> value.trim().toDoubleOrNull()?.let { if (it % 1.0 == 0.0) it.toLong() else it }
+                else -> null
+            }
+            "integer" -> when (value) {
+                is Int, is Long -> value
+                is Number -> value.toDouble().takeIf { it % 1.0 == 0.0 }?.toLong()
+                is String -> value.trim().toDoubleOrNull()?.takeIf { it % 1.0 == 0.0 }?.toLong()
+                else -> null
+            }
+            "boolean" -> when (value) {
+                is Boolean -> value
+                is String -> value.trim().lowercase().toBooleanStrictOrNull()
+                else -> null
+            }
+            "string" -> when (value) {
+                is String -> value
+                is Number, is Boolean -> value.toString()
+                else -> null
+            }
+            "object" -> value as? JSONObject
+            "array" -> value as? JSONArray
+            else -> value
+        }
+    }
+
+    private fun expected(schema: JSONObject): String {
+        val allowed = schema.optJSONArray("enum")
+        if (allowed != null) {
+            return "one of " + (0 until allowed.length()).joinToString("|") { "\"${allowed.opt(it)}\"" }
+        }
+        return "a ${schema.optString("type", "value")}"
+    }
+
+    private fun suggestion(name: String): String {
+        val key = nameKey(name)
+        val closest = catalog.tools.minByOrNull { editDistance(nameKey(it.name), key) } ?: return ""
+        return if (editDistance(nameKey(closest.name), key) <= 3) ", did you mean \"${closest.name}\"?" else ""
+    }
+
+    private fun nameKey(name: String): String = name.lowercase().filter { it.isLetterOrDigit() }
+}
+
+
+
+
+// ToolCatalog.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.File
+
+class ToolSpec(
+    val name: String,
+    val description: String,
+    val inputSchema: JSONObject
+) {
+    val properties: JSONObject = inputSchema.optJSONObject("properties") ?: JSONObject()
+
+    val required: Set<String> = inputSchema.optJSONArray("required").let { array ->
+        if (array == null) emptySet() else (0 until array.length()).map { array.optString(it) }.toSet()
+    }
+
+    // e.g. swipe_on_screen(direction: "up"|"down"|"left"|"right", x?: number, y?: number, distance?: number)
+    fun signature(): String {
+        val params = properties.keys().asSequence().map { key ->
+            val schema = properties.optJSONObject(key) ?: JSONObject()
+            val optional = if (key in required) "" else "?"
+            "$key$optional: ${typeOf(schema)}"
+        }
+        return params.joinToString(", ", prefix = "$name(", postfix = ")")
+    }
+
+    // First sentence of the description, which is all the model needs to pick a tool
+    fun purpose(): String {
+        val firstLine = description.lineSequence().firstOrNull { it.isNotBlank() }?.trim() ?: return ""
+        val sentenceEnd = firstLine.indexOf(". ")
+        val sentence = if (sentenceEnd > 0) firstLine.substring(0, sentenceEnd + 1) else firstLine
+        return if (sentence.length <= 120) sentence else sentence.substring(0, 120) + "…"
+    }
+
+    private fun typeOf(schema: JSONObject): String {
+        val values = schema.optJSONArray("enum")
+        if (values != null) {
+            return (0 until values.length()).joinToString("|") { "\"${values.opt(it)}\"" }
+        }
+        return schema.optString("type", "any")
+    }
+}
+
+// The tools/list result for one MCP server, identified by server id plus a hash of the schemas
+class ToolCatalog(
+    val serverId: String,
+    val schemaHash: String,
+    private val toolsJson: JSONArray
+) {
+    val tools: List<ToolSpec> = (0 until toolsJson.length()).mapNotNull { index ->
+        toolsJson.optJSONObject(index)?.let {
+            ToolSpec(it.optString("name"), it.optString("description"), it.optJSONObject("inputSchema") ?: JSONObject())
+        }
+    }
+
+    private val byName = tools.associateBy { it.name }
+
+    fun get(name: String): ToolSpec? = byName[name]
+
+    // Compact rendering for prompts: one line per tool instead of the full JSON schema
+    val promptText: String by lazy {
+        tools.joinToString("\n") { "- ${it.signature()}: ${it.purpose()}" }
+    }
+
+    val validator: ToolCallValidator by lazy { ToolCallValidator(this) }
+
+    fun toJson(): JSONObject = JSONObject().apply {
+        put("serverId", serverId)
+        put("schemaHash", schemaHash)
+        put("tools", toolsJson)
+    }
+
+    companion object {
+        fun fromToolsListResponse(serverId: String, response: String): ToolCatalog {
+            val tools = JSONObject(response).optJSONObject("result")?.optJSONArray("tools")
+                ?: throw IllegalArgumentException("tools/list response has no tools: ${response.take(200)}")
+            return ToolCatalog(serverId, sha1Hex(tools.toString().toByteArray(Charsets.UTF_8), 16), tools)
+        }
+
+        fun fromJson(json: JSONObject): ToolCatalog {
+            return ToolCatalog(json.getString("serverId"), json.getString("schemaHash"), json.getJSONArray("tools"))
+        }
+    }
+}
+
+// Keeps the catalog in memory across queries and on disk across service restarts
+class ToolCatalogCache(private val directory: File) {
+
+    @Volatile
+    private var memory: ToolCatalog? = null
+
+    fun get(serverId: String): ToolCatalog? {
+        memory?.let { if (it.serverId == serverId) return it }
+
+        val file = fileFor(serverId)
+        if (!file.exists()) return null
+        return try {
+            ToolCatalog.fromJson(JSONObject(file.readText())).takeIf { it.serverId == serverId }?.also { memory = it }
+        } catch (e: Exception) {
+            file.delete()
+            null
+        }
+    }
+
+    // Returns true when the stored schemas changed (or nothing was stored yet)
+    fun put(catalog: ToolCatalog): Boolean {
+        val previous = get(catalog.serverId)
+        memory = catalog
+        if (previous?.schemaHash == catalog.schemaHash) return false
+
+        directory.mkdirs()
+        val file = fileFor(catalog.serverId)
+        val tmp = File(file.path + ".tmp")
+        tmp.writeText(catalog.toJson().toString())
+        tmp.renameTo(file)
+        return true
+    }
+
+    fun invalidate(serverId: String) {
+        if (memory?.serverId == serverId) memory = null
+        fileFor(serverId).delete()
+    }
+
+    private fun fileFor(serverId: String): File {
+        return File(directory, "tool_catalog_${sha1Hex(serverId.toByteArray(Charsets.UTF_8), 12)}.json")
+    }
+}
+
+
+
+
+// Tracer.kt
+
+package com.example.mcpapp
+
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicLong
+import java.util.concurrent.atomic.AtomicLongArray
+
+// Receives finished spans; implementations must not block the caller
+interface TraceSink {
+    fun write(span: TraceSpan)
+    fun close()
+}
+
+// A finished span; times are microseconds since the tracer was created
+class TraceSpan(
+    val name: String,
+    val startUs: Long,
+    val durationUs: Long,
+    val threadId: Long,
+    val attributes: Map<String, Any?>
+)
+
+// Attributes collected while a span is open. When tracing is off callers get NOOP, which
+// drops everything, so instrumented code needs no branches of its own.
+class Span @PublishedApi internal constructor(
+    val name: String,
+    @PublishedApi internal val startNanos: Long
+) {
+    @PublishedApi
+    internal var attributes: HashMap<String, Any?>? = null
+
+    fun set(key: String, value: Any?): Span {
+        if (this === NOOP) return this
+        val map = attributes ?: HashMap<String, Any?>(8).also { attributes = it }
+        map[key] = value
+        return this
+    }
+
+    companion object {
+        val NOOP = Span("", 0L)
+    }
+}
+
+data class LatencySummary(
+    val count: Long,
+    val p50Ms: Double,
+    val p90Ms: Double,
+    val p99Ms: Double,
+    val maxMs: Double
+)
+
+// Lock-free log-linear histogram: 8 buckets per power of two of microseconds, so any
+// percentile is within ~6% of the true value at a fixed 4 KB per histogram
+class LatencyHistogram {
+
+    companion object {
+        private const val SUB_BUCKET_BITS = 3
+        private const val SUB_BUCKETS = 1 shl SUB_BUCKET_BITS
+        private const val BUCKET_COUNT = SUB_BUCKETS * 62
+
+        private fun indexOf(valueUs: Long): Int {
+            if (valueUs < SUB_BUCKETS) return valueUs.toInt()
+            val exponent = 63 - java.lang.Long.numberOfLeadingZeros(valueUs)
+            val mantissa = (valueUs ushr (exponent - SUB_BUCKET_BITS)).toInt()
+            return (exponent - SUB_BUCKET_BITS) * SUB_BUCKETS + mantissa
+        }
+
+        // Midpoint of the bucket, in microseconds
+        private fun valueOf(index: Int): Double {
+            if (index < SUB_BUCKETS) return index.toDouble()
+            val shift = index / SUB_BUCKETS - 1
+            val mantissa = (index % SUB_BUCKETS + SUB_BUCKETS).toLong()
+            return ((mantissa shl shift) + ((mantissa + 1) shl shift)) / 2.0
+        }
+    }
+
+    private val counts = AtomicLongArray(BUCKET_COUNT)
+    private val total = AtomicLong()
+    private val max = AtomicLong()
+
+    fun record(valueUs: Long) {
+        val value = valueUs.coerceAtLeast(0L)
+        counts.incrementAndGet(indexOf(value).coerceAtMost(BUCKET_COUNT - 1))
+        total.incrementAndGet()
+        max.accumulateAndGet(value) { a, b -> maxOf(a, b) }
+    }
+
+    fun summary(): LatencySummary {
+        val snapshot = LongArray(BUCKET_COUNT) { counts.get(it) }
+        val count = snapshot.sum()
+        return LatencySummary(
+            count = count,
+            p50Ms = percentile(snapshot, count, 0.50) / 1000.0,
+            p90Ms = percentile(snapshot, count, 0.90) / 1000.0,
+            p99Ms = percentile(snapshot, count, 0.99) / 1000.0,
+            maxMs = max.get() / 1000.0
+        )
+    }
+
+    fun percentileMs(fraction: Double): Double {
+        val snapshot = LongArray(BUCKET_COUNT) { counts.get(it) }
+        return percentile(snapshot, snapshot.sum(), fraction) / 1000.0
+    }
+
+    private fun percentile(snapshot: LongArray, count: Long, fraction: Double): Double {
+        if (count == 0L) return 0.0
+        val rank = Math.ceil(count * fraction).toLong().coerceAtLeast(1L)
+        var seen = 0L
+        for (i in snapshot.indices) {
+            seen += snapshot[i]
+            if (seen >= rank) return minOf(valueOf(i), max.get().toDouble())
+        }
+        return max.get().toDouble()
+    }
+}
+
+// Spans around the phases of a task, aggregated into per-name histograms and optionally
+// streamed to a [TraceSink]. Off by default; a disabled span costs one volatile read.
+class Tracer {
+
+    @Volatile
+    var enabled = false
+
+    @Volatile
+    var sink: TraceSink? = null
+
+    private val originNanos = System.nanoTime()
+    private val histograms = ConcurrentHashMap<String, LatencyHistogram>()
+
+    inline fun <T> span(name: String, block: (Span) -> T): T {
+        if (!enabled) return block(Span.NOOP)
+        val span = Span(name, System.nanoTime())
+        try {
+            return block(span)
+        } catch (e: Throwable) {
+            span.set("error", e.javaClass.simpleName)
+            throw e
+        } finally {
+            end(span)
+        }
+    }
+
+    // For phases that start and end in different places, e.g. on another thread
+    fun record(name: String, startNanos: Long, attributes: Map<String, Any?> = emptyMap()) {
+        if (!enabled) return
+        finish(name, startNanos, System.nanoTime(), attributes)
+    }
+
+    // A zero-length marker such as a reconnect
+    inline fun instant(name: String, attributes: () -> Map<String, Any?> = { emptyMap() }) {
+        if (!enabled) return
+        val now = System.nanoTime()
+        finish(name, now, now, attributes())
+    }
+
+    fun now(): Long = if (enabled) System.nanoTime() else 0L
+
+    fun latencySummaries(): Map<String, LatencySummary> {
+        return histograms.entries
+            .sortedBy { it.key }
+            .associate { it.key to it.value.summary() }
+    }
+
+    fun reset() {
+        histograms.clear()
+    }
+
+    @PublishedApi
+    internal fun end(span: Span) {
+        finish(span.name, span.startNanos, System.nanoTime(), span.attributes ?: emptyMap())
+    }
+
+    @PublishedApi
+    internal fun finish(name: String, startNanos: Long, endNanos: Long, attributes: Map<String, Any?>) {
+        val durationUs = (endNanos - startNanos) / 1000
+        if (endNanos > startNanos) {
+            histograms.getOrPut(name) { LatencyHistogram() }.record(durationUs)
+        }
+        sink?.write(TraceSpan(
+            name,
+            (startNanos - originNanos) / 1000,
+            durationUs,
+            Thread.currentThread().id,
+            attributes
+        ))
+    }
+}
+
+
+
+
+// ChromeTraceWriter.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import org.json.JSONObject
+import java.io.File
+import java.io.FileOutputStream
+import java.io.OutputStreamWriter
+import java.io.Writer
+import java.util.concurrent.LinkedBlockingQueue
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicLong
+
+// Streams spans into rolling Chrome trace files (trace-0.json newest) that load directly in
+// chrome://tracing or Perfetto. Spans are queued and written by one background thread; when
+// the queue is full they are dropped rather than slowing the caller down. Each file is an
+// unterminated JSON array, which the trace viewers accept, so a crash still leaves a file
+// that loads.
+class ChromeTraceWriter(
+    private val directory: File,
+    private val maxFileBytes: Long = 4L * 1024 * 1024,
+    private val maxFiles: Int = 3,
+    queueCapacity: Int = 4096,
+    private val closeTimeoutMs: Long = 2_000L
+) : TraceSink {
+
+    private val queue = LinkedBlockingQueue<TraceSpan>(queueCapacity)
+    private val dropped = AtomicLong()
+    @Volatile
+    private var running = true
+    private var writer: Writer? = null
+    private var fileBytes = 0L
+
+    private val thread = Thread(::drain, "trace-writer").apply {
+        isDaemon = true
+        start()
+    }
+
+    val droppedSpans: Long
+        get() = dropped.get()
+
+    override fun write(span: TraceSpan) {
+        if (!queue.offer(span)) dropped.incrementAndGet()
+    }
+
+    // Returns once the queued spans are written and the file is closed, so that a writer opened
+    // next on the same directory never appends to trace-0.json alongside this one
+    override fun close() {
+        running = false
+        thread.interrupt()
+        thread.join(closeTimeoutMs)
+        if (thread.isAlive) Log.w("Tracer", "Trace writer still draining after ${closeTimeoutMs}ms")
+    }
+
+    private fun drain() {
+        try {
+            while (running) {
+                val span = queue.poll(1, TimeUnit.SECONDS)
+                if (span == null) {
+                    writer?.flush()
+                    continue
+                }
+                append(span)
+                // Flush once the burst is over rather than per span
+                if (queue.isEmpty()) writer?.flush()
+            }
+        } catch (e: InterruptedException) {
+            // close()
+        } catch (e: Exception) {
+            Log.e("Tracer", "Trace writer stopped: ${e.message}")
+        } finally {
+            while (true) append(queue.poll() ?: break)
+            writer?.close()
+            writer = null
+        }
+    }
+
+    private fun append(span: TraceSpan) {
+        val event = JSONObject().apply {
+            put("name", span.name)
+            put("cat", span.name.substringBefore('.'))
+            put("ph", if (span.durationUs > 0) "X" else "i")
+            put("ts", span.startUs)
+            if (span.durationUs > 0) put("dur", span.durationUs) else put("s", "t")
+            put("pid", android.os.Process.myPid())
+            put("tid", span.threadId)
+            if (span.attributes.isNotEmpty()) put("args", JSONObject(span.attributes))
+        }
+        val line = event.toString() + ",\n"
+
+        val out = writer ?: open()
+        out.write(line)
+        fileBytes += line.length
+        if (fileBytes >= maxFileBytes) rotate()
+    }
+
+    private fun open(): Writer {
+        directory.mkdirs()
+        val file = File(directory, "trace-0.json")
+        val fresh = !file.exists() || file.length() == 0L
+        val out = OutputStreamWriter(FileOutputStream(file, true), Charsets.UTF_8).buffered()
+        if (fresh) out.write("[\n")
+        fileBytes = file.length()
+        writer = out
+        return out
+    }
+
+    private fun rotate() {
+        writer?.close()
+        writer = null
+        File(directory, "trace-${maxFiles - 1}.json").delete()
+        for (i in maxFiles - 2 downTo 0) {
+            File(directory, "trace-$i.json").renameTo(File(directory, "trace-${i + 1}.json"))
+        }
+    }
+}
+
+
+
+
+// Strings.kt
+
+package com.example.mcpapp
+
+// Levenshtein distance with two rolling rows
+internal fun editDistance(a: String, b: String): Int {
+    var previous = IntArray(b.length + 1) { it }
+    var current = IntArray(b.length + 1)
+    for (i in 1..a.length) {
+        current[0] = i
+        for (j in 1..b.length) {
+            val substitution = previous[j - 1] + if (a[i - 1] == b[j - 1]) 0 else 1
+            current[j] = minOf(substitution, previous[j] + 1, current[j - 1] + 1)
+        }
+        val swap = previous
+        previous = current
+        current = swap
+    }
+    return previous[b.length]
+}
+
+
+
+
+// Hashing.kt
+
+package com.example.mcpapp
+
+import java.security.MessageDigest
+
+// Lowercase hex SHA-1, truncated to [length] characters
+internal fun sha1Hex(bytes: ByteArray, length: Int = 40): String {
+    val hash = MessageDigest.getInstance("SHA-1").digest(bytes)
+    val builder = StringBuilder(40)
+    for (b in hash) {
+        val value = b.toInt() and 0xff
+        builder.append(HEX_DIGITS[value ushr 4]).append(HEX_DIGITS[value and 0x0f])
+        if (builder.length >= length) break
+    }
+    return builder.substring(0, minOf(length, builder.length))
+}
+
+private const val HEX_DIGITS = "0123456789abcdef"
+
+
+
+
+// JobCheckpoints.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.File
+import java.io.FileOutputStream
+import java.io.RandomAccessFile
+import java.util.concurrent.LinkedBlockingQueue
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+
+// Append-only log of every running job, one file per job and one JSON line per completed step,
+// so a job whose process was killed resumes after its last step that reached the disk. The agent
+// loop only queues lines; a daemon thread appends them and syncs each touched file once per
+// batch, so steps of parallel jobs that end together share a sync.
+class JobCheckpoints(
+    private val directory: File,
+    // How long the writer lets a batch fill up before syncing it
+    private val batchWindowMs: Long = 20L,
+    // A job started longer ago than this is not acted out on the device any more
+    private val maxAgeMs: Long = 30 * 60_000L,
+    // A job that keeps taking the process down is given up after this many resumes
+    private val maxResumes: Int = 2
+) {
+
+    // line == null: the job ended and its log goes away
+    private class Entry(val id: String, val line: String?)
+
+    private val queue = LinkedBlockingQueue<Entry>()
+    private val nextId = AtomicInteger()
+    @Volatile
+    private var running = true
+    private val files = HashMap<String, FileOutputStream>()
+
+    private val thread = Thread(::drain, "checkpoint-writer").apply {
+        isDaemon = true
+        start()
+    }
+
+    // A resumed job keeps appending to the log it was restored from
+    fun begin(state: QueryJobState) {
+        if (state.checkpointId != null) return
+        val id = "job-${System.currentTimeMillis()}-${nextId.incrementAndGet()}"
+        state.checkpointId = id
+        val start = JSONObject().apply {
+            put("type", "start")
+            put("query", state.query)
+            put("createdAt", System.currentTimeMillis())
+        }
+        queue.offer(Entry(id, start.toString()))
+    }
+
+    // Logs the records of the step the job just finished
+    fun stepCompleted(state: QueryJobState) {
+        val id = state.checkpointId ?: return
+        val records = JSONArray()
+        state.stepHistory.steps.filter { it.step == state.iteration }.forEach { records.put(state.stepHistory.toJson(it)) }
+        val step = JSONObject().apply {
+            put("type", "step")
+            put("step", state.iteration)
+            put("records", records)
+        }
+        queue.offer(Entry(id, step.toString()))
+    }
+
+    // The job ended on its own (completed, failed or timed out); it is not resumed
+    fun finish(state: QueryJobState) {
+        val id = state.checkpointId ?: return
+        state.checkpointId = null
+        queue.offer(Entry(id, null))
+    }
+
+    // Jobs a previous process left unfinished, oldest first, with their step history rebuilt.
+    // Logs past maxAgeMs or maxResumes are deleted instead; each log returned has the resume
+    // counted on disk before the job runs again. Reads files, so call off the main thread, and
+    // before any job begins.
+    fun recover(newState: (String) -> QueryJobState): List<QueryJobState> {
+        val logs = directory.listFiles { file -> file.name.endsWith(".jsonl") } ?: return emptyList()
+        return logs.sortedBy { it.lastModified() }.mapNotNull { file ->
+            try {
+                restore(file, newState)
+            } catch (e: Exception) {
+                Log.w("JobCheckpoints", "Dropping unreadable checkpoint ${file.name}: ${e.message}")
+                file.delete()
+                null
+            }
+        }
+    }
+
+    fun close() {
+        // No interrupt: it would close a file channel in the middle of force()
+        running = false
+    }
+
+    private fun restore(file: File, newState: (String) -> QueryJobState): QueryJobState? {
+        var state: QueryJobState? = null
+        var createdAt = file.lastModified()
+        var resumes = 0
+        val bytes = file.readBytes()
+        for (line in String(bytes, Charsets.UTF_8).lineSequence()) {
+            // Only the last line can be cut short by the kill; that step is simply run again
+            val json = try {
+                JSONObject(line)
+            } catch (e: Exception) {
+                break
+            }
+            when (json.optString("type")) {
+                "start" -> {
+                    state = newState(json.getString("query"))
+                    createdAt = json.optLong("createdAt", createdAt)
+                }
+                "resume" -> resumes++
+                "step" -> state?.let { restored ->
+                    val records = json.getJSONArray("records")
+                    for (i in 0 until records.length()) restored.stepHistory.restore(records.getJSONObject(i))
+                    restored.iteration = json.getInt("step")
+                }
+            }
+        }
+
+        val restored = state
+        if (restored == null) {
+            file.delete()
+            return null
+        }
+        val ageMs = System.currentTimeMillis() - createdAt
+        if (ageMs > maxAgeMs || resumes >= maxResumes) {
+            Log.w("JobCheckpoints", "Dropping checkpoint ${file.name}: started ${ageMs / 60_000} min ago, resumed $resumes times")
+            file.delete()
+            return null
+        }
+
+        // Synced before the job runs, so a resume that crashes the process still counts. A torn
+        // last line is cut off first, or the marker would be glued to it.
+        val intact = bytes.lastIndexOf('\n'.code.toByte()) + 1
+        val resume = JSONObject().apply {
+            put("type", "resume")
+            put("at", System.currentTimeMillis())
+        }
+        RandomAccessFile(file, "rw").use { raf ->
+            raf.setLength(intact.toLong())
+            raf.seek(raf.length())
+            raf.write((resume.toString() + "\n").toByteArray(Charsets.UTF_8))
+            raf.channel.force(false)
+        }
+        restored.checkpointId = file.nameWithoutExtension
+        return restored
+    }
+
+    private fun drain() {
+        try {
+            while (running) {
+                val first = queue.poll(1, TimeUnit.SECONDS) ?: continue
+                Thread.sleep(batchWindowMs)
+                val batch = arrayListOf(first)
+                queue.drainTo(batch)
+                write(batch)
+            }
+        } catch (e: InterruptedException) {
+            // Process is going away
+        } catch (e: Exception) {
+            Log.e("JobCheckpoints", "Checkpoint writer stopped: ${e.message}")
+        } finally {
+            val rest = ArrayList<Entry>()
+            queue.drainTo(rest)
+            write(rest)
+            files.values.forEach { it.close() }
+            files.clear()
+        }
+    }
+
+    private fun write(batch: List<Entry>) {
+        val touched = LinkedHashSet<String>()
+        for (entry in batch) {
+            try {
+                if (entry.line == null) {
+                    files.remove(entry.id)?.close()
+                    touched.remove(entry.id)
+                    File(directory, "${entry.id}.jsonl").delete()
+                    continue
+                }
+                val out = files.getOrPut(entry.id) {
+                    directory.mkdirs()
+                    FileOutputStream(File(directory, "${entry.id}.jsonl"), true)
+                }
+                out.write((entry.line + "\n").toByteArray(Charsets.UTF_8))
+                touched.add(entry.id)
+            } catch (e: Exception) {
+                Log.e("JobCheckpoints", "Could not write checkpoint ${entry.id}: ${e.message}")
+            }
+        }
+        // fdatasync; the file length is all the metadata an append needs
+        for (id in touched) {
+            try {
+                files[id]?.channel?.force(false)
+            } catch (e: Exception) {
+                Log.e("JobCheckpoints", "Could not sync checkpoint $id: ${e.message}")
+            }
+        }
+    }
+}
+
+
+
+
+// ResultStore.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import java.io.File
+import java.io.RandomAccessFile
+import java.nio.ByteBuffer
+import java.nio.channels.FileChannel
+import java.nio.file.StandardOpenOption
+
+// A tool result that is either held inline or spilled to a BlobStore. Spilled results are read
+// back on demand, and usually only their head, so the full text never has to sit on the heap.
+class ResultHandle internal constructor(
+    val bytes: Int,
+    private val inline: String?,
+    val blobId: String?,
+    private val store: BlobStore?
+) {
+    val isSpilled: Boolean
+        get() = inline == null
+
+    // Null once the blob has been evicted
+    fun load(): String? = inline ?: store?.read(blobId!!)
+
+    // At most [maxChars] characters from the start of the result
+    fun head(maxChars: Int): String? {
+        inline?.let { return if (it.length <= maxChars) it else it.substring(0, maxChars) }
+        // UTF-8 needs at most 4 bytes per char, so this prefix always covers maxChars
+        val text = store?.read(blobId!!, maxBytes = maxChars.toLong() * 4) ?: return null
+        return if (text.length <= maxChars) text else text.substring(0, maxChars)
+    }
+}
+
+// Keeps results up to [inlineLimitBytes] in memory and writes larger ones to [blobStore]
+class ResultStore(
+    private val blobStore: BlobStore?,
+    private val inlineLimitBytes: Int = 8 * 1024
+) {
+    // [bytes] is the UTF-8 encoding of [result], which callers have usually computed already
+    fun put(result: String, bytes: ByteArray = result.toByteArray(Charsets.UTF_8)): ResultHandle {
+        if (blobStore == null || bytes.size <= inlineLimitBytes) {
+            return ResultHandle(bytes.size, result, null, null)
+        }
+        val id = blobStore.write(bytes) ?: return ResultHandle(bytes.size, result, null, null)
+        return ResultHandle(bytes.size, null, id, blobStore)
+    }
+
+    companion object {
+        // Everything inline; for callers without a place on disk
+        val IN_MEMORY = ResultStore(null)
+    }
+}
+
+// Content-addressed files in [directory], capped by total size and age. The oldest blobs are
+// evicted first; identical results share one file. Large blobs are read through a memory map.
+class BlobStore(
+    private val directory: File,
+    private val maxTotalBytes: Long = 64L * 1024 * 1024,
+    private val maxAgeMs: Long = 24 * 60 * 60_000L,
+    private val mmapThresholdBytes: Long = 256L * 1024
+) {
+
+    private class Entry(val file: File, val bytes: Long, var touchedAt: Long)
+
+    // Insertion order is age order; a rewrite of an existing blob moves it to the back
+    private val entries = LinkedHashMap<String, Entry>()
+    private var totalBytes = 0L
+    private var scanned = false
+
+    val sizeBytes: Long
+        get() = synchronized(entries) { totalBytes }
+
+    // Returns the blob id, or null if the result could not be written
+    fun write(bytes: ByteArray): String? {
+        val id = sha1Hex(bytes, 24)
+        synchronized(entries) {
+            scan()
+            val now = System.currentTimeMillis()
+            entries.remove(id)?.let { existing ->
+                existing.touchedAt = now
+                existing.file.setLastModified(now)
+                entries[id] = existing
+                return id
+            }
+
+            val file = File(directory, "$id.blob")
+            try {
+                val tmp = File(directory, "$id.tmp")
+                tmp.writeBytes(bytes)
+                if (!tmp.renameTo(file)) return null
+            } catch (e: Exception) {
+                Log.e("BlobStore", "Failed to write blob: ${e.message}")
+                return null
+            }
+            entries[id] = Entry(file, bytes.size.toLong(), now)
+            totalBytes += bytes.size
+            evict(now)
+            return id
+        }
+    }
+
+    // Decodes up to [maxBytes] from the start of the blob; null if it is gone
+    fun read(id: String, maxBytes: Long = Long.MAX_VALUE): String? {
+        val file = synchronized(entries) { entries[id]?.file } ?: return null
+        return try {
+            val length = minOf(file.length(), maxBytes)
+            val buffer = if (length >= mmapThresholdBytes) {
+                FileChannel.open(file.toPath(), StandardOpenOption.READ).use { channel ->
+                    channel.map(FileChannel.MapMode.READ_ONLY, 0, length)
+                }
+            } else {
+                val array = ByteArray(length.toInt())
+                RandomAccessFile(file, "r").use { it.readFully(array) }
+                ByteBuffer.wrap(array)
+            }
+            Charsets.UTF_8.decode(buffer).toString()
+        } catch (e: Exception) {
+            Log.e("BlobStore", "Failed to read blob $id: ${e.message}")
+            null
+        }
+    }
+
+    fun clear() = synchronized(entries) {
+        entries.values.forEach { it.file.delete() }
+        entries.clear()
+        totalBytes = 0
+    }
+
+    // Oldest first until both limits hold again
+    private fun evict(now: Long) {
+        val iterator = entries.values.iterator()
+        while (iterator.hasNext()) {
+            val entry = iterator.next()
+            if (totalBytes <= maxTotalBytes && now - entry.touchedAt <= maxAgeMs) break
+            entry.file.delete()
+            totalBytes -= entry.bytes
+            iterator.remove()
+        }
+    }
+
+    // Picks up blobs written by an earlier process, oldest first
+    private fun scan() {
+        if (scanned) return
+        scanned = true
+        directory.mkdirs()
+        val files = directory.listFiles() ?: return
+        files.filter { it.name.endsWith(".tmp") }.forEach { it.delete() }
+        files.filter { it.name.endsWith(".blob") }
+            .sortedBy { it.lastModified() }
+            .forEach { file ->
+                entries[file.name.removeSuffix(".blob")] = Entry(file, file.length(), file.lastModified())
+                totalBytes += file.length()
+            }
+        evict(System.currentTimeMillis())
+    }
+}
+
+
+
+
+// StepHistory.kt
+
+package com.example.mcpapp
+
+import org.json.JSONObject
+
+data class StepHistoryPolicy(
+    val keepRawResults: Int = 3,          // newest steps whose full result stays in the prompt
+    val maxRawResultChars: Int = 4_000,   // a single raw result is cut beyond this
+    val maxRenderedChars: Int = 12_000,   // budget for the whole rendered history
+    val previewChars: Int = 80            // length of the preview in a collapsed step
+)
+
+// One record per executed step. Older records keep only their one-line summary, so memory and
+// prompt size stay flat no matter how many iterations a task runs. Results of the newest steps
+// go through [resultStore], which spills large ones to disk.
+class StepHistory(
+    private val policy: StepHistoryPolicy = StepHistoryPolicy(),
+    private val resultStore: ResultStore = ResultStore.IN_MEMORY
+) {
+
+    class StepRecord(
+        val step: Int,
+        val label: String,
+        val call: String,
+        val resultBytes: Int,
+        val digest: String,
+        val summary: String,
+        result: ResultHandle
+    ) {
+        var result: ResultHandle? = result
+            internal set
+    }
+
+    private val records = ArrayList<StepRecord>()
+
+    val size: Int
+        get() = records.size
+
+    val steps: List<StepRecord>
+        get() = records
+
+    // [action] numbers the calls of a multi-action turn (step 4 -> 4.1, 4.2, ...)
+    fun record(step: Int, request: JSONObject, result: String, action: Int? = null): StepRecord {
+        val bytes = result.toByteArray(Charsets.UTF_8)
+        val digest = sha1Hex(bytes, 8)
+        val call = describeCall(request)
+        val label = if (action == null) "Step $step" else "Step $step.$action"
+        val summary = "$label: $call -> ${bytes.size} B, sha1 $digest: \"${preview(result)}\""
+
+        val record = StepRecord(step, label, call, bytes.size, digest, summary, resultStore.put(result, bytes))
+        records.add(record)
+        collapseOldResults()
+        return record
+    }
+
+    // A record as a checkpoint keeps it: the result only as far as render() would show it
+    fun toJson(record: StepRecord): JSONObject {
+        return JSONObject().apply {
+            put("step", record.step)
+            put("label", record.label)
+            put("call", record.call)
+            put("resultBytes", record.resultBytes)
+            put("digest", record.digest)
+            put("summary", record.summary)
+            val handle = record.result
+            val head = handle?.head(policy.maxRawResultChars + 1)
+            if (handle != null && head != null) {
+                if (head.length <= policy.maxRawResultChars && !handle.isSpilled) {
+                    put("result", head)
+                } else {
+                    val marker = "…[+${maxOf(0, handle.bytes - policy.maxRawResultChars)} bytes]"
+                    put("result", head.take(policy.maxRawResultChars - marker.length) + marker)
+                }
+            }
+        }
+    }
+
+    // Inverse of toJson(), for a job resumed from its checkpoint
+    fun restore(json: JSONObject): StepRecord {
+        val result = if (json.has("result")) json.getString("result") else null
+        val record = StepRecord(
+            json.getInt("step"),
+            json.getString("label"),
+            json.getString("call"),
+            json.getInt("resultBytes"),
+            json.getString("digest"),
+            json.getString("summary"),
+            resultStore.put(result ?: "")
+        )
+        if (result == null) record.result = null
+        records.add(record)
+        collapseOldResults()
+        return record
+    }
+
+    // Only the newest results are kept verbatim; everything older collapses to its summary
+    private fun collapseOldResults() {
+        val firstRaw = records.size - policy.keepRawResults
+        for (i in 0 until firstRaw) {
+            records[i].result = null
+        }
+    }
+
+    fun clear() {
+        records.clear()
+    }
+
+    // Whether render() shows the record's whole result: false once it has collapsed to its
+    // one-line summary, and while its result is cut at maxRawResultChars
+    fun isRenderedInFull(record: StepRecord): Boolean {
+        val handle = record.result ?: return false
+        if (handle.isSpilled) return false
+        val head = handle.head(policy.maxRawResultChars + 1) ?: return false
+        return head.length <= policy.maxRawResultChars
+    }
+
+    // Renders newest-first into the budget, then restores chronological order for the prompt
+    fun render(): String {
+        if (records.isEmpty()) return "(none yet)"
+
+        val blocks = ArrayList<String>()
+        var used = 0
+        var omitted = 0
+        for (i in records.indices.reversed()) {
+            val record = records[i]
+            val block = render(record)
+            if (used + block.length + 1 > policy.maxRenderedChars && blocks.isNotEmpty()) {
+                omitted = i + 1
+                break
+            }
+            blocks.add(block)
+            used += block.length + 1
+        }
+
+        val builder = StringBuilder(used + 64)
+        if (omitted > 0) {
+            builder.append("($omitted earlier steps omitted)\n")
+        }
+        for (i in blocks.indices.reversed()) {
+            builder.append(blocks[i])
+            if (i > 0) builder.append('\n')
+        }
+        return builder.toString()
+    }
+
+    // Full (truncated) result while it is still kept raw, otherwise the one-line summary. Only the
+    // head of a spilled result is read back; the rest is referenced by blob id.
+    fun render(record: StepRecord): String {
+        val handle = record.result ?: return record.summary
+        val head = handle.head(policy.maxRawResultChars + 1) ?: return record.summary
+        if (head.length <= policy.maxRawResultChars && !handle.isSpilled) {
+            return "${record.label}: ${record.call} ->\n$head"
+        }
+        val reference = handle.blobId?.let { ", blob $it" } ?: ""
+        val rest = maxOf(0, handle.bytes - policy.maxRawResultChars)
+        return "${record.label}: ${record.call} ->\n${head.take(policy.maxRawResultChars)}…[+$rest bytes$reference]"
+    }
+
+    private fun describeCall(request: JSONObject): String {
+        val params = request.optJSONObject("params")
+        return if (request.optString("method") == "tools/call" && params != null) {
+            "${params.optString("name")} ${params.optJSONObject("arguments") ?: "{}"}"
+        } else {
+            request.optString("method", "unknown")
+        }
+    }
+
+    // Prefer the text content of an MCP tool result over the JSON-RPC envelope
+    private fun preview(result: String): String {
+        val text = try {
+            val content = JSONObject(result).optJSONObject("result")?.optJSONArray("content")
+            if (content != null && content.length() > 0) {
+                content.optJSONObject(0)?.optString("text") ?: result
+            } else {
+                result
+            }
+        } catch (e: Exception) {
+            result
+        }
+        val collapsed = text.replace(WHITESPACE, " ").trim()
+        return truncate(collapsed, policy.previewChars).replace("\"", "'")
+    }
+
+    private fun truncate(text: String, max: Int): String {
+        return if (text.length <= max) text else text.substring(0, max) + "…[+${text.length - max} chars]"
+    }
+
+    private companion object {
+        val WHITESPACE = Regex("\\s+")
+    }
+}
+
+
+
+
+// DevicePool.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.CoroutineScope
+import kotlinx.coroutines.Job
+import kotlinx.coroutines.async
+import kotlinx.coroutines.awaitAll
+import kotlinx.coroutines.channels.Channel
+import kotlinx.coroutines.coroutineScope
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.isActive
+import kotlinx.coroutines.launch
+import kotlinx.coroutines.sync.Mutex
+import kotlinx.coroutines.sync.withLock
+import kotlinx.coroutines.withTimeoutOrNull
+import org.json.JSONObject
+import java.io.IOException
+import java.util.concurrent.ConcurrentHashMap
+
+class DeviceInfo(
+    val id: String,
+    val type: String // "android", "ios" or "simulator", as mobile_use_device expects
+)
+
+// One MCP session per discovered device. Queries lease a free device, so with N devices up to
+// N agent loops run at once; devices that fail a health check are dropped and rediscovered
+// once the pool runs empty.
+class DevicePool(
+    private val scope: CoroutineScope,
+    private val sessionFactory: (DeviceInfo) -> McpSession,
+    private val discoverDevices: suspend () -> List<DeviceInfo>,
+    private val healthCheckIntervalMs: Long = 30_000L
+) {
+
+    private val sessions = ConcurrentHashMap<String, McpSession>()
+    private val idle = Channel<McpSession>(Channel.UNLIMITED)
+    private val discoveryMutex = Mutex()
+    private var healthJob: Job? = null
+
+    val size: Int
+        get() = sessions.size
+
+    val deviceIds: List<String>
+        get() = sessions.keys.toList()
+
+    // Suspends until a healthy device is free
+    suspend fun lease(): McpSession {
+        while (true) {
+            if (sessions.isEmpty()) {
+                discover()
+                if (sessions.isEmpty()) throw IOException("No devices available")
+            }
+            // Wake up now and then so a pool that emptied while we waited gets rediscovered
+            val session = withTimeoutOrNull(5_000L) { idle.receive() } ?: continue
+            if (sessions[session.deviceId] === session) return session
+        }
+    }
+
+    // A suspect session (its job failed on the transport) is pinged before it is lent out again
+    fun release(session: McpSession, suspect: Boolean = false) {
+        if (sessions[session.deviceId] !== session) {
+            session.close()
+            return
+        }
+        if (!suspect) {
+            idle.trySend(session)
+            return
+        }
+        scope.launch {
+            if (session.ping()) idle.trySend(session) else remove(session, "failed ping after error")
+        }
+    }
+
+    // Discovers and connects devices ahead of the first lease; returns the pool size
+    suspend fun warmUp(): Int {
+        discover()
+        return sessions.size
+    }
+
+    // After a network change every stream may be dead: ping all sessions at once, drop the
+    // ones that do not answer and rediscover if none are left
+    suspend fun revalidate() {
+        coroutineScope {
+            sessions.values.map { session ->
+                async { if (!session.ping()) remove(session, "failed ping after network change") }
+            }.awaitAll()
+        }
+        if (sessions.isEmpty()) discover()
+    }
+
+    fun shutdown() {
+        healthJob?.cancel()
+        idle.close()
+        sessions.values.forEach { it.close() }
+        sessions.clear()
+    }
+
+    private suspend fun discover() {
+        discoveryMutex.withLock {
+            if (sessions.isNotEmpty()) return
+
+            val devices = try {
+                discoverDevices()
+            } catch (e: CancellationException) {
+                throw e
+            } catch (e: Exception) {
+                Log.e("DevicePool", "Device discovery failed: ${e.message}")
+                emptyList()
+            }
+            Log.d("DevicePool", "Discovered ${devices.size} devices: ${devices.joinToString { it.id }}")
+
+            // Bring every device up in parallel; a device that cannot connect is left out
+            coroutineScope {
+                devices.map { device ->
+                    async {
+                        val session = sessionFactory(device)
+                        try {
+                            session.connect()
+                            session.selectDevice()
+                            sessions[device.id] = session
+                            idle.trySend(session)
+                        } catch (e: CancellationException) {
+                            session.close()
+                            throw e
+                        } catch (e: Exception) {
+                            Log.e("DevicePool", "Could not bring up ${device.id}: ${e.message}")
+                            session.close()
+                        }
+                    }
+                }.awaitAll()
+            }
+
+            if (healthJob == null && sessions.isNotEmpty()) {
+                healthJob = scope.launch { healthCheckLoop() }
+            }
+        }
+    }
+
+    private suspend fun healthCheckLoop() {
+        while (scope.isActive) {
+            delay(healthCheckIntervalMs)
+            for (session in sessions.values) {
+                if (!session.ping()) remove(session, "failed health check")
+            }
+        }
+    }
+
+    private fun remove(session: McpSession, reason: String) {
+        if (sessions.remove(session.deviceId, session)) {
+            Log.w("DevicePool", "Removing ${session.deviceId}: $reason")
+            session.close()
+        }
+    }
+
+    companion object {
+        private val EMULATOR_SERIAL = Regex("emulator-\\d+")
+
+        // mobile_list_available_devices answers with lines such as "Android devices: [emulator-5554, ...]"
+        fun parseDeviceList(response: String): List<DeviceInfo> {
+            val text = try {
+                JSONObject(response).optJSONObject("result")?.optJSONArray("content")
+                    ?.optJSONObject(0)?.optString("text") ?: response
+            } catch (e: Exception) {
+                response
+            }
+
+            val devices = LinkedHashMap<String, DeviceInfo>()
+            for (line in text.lines()) {
+                val type = when {
+                    line.contains("android", ignoreCase = true) -> "android"
+                    line.contains("simulator", ignoreCase = true) -> "simulator"
+                    line.contains("ios", ignoreCase = true) -> "ios"
+                    else -> continue
+                }
+                val open = line.indexOf('[')
+                val close = line.lastIndexOf(']')
+                if (open == -1 || close <= open) continue
+                line.substring(open + 1, close).split(',')
+                    .map { it.trim() }
+                    .filter { it.isNotEmpty() }
+                    .forEach { devices.getOrPut(it) { DeviceInfo(it, type) } }
+            }
+            if (devices.isEmpty()) {
+                EMULATOR_SERIAL.findAll(text).forEach { devices.getOrPut(it.value) { DeviceInfo(it.value, "android") } }
+            }
+            return devices.values.toList()
+        }
+    }
+}
+
+
+
+
+// McpRetry.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.suspendCancellableCoroutine
+import okhttp3.Call
+import okhttp3.Callback
+import okhttp3.Response
+import org.json.JSONObject
+import java.io.IOException
+import java.net.ConnectException
+import java.net.NoRouteToHostException
+import java.net.UnknownHostException
+import kotlin.coroutines.resume
+import kotlin.coroutines.resumeWithException
+import kotlin.random.Random
+
+class McpHttpException(val code: Int, message: String) : IOException(message)
+
+class CircuitOpenException(message: String) : IOException(message)
+
+// Suspends until OkHttp has the response status; cancelling the coroutine cancels the call
+suspend fun Call.await(): Response {
+    return suspendCancellableCoroutine { continuation ->
+        continuation.invokeOnCancellation { cancel() }
+        enqueue(object : Callback {
+            override fun onFailure(call: Call, e: IOException) {
+                continuation.resumeWithException(e)
+            }
+
+            override fun onResponse(call: Call, response: Response) {
+                // A response that arrives after cancellation would otherwise hold its connection
+                continuation.resume(response) { response.close() }
+            }
+        })
+    }
+}
+
+// Exponential backoff with full jitter: a random delay in [0, min(maxMs, baseMs * 2^(attempt - 1))]
+class Backoff(
+    private val baseMs: Long = 200L,
+    private val maxMs: Long = 5_000L,
+    private val random: Random = Random.Default
+) {
+    fun delayFor(attempt: Int): Long {
+        val ceiling = (baseMs shl (attempt - 1).coerceIn(0, 20)).coerceAtMost(maxMs)
+        return random.nextLong(ceiling + 1)
+    }
+}
+
+// Fails fast while the MCP server looks down: after failureThreshold consecutive failures the
+// circuit opens for openMs, then lets a single trial request through (half-open)
+class CircuitBreaker(
+    private val failureThreshold: Int = 5,
+    private val openMs: Long = 10_000L
+) {
+    enum class State { CLOSED, OPEN, HALF_OPEN }
+
+    private var state = State.CLOSED
+    private var consecutiveFailures = 0
+    private var openedAt = 0L
+
+    val currentState: State
+        @Synchronized get() = state
+
+    // Returns true when the caller got the half-open trial; it must then report back through
+    // onSuccess(), onFailure() or onCancelled()
+    @Synchronized
+    fun checkAllowed(): Boolean {
+        when (state) {
+            State.CLOSED -> return false
+            State.OPEN -> {
+                val remaining = openedAt + openMs - System.currentTimeMillis()
+                if (remaining > 0) {
+                    throw CircuitOpenException("MCP server unavailable, retrying in ${remaining}ms")
+                }
+                state = State.HALF_OPEN
+                return true
+            }
+            State.HALF_OPEN -> throw CircuitOpenException("MCP server unavailable, trial request in flight")
+        }
+    }
+
+    @Synchronized
+    fun onSuccess() {
+        state = State.CLOSED
+        consecutiveFailures = 0
+    }
+
+    @Synchronized
+    fun onFailure() {
+        consecutiveFailures++
+        if (state == State.HALF_OPEN || consecutiveFailures >= failureThreshold) {
+            state = State.OPEN
+            openedAt = System.currentTimeMillis()
+        }
+    }
+
+    // A cancelled trial proved nothing; reopen so the next trial is let through after openMs
+    // instead of the circuit staying half-open for good
+    @Synchronized
+    fun onCancelled(trial: Boolean) {
+        if (trial && state == State.HALF_OPEN) {
+            state = State.OPEN
+            openedAt = System.currentTimeMillis()
+        }
+    }
+}
+
+object RetryPolicy {
+
+    private val READ_ONLY_TOOLS = setOf(
+        "mobile_take_screenshot",
+        "mobile_list_available_devices"
+    )
+
+    // Everything but tools/call is safe to repeat, and so are tools that only read device state
+    fun isIdempotent(request: JSONObject): Boolean {
+        if (request.optString("method") != "tools/call") return true
+        val tool = request.optJSONObject("params")?.optString("name") ?: return false
+        return tool.startsWith("mobile_get_") || tool.startsWith("mobile_list_") || tool in READ_ONLY_TOOLS
+    }
+
+    // Whether the failure says something about server availability (feeds the circuit breaker)
+    fun isServerFailure(error: Throwable): Boolean {
+        return when (error) {
+            is McpHttpException -> error.code >= 500
+            is CircuitOpenException -> false
+            is IOException -> true
+            else -> false
+        }
+    }
+
+    // Non-idempotent calls are only repeated when the request provably never reached the tool
+    fun isRetryable(error: Throwable, idempotent: Boolean): Boolean {
+        return when (error) {
+            is CircuitOpenException -> false
+            is McpHttpException -> error.code == 429 || error.code == 503 || (idempotent && (error.code == 408 || error.code >= 500))
+            is ConnectException, is UnknownHostException, is NoRouteToHostException -> true
+            is IOException -> idempotent
+            else -> false
+        }
+    }
+}
+
+
+
+
+// McpTransport.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.delay
+import okhttp3.OkHttpClient
+import okhttp3.MediaType.Companion.toMediaTypeOrNull
+import okhttp3.Request
+import okhttp3.RequestBody.Companion.toRequestBody
+import okhttp3.Response
+import org.json.JSONObject
+import java.io.IOException
+
+enum class TransportKind {
+    STREAMABLE_HTTP, // response comes back in the POST body
+    SSE              // legacy: responses arrive on a long-lived GET stream
+}
+
+class UnsupportedTransportException(message: String) : IOException(message)
+
+// How requests reach an MCP server and how their responses come back
+interface McpTransport {
+    val kind: TransportKind
+
+    // Idempotent; cheap once connected
+    suspend fun connect()
+
+    // Assigns the request a fresh id, sends it and returns the matching response
+    suspend fun call(request: JSONObject, timeoutMs: Long): String
+
+    fun peekNextId(): Int
+
+    fun close()
+}
+
+// Tries Streamable HTTP first and falls back to the legacy SSE stream when the server does not
+// speak it. Once a kind is known to work, passing it as [preferred] skips the probe.
+suspend fun openMcpTransport(
+    client: OkHttpClient,
+    mcpUrl: String,
+    poster: JsonRpcPoster,
+    tracer: Tracer,
+    onNotification: (String) -> Unit,
+    preferred: TransportKind?
+): McpTransport {
+    if (preferred != TransportKind.SSE) {
+        val streamable = StreamableHttpMcpTransport(mcpUrl, poster, tracer, onNotification)
+        try {
+            streamable.connect()
+            return streamable
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: CircuitOpenException) {
+            throw e
+        } catch (e: Exception) {
+            streamable.close()
+            if (preferred == TransportKind.STREAMABLE_HTTP) throw e
+            Log.d("MCPService", "Streamable HTTP not available (${e.message}), falling back to SSE")
+        }
+    }
+
+    val sse = SseMcpTransport(client, mcpUrl, poster, tracer, onNotification)
+    sse.connect()
+    return sse
+}
+
+// POSTs JSON-RPC messages. Retries use jittered exponential backoff. A tools/call that may have
+// changed the device is only repeated when the server provably never ran it, and an open
+// circuit fails at once. Returns the successful response; the caller closes it.
+class JsonRpcPoster(
+    private val client: OkHttpClient,
+    private val circuitBreaker: CircuitBreaker,
+    private val tracer: Tracer,
+    private val maxRetries: Int = 3,
+    private val backoff: Backoff = Backoff()
+) {
+
+    suspend fun post(url: String, request: JSONObject, headers: Map<String, String> = emptyMap()): Response {
+        val body = request.toString()
+        return tracer.span("mcp.post") { span ->
+            span.set("method", request.optString("method")).set("requestBytes", body.length)
+            postWithRetries(url, body, RetryPolicy.isIdempotent(request), headers, span)
+        }
+    }
+
+    private suspend fun postWithRetries(
+        url: String,
+        body: String,
+        idempotent: Boolean,
+        headers: Map<String, String>,
+        span: Span
+    ): Response {
+        var attempts = 0
+        while (true) {
+            val trial = circuitBreaker.checkAllowed()
+            try {
+                val response = send(url, body, headers)
+                circuitBreaker.onSuccess()
+                span.set("attempts", attempts + 1).set("status", response.code)
+                return response
+            } catch (e: CancellationException) {
+                circuitBreaker.onCancelled(trial)
+                throw e
+            } catch (e: Exception) {
+                if (RetryPolicy.isServerFailure(e)) circuitBreaker.onFailure() else circuitBreaker.onSuccess()
+                attempts++
+                span.set("attempts", attempts)
+                Log.e("MCPService", "Send request failed, attempt $attempts: ${e.message}")
+                if (attempts >= maxRetries || !RetryPolicy.isRetryable(e, idempotent)) {
+                    if (e is McpHttpException) throw e
+                    throw IOException("Failed to send request after $attempts attempts: ${e.message}", e)
+                }
+                delay(backoff.delayFor(attempts))
+            }
+        }
+    }
+
+    // Suspends until the HTTP status is known, so failures reach the retry loop
+    private suspend fun send(url: String, body: String, headers: Map<String, String>): Response {
+        val requestBody = body.toRequestBody("application/json".toMediaTypeOrNull())
+
+        val postRequest = Request.Builder()
+            .url(url)
+            .post(requestBody)
+            .apply { headers.forEach { (name, value) -> header(name, value) } }
+            .build()
+
+        val response = client.newCall(postRequest).await()
+        if (!response.isSuccessful) {
+            response.close()
+            Log.e("MCPService", "❌ JSON-RPC error: ${response.code}")
+            throw McpHttpException(response.code, "JSON-RPC POST failed with HTTP ${response.code}")
+        }
+        Log.d("MCPService", "✅ Sent request successfully")
+        return response
+    }
+}
+
+
+
+
+// SseMcpTransport.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CompletableDeferred
+import kotlinx.coroutines.withTimeoutOrNull
+import okhttp3.*
+import okhttp3.HttpUrl.Companion.toHttpUrl
+import org.json.JSONObject
+import java.io.IOException
+import java.util.concurrent.Executors
+import java.util.concurrent.atomic.AtomicBoolean
+
+// The SSE stream a request was posted under went away; its response will not arrive on any other
+class SseStreamLostException(message: String) : IOException(message)
+
+// Legacy MCP transport: one long-lived GET stream carries every response, requests are POSTed
+// separately and matched back by id. Owns a listener thread and the in-flight request table.
+class SseMcpTransport(
+    private val client: OkHttpClient,
+    private val mcpUrl: String,
+    private val poster: JsonRpcPoster,
+    private val tracer: Tracer,
+    private val onNotification: (String) -> Unit
+) : McpTransport {
+
+    override val kind = TransportKind.SSE
+
+    private val executor = Executors.newSingleThreadExecutor()
+
+    private val requestRegistry = McpRequestRegistry()
+    private val orphanTimeoutMs = 5 * 60_000L
+    private val maxRetries = 3
+    private val isListening = AtomicBoolean(false)
+    private val shouldReconnect = AtomicBoolean(true)
+    @Volatile
+    private var activeSseCall: Call? = null
+    // Both may be updated by the server through the SSE `retry:` and `id:` fields
+    @Volatile
+    private var reconnectDelayMs = 5000L
+    @Volatile
+    private var lastSseEventId: String? = null
+    // Set from the `endpoint` event, which ties our POSTs to this stream
+    @Volatile
+    private var postUrl = mcpUrl
+
+    // Completed with the session endpoint once the SSE stream is open; replaced on every disconnect
+    private val readyLock = Any()
+    @Volatile
+    private var connectionReady = CompletableDeferred<String>()
+    private val connectionReadyTimeoutMs = 10_000L
+
+    // Cheap when already connected: the listener is running and the readiness signal is complete
+    override suspend fun connect() {
+        shouldReconnect.set(true)
+        startSSEListener()
+        awaitConnectionReady()
+    }
+
+    // Registers a fresh id for the request, sends it and suspends until the matching response
+    // arrives. A response only ever comes on the stream its request was posted under, so when
+    // that stream is lost an idempotent request is posted again on the next one and anything
+    // else fails.
+    override suspend fun call(request: JSONObject, timeoutMs: Long): String {
+        val swept = requestRegistry.sweepOrphans(orphanTimeoutMs)
+        if (swept > 0) {
+            Log.w("MCPService", "Dropped $swept orphaned requests")
+        }
+
+        val idempotent = RetryPolicy.isIdempotent(request)
+        var attempts = 0
+        while (true) {
+            attempts++
+            // Registered before the endpoint is read, so losing that stream fails this id
+            val id = requestRegistry.register()
+            request.put("id", id)
+            try {
+                awaitConnectionReady()
+                poster.post(postUrl, request).close()
+                return waitForResponse(id, timeoutMs)
+            } catch (e: SseStreamLostException) {
+                if (attempts >= maxRetries || !RetryPolicy.isRetryable(e, idempotent)) throw e
+                Log.w("MCPService", "SSE stream lost before the response to request $id, posting it again")
+            } finally {
+                requestRegistry.release(id)
+            }
+        }
+    }
+
+    override fun peekNextId(): Int = requestRegistry.peekNextId()
+
+    override fun close() {
+        shouldReconnect.set(false)
+        isListening.set(false)
+        activeSseCall?.cancel()
+        requestRegistry.failAll(IllegalStateException("SSE transport closed"))
+        executor.shutdown()
+    }
+
+    // Waits once: after a reconnect the response could only come on the old stream, so waiting
+    // again would just run out the timeout a second time. A silent stream is replaced for the
+    // requests that follow.
+    private suspend fun waitForResponse(id: Int, timeoutMs: Long): String {
+        return tracer.span("mcp.await_response") { span ->
+            span.set("id", id)
+            val response = requestRegistry.await(id, timeoutMs)
+            if (response != null) {
+                span.set("responseBytes", response.length)
+                return@span response
+            }
+            span.set("timedOut", true)
+            Log.e("GeminiMcpService", "No response for request $id within ${timeoutMs}ms")
+            try {
+                restartSSEListener()
+            } catch (e: IOException) {
+                Log.e("MCPService", "Reconnect failed: ${e.message}")
+            }
+            throw IOException("No response for request $id within ${timeoutMs}ms")
+        }
+    }
+
+    private fun startSSEListener() {
+        if (isListening.get()) return
+
+        isListening.set(true)
+
+        executor.execute {
+            while (shouldReconnect.get() && !executor.isShutdown) {
+                markConnectionPending()
+                val connectStart = tracer.now()
+                try {
+                    val getRequest = Request.Builder()
+                        .url(mcpUrl)
+                        .get()
+                        .header("Cache-Control", "no-cache")
+                        .header("Accept", "text/event-stream")
+                        .header("Connection", "keep-alive")
+                        .apply { lastSseEventId?.let { header("Last-Event-ID", it) } }
+                        .build()
+
+                    val call = client.newCall(getRequest)
+                    activeSseCall = call
+                    call.execute().use { response ->
+                        if (!response.isSuccessful) {
+                            Log.e("MCPService", "❌ Failed SSE connection: ${response.code}")
+                            Thread.sleep(reconnectDelayMs)
+                            return@use
+                        }
+
+                        Log.d("MCPService", "✅ SSE connection established")
+
+                        val body = response.body ?: throw IOException("SSE response has no body")
+                        val decoder = SseDecoder(body.byteStream())
+
+                        while (shouldReconnect.get()) {
+                            val sse = decoder.next() ?: break
+                            sse.retryMs?.let { reconnectDelayMs = it }
+                            lastSseEventId = sse.id
+
+                            val fullData = sse.data
+                            if (fullData.isEmpty()) continue
+                            Log.d("SSE_RAW", "event=${sse.type}, ${fullData.length} chars: ${fullData.take(200)}")
+
+                            // Handle different event types properly
+                            when (sse.type) {
+                                "endpoint" -> {
+                                    // Session metadata: the stream is open and requests go to this endpoint
+                                    Log.d("MCPService", "Session endpoint: $fullData")
+                                    postUrl = mcpUrl.toHttpUrl().resolve(fullData)?.toString() ?: mcpUrl
+                                    connectionReady.complete(fullData)
+                                    tracer.record("sse.connect", connectStart)
+                                }
+
+                                "message" -> {
+                                    // Route by id without parsing; the awaiting caller does the only full parse
+                                    val responseId = JsonRpcPeek.id(fullData)
+                                    when {
+                                        responseId != null -> {
+                                            if (requestRegistry.complete(responseId, fullData)) {
+                                                Log.d("MCPService", "✅ Received response for request $responseId")
+                                            } else {
+                                                Log.d("MCPService", "Response ID $responseId has no in-flight request (${requestRegistry.inFlight} pending)")
+                                            }
+                                        }
+
+                                        JsonRpcPeek.hasMember(fullData, "method") -> {
+                                            try {
+                                                onNotification(JSONObject(fullData).getString("method"))
+                                            } catch (e: Exception) {
+                                                Log.e("MCPService", "Error parsing notification: ${e.message}")
+                                            }
+                                        }
+
+                                        else -> {
+                                            Log.e("MCPService", "Message without a usable id: ${fullData.take(200)}")
+                                            // Still deliver it if the owner is unambiguous
+                                            requestRegistry.completeIfSingle(fullData)
+                                        }
+                                    }
+                                }
+
+                                "error" -> {
+                                    // Handle error events
+                                    Log.e("MCPService", "Server error: $fullData")
+                                    requestRegistry.completeAll(fullData)
+                                }
+
+                                else -> {
+                                    // Unknown event type, log but don't process
+                                    Log.d("MCPService", "Unknown event type '${sse.type}': $fullData")
+                                }
+                            }
+                        }
+                        onStreamLost()
+                    }
+                } catch (e: Exception) {
+                    onStreamLost()
+                    // A deliberate cancel from restartSSEListener() reconnects right away
+                    if (activeSseCall?.isCanceled() == true) {
+                        Log.d("MCPService", "SSE connection cancelled for restart")
+                    } else {
+                        Log.e("MCPService", "❌ SSE error: ${e.message}")
+                        tracer.instant("sse.reconnect") { mapOf("reason" to (e.message ?: e.javaClass.simpleName)) }
+                        if (shouldReconnect.get()) {
+                            Thread.sleep(reconnectDelayMs)
+                        }
+                    }
+                }
+            }
+            activeSseCall = null
+            isListening.set(false)
+        }
+    }
+
+    // Pending first, so a request registered from here on posts to the next endpoint; responses
+    // to the ones posted under this stream will not arrive
+    private fun onStreamLost() {
+        markConnectionPending()
+        requestRegistry.failAll(SseStreamLostException("SSE stream closed before the response arrived"))
+    }
+
+    private fun markConnectionPending() {
+        synchronized(readyLock) {
+            if (connectionReady.isCompleted) {
+                connectionReady = CompletableDeferred()
+            }
+        }
+    }
+
+    private suspend fun awaitConnectionReady(timeoutMs: Long = connectionReadyTimeoutMs): String {
+        return withTimeoutOrNull(timeoutMs) { connectionReady.await() }
+            ?: throw IOException("SSE connection not ready after ${timeoutMs}ms")
+    }
+
+    private suspend fun restartSSEListener() {
+        tracer.span("sse.restart") {
+            Log.d("MCPService", "Restarting SSE listener...")
+            markConnectionPending()
+            activeSseCall?.cancel()
+            startSSEListener() // no-op while the existing loop is alive; it reconnects by itself
+            awaitConnectionReady()
+        }
+    }
+}
+
+
+
+
+// StreamableHttpMcpTransport.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.runInterruptible
+import kotlinx.coroutines.sync.Mutex
+import kotlinx.coroutines.sync.withLock
+import kotlinx.coroutines.withTimeoutOrNull
+import okhttp3.Response
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.IOException
+import java.util.concurrent.atomic.AtomicInteger
+
+// Streamable-HTTP MCP transport: every request is a POST whose response carries the answer,
+// either as a JSON body or as a short SSE stream that ends with it. The server-assigned
+// Mcp-Session-Id header ties the POSTs together; no listener thread is needed.
+class StreamableHttpMcpTransport(
+    private val mcpUrl: String,
+    private val poster: JsonRpcPoster,
+    private val tracer: Tracer,
+    private val onNotification: (String) -> Unit
+) : McpTransport {
+
+    companion object {
+        private const val PROTOCOL_VERSION = "2025-03-26"
+        private const val INITIALIZE_TIMEOUT_MS = 10_000L
+    }
+
+    override val kind = TransportKind.STREAMABLE_HTTP
+
+    private val nextId = AtomicInteger(1)
+    private val initMutex = Mutex()
+    @Volatile
+    private var initialized = false
+    @Volatile
+    private var sessionId: String? = null
+
+    override suspend fun connect() {
+        if (initialized) return
+        initMutex.withLock {
+            if (initialized) return
+            initialize()
+            initialized = true
+        }
+    }
+
+    override suspend fun call(request: JSONObject, timeoutMs: Long): String {
+        connect()
+        return try {
+            exchange(request, timeoutMs)
+        } catch (e: McpHttpException) {
+            // 404 on a known session means the server forgot it; the request was never run,
+            // so handshake again and send it once more
+            if (e.code != 404 || sessionId == null) throw e
+            Log.d("MCPService", "MCP session $sessionId expired, re-initializing")
+            initialized = false
+            connect()
+            exchange(request, timeoutMs)
+        }
+    }
+
+    override fun peekNextId(): Int = nextId.get()
+
+    override fun close() {
+        initialized = false
+        sessionId = null
+    }
+
+    private suspend fun initialize() {
+        sessionId = null
+        val request = JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("method", "initialize")
+            put("params", JSONObject().apply {
+                put("protocolVersion", PROTOCOL_VERSION)
+                put("capabilities", JSONObject())
+                put("clientInfo", JSONObject().apply {
+                    put("name", "mcpapp")
+                    put("version", "1.0")
+                })
+            })
+        }
+        val response = exchange(request, INITIALIZE_TIMEOUT_MS)
+        if (JSONObject(response).has("error")) {
+            throw UnsupportedTransportException("initialize rejected: ${response.take(200)}")
+        }
+
+        val notification = JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("method", "notifications/initialized")
+        }
+        poster.post(mcpUrl, notification, headers()).close()
+        Log.d("MCPService", "✅ Streamable HTTP session ${sessionId ?: "(stateless)"} initialized")
+    }
+
+    private suspend fun exchange(request: JSONObject, timeoutMs: Long): String {
+        val id = nextId.getAndIncrement()
+        request.put("id", id)
+        return tracer.span("mcp.exchange") { span ->
+            span.set("id", id).set("method", request.optString("method"))
+            val text = withTimeoutOrNull(timeoutMs) {
+                val response = poster.post(mcpUrl, request, headers())
+                response.header("Mcp-Session-Id")?.let { sessionId = it }
+                runInterruptible(Dispatchers.IO) {
+                    response.use { readResponse(it, id) }
+                }
+            } ?: throw IOException("No response for request $id within ${timeoutMs}ms")
+            span.set("responseBytes", text.length)
+            text
+        }
+    }
+
+    private fun headers(): Map<String, String> {
+        val headers = HashMap<String, String>(2)
+        headers["Accept"] = "application/json, text/event-stream"
+        sessionId?.let { headers["Mcp-Session-Id"] = it }
+        return headers
+    }
+
+    // The answer is either a JSON body or an SSE stream that may carry notifications first
+    private fun readResponse(response: Response, id: Int): String {
+        val body = response.body ?: throw UnsupportedTransportException("HTTP ${response.code} without a body")
+        val contentType = response.header("Content-Type").orEmpty()
+
+        if (contentType.startsWith("text/event-stream")) {
+            val decoder = SseDecoder(body.byteStream())
+            while (true) {
+                val event = decoder.next() ?: break
+                if (event.type != "message" || event.data.isEmpty()) continue
+                val data = event.data
+                when {
+                    JsonRpcPeek.id(data) == id -> return data
+                    JsonRpcPeek.hasMember(data, "method") && JsonRpcPeek.id(data) == null -> {
+                        onNotification(JSONObject(data).getString("method"))
+                    }
+                }
+            }
+            throw IOException("Stream for request $id ended without a response")
+        }
+
+        if (contentType.startsWith("application/json")) {
+            val text = body.string()
+            if (text.trimStart().startsWith("[")) {
+                val array = JSONArray(text)
+                for (i in 0 until array.length()) {
+                    val message = array.optJSONObject(i) ?: continue
+                    if (message.optInt("id", -1) == id) return message.toString()
+                }
+                throw IOException("Batch response has no entry for request $id")
+            }
+            return text
+        }
+
+        // A legacy SSE endpoint accepts the POST (202) and answers on its GET stream instead
+        throw UnsupportedTransportException("HTTP ${response.code} with content type '$contentType'")
+    }
+}
+
+
+
+
+// McpSession.kt
+
+package com.example.mcpapp
+
+import android.util.Log
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.sync.Mutex
+import kotlinx.coroutines.sync.withLock
+import kotlinx.coroutines.withTimeoutOrNull
+import org.json.JSONObject
+
+// One MCP connection driving one device. The transport (Streamable HTTP or legacy SSE) is
+// negotiated on first connect; each session has its own, so sessions run independently.
+class McpSession(
+    private val openTransport: suspend (onNotification: (String) -> Unit) -> McpTransport,
+    val deviceId: String,
+    val deviceType: String,
+    private val onNotification: (McpSession, String) -> Unit
+) {
+
+    private val responseTimeoutMs = 30_000L
+    private val transportMutex = Mutex()
+    @Volatile
+    private var transport: McpTransport? = null
+
+    val settleDetector = UiSettleDetector(::screenFingerprint)
+
+    val transportKind: TransportKind?
+        get() = transport?.kind
+
+    // Cheap when already connected
+    suspend fun connect() {
+        val current = transport ?: transportMutex.withLock {
+            transport ?: openTransport { method -> onNotification(this, method) }.also { transport = it }
+        }
+        current.connect()
+    }
+
+    suspend fun selectDevice() {
+        callTool("mobile_use_device", JSONObject().apply {
+            put("device", deviceId)
+            put("deviceType", deviceType)
+        })
+    }
+
+    suspend fun ping(timeoutMs: Long = 5_000L): Boolean {
+        return try {
+            withTimeoutOrNull(timeoutMs) {
+                val request = JSONObject().apply {
+                    put("jsonrpc", "2.0")
+                    put("method", "ping")
+                }
+                !JSONObject(sendAndAwait(request, timeoutMs)).has("error")
+            } ?: false
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            Log.e("MCPService", "Ping to $deviceId failed: ${e.message}")
+            false
+        }
+    }
+
+    suspend fun callTool(name: String, arguments: JSONObject = JSONObject(), timeoutMs: Long = responseTimeoutMs): String {
+        val request = JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("method", "tools/call")
+            put("params", JSONObject().apply {
+                put("name", name)
+                put("arguments", arguments)
+            })
+        }
+        return sendAndAwait(request, timeoutMs)
+    }
+
+    // Gives the request a fresh id, sends it and suspends until the matching response arrives
+    suspend fun sendAndAwait(request: JSONObject, timeoutMs: Long = responseTimeoutMs): String {
+        val current = transport ?: run {
+            connect()
+            transport!!
+        }
+        return current.call(request, timeoutMs)
+    }
+
+    fun peekNextRequestId(): Int = transport?.peekNextId() ?: 1
+
+    fun close() {
+        transport?.close()
+    }
+
+    @Volatile
+    private var lastListing: String? = null
+
+    // The element listing the latest settle wait ended on; null if that wait sampled nothing
+    val lastSettledListing: String?
+        get() = if (settleDetector.lastFingerprint != null) lastListing else null
+
+    // Signature of the screen the latest settle wait ended on, for plan replay checks
+    val lastSettledSignature: String?
+        get() = lastSettledListing?.let { signatureOf(it) }
+
+    // Hash of the current element listing, bounds and values included so that the settle wait
+    // sees animations end; the JSON-RPC envelope is left out because its id changes
+    suspend fun screenFingerprint(): String {
+        val response = callTool("mobile_list_elements_on_screen", timeoutMs = 5_000L)
+        lastListing = response
+        val result = JSONObject(response).optJSONObject("result")?.toString() ?: response
+        return sha1Hex(result.toByteArray(Charsets.UTF_8), 16)
+    }
+
+    // What the current screen is, whatever its clock or element bounds; keys cached plans
+    suspend fun screenSignature(): String {
+        return signatureOf(callTool("mobile_list_elements_on_screen", timeoutMs = 5_000L))
+    }
+
+    // A result that is not an element listing is hashed whole, as the fingerprint does
+    private fun signatureOf(response: String): String {
+        return ScreenStateStore.signature(response) ?: run {
+            val result = JSONObject(response).optJSONObject("result")?.toString() ?: response
+            sha1Hex(result.toByteArray(Charsets.UTF_8), 16)
+        }
+    }
+}
+
+
+
+
+
+// McpRequestRegistry.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.CompletableDeferred
+import kotlinx.coroutines.withTimeoutOrNull
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.TimeoutException
+import java.util.concurrent.atomic.AtomicInteger
+
+// Tracks every in-flight JSON-RPC request by id so several calls can be outstanding at once.
+// Each request gets its own awaitable; responses for unknown or released ids are dropped.
+class McpRequestRegistry(firstId: Int = 1) {
+
+    private class PendingRequest(
+        val deferred: CompletableDeferred<String>,
+        val createdAt: Long
+    )
+
+    private val nextId = AtomicInteger(firstId)
+    private val pending = ConcurrentHashMap<Int, PendingRequest>()
+
+    val inFlight: Int
+        get() = pending.size
+
+    fun peekNextId(): Int = nextId.get()
+
+    fun register(): Int {
+        val id = nextId.getAndIncrement()
+        pending[id] = PendingRequest(CompletableDeferred(), System.currentTimeMillis())
+        return id
+    }
+
+    fun complete(id: Int, payload: String): Boolean {
+        return pending[id]?.deferred?.complete(payload) ?: false
+    }
+
+    // Used for payloads we cannot attribute to an id; only safe when exactly one request is waiting
+    fun completeIfSingle(payload: String): Boolean {
+        val only = pending.values.singleOrNull() ?: return false
+        return only.deferred.complete(payload)
+    }
+
+    fun completeAll(payload: String) {
+        pending.values.forEach { it.deferred.complete(payload) }
+    }
+
+    fun fail(id: Int, error: Throwable): Boolean {
+        return pending[id]?.deferred?.completeExceptionally(error) ?: false
+    }
+
+    // Entries stay registered until released, so a caller that has not started waiting yet
+    // still finds its failure
+    fun failAll(error: Throwable) {
+        pending.values.forEach { it.deferred.completeExceptionally(error) }
+    }
+
+    // Returns null on timeout; the entry stays registered so the caller can keep waiting after a reconnect
+    suspend fun await(id: Int, timeoutMs: Long): String? {
+        val request = pending[id] ?: throw IllegalStateException("Request $id is not registered")
+        return withTimeoutOrNull(timeoutMs) { request.deferred.await() }
+    }
+
+    fun release(id: Int) {
+        pending.remove(id)
+    }
+
+    // Drops entries nobody released (e.g. the awaiting coroutine died) so late responses cannot pile up
+    fun sweepOrphans(maxAgeMs: Long): Int {
+        val cutoff = System.currentTimeMillis() - maxAgeMs
+        var removed = 0
+        val iterator = pending.entries.iterator()
+        while (iterator.hasNext()) {
+            val entry = iterator.next()
+            if (entry.value.createdAt < cutoff) {
+                entry.value.deferred.completeExceptionally(
+                    TimeoutException("Request ${entry.key} orphaned after ${maxAgeMs}ms")
+                )
+                iterator.remove()
+                removed++
+            }
+        }
+        return removed
+    }
+}
+
+
+
+
+// MainActivity.kt
+
+package com.example.mcpapp
+
+import android.content.ComponentName
+import android.content.Context
+import android.content.Intent
+import android.content.ServiceConnection
+import android.os.Bundle
+import android.os.IBinder
+import android.widget.Button
+import android.widget.EditText
+import android.widget.TextView
+import androidx.appcompat.app.AppCompatActivity
+
+class MainActivity : AppCompatActivity() {
+
+    private lateinit var editTextPrompt: EditText
+    private lateinit var buttonSend: Button
+    private lateinit var textViewStatus: TextView
+    private lateinit var textViewResponse: TextView
+
+    private var geminiMcpService: GeminiMcpService? = null
+    private var bound = false
+
+    private val connection = object : ServiceConnection {
+        override fun onServiceConnected(className: ComponentName, service: IBinder) {
+            val binder = service as GeminiMcpService.GeminiMcpBinder
+            geminiMcpService = binder.getService()
+            bound = true
+
+            // Set callback for service responses
+            geminiMcpService?.setCallback(object : GeminiMcpService.GeminiMcpCallback {
+                override fun onStatusUpdate(status: String) {
+                    runOnUiThread {
+                        textViewStatus.text = status
+                    }
+                }
+
+                override fun onResponse(response: String) {
+                    runOnUiThread {
+                        textViewResponse.text = response
+                        buttonSend.isEnabled = true
+                    }
+                }
+
+                override fun onError(error: String) {
+                    runOnUiThread {
+                        textViewResponse.text = "Error: $error"
+                        textViewStatus.text = "Ready"
+                        buttonSend.isEnabled = true
                     }
                 }
 
@@ -627,6 +5397,16 @@ class MainActivity : AppCompatActivity() {
                         buttonSend.isEnabled = true
                     }
                 }
+
+                override fun onReadyStateChanged(state: GeminiMcpService.ReadyState) {
+                    runOnUiThread {
+                        textViewStatus.text = when (state) {
+                            GeminiMcpService.ReadyState.READY -> "Ready"
+                            GeminiMcpService.ReadyState.FAILED -> "Not connected, retrying in the background"
+                            else -> "Warming up..."
+                        }
+                    }
+                }
             })
         }
 
@@ -0,0 +1,1594 @@
+// CircuitBreakerTest.kt
+
+package com.example.mcpapp
+
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertFalse
+import org.junit.Assert.assertTrue
+import org.junit.Test
+
+class CircuitBreakerTest {
+
+    private fun openBreaker(openMs: Long = 0L): CircuitBreaker {
+        val breaker = CircuitBreaker(failureThreshold = 1, openMs = openMs)
+        breaker.onFailure()
+        assertEquals(CircuitBreaker.State.OPEN, breaker.currentState)
+        return breaker
+    }
+
+    @Test
+    fun cancelledTrialReopensTheCircuit() {
+        val breaker = openBreaker()
+        assertTrue(breaker.checkAllowed())
+        assertEquals(CircuitBreaker.State.HALF_OPEN, breaker.currentState)
+
+        breaker.onCancelled(trial = true)
+
+        assertEquals(CircuitBreaker.State.OPEN, breaker.currentState)
+        // openMs = 0: the next request is the new trial instead of "trial request in flight"
+        assertTrue(breaker.checkAllowed())
+    }
+
+    @Test
+    fun cancelledNonTrialLeavesTheTrialAlone() {
+        val breaker = openBreaker()
+        assertTrue(breaker.checkAllowed())
+
+        breaker.onCancelled(trial = false)
+
+        assertEquals(CircuitBreaker.State.HALF_OPEN, breaker.currentState)
+    }
+
+    @Test
+    fun closedCircuitHandsOutNoTrial() {
+        val breaker = CircuitBreaker()
+        assertFalse(breaker.checkAllowed())
+        breaker.onCancelled(trial = false)
+        assertEquals(CircuitBreaker.State.CLOSED, breaker.currentState)
+    }
+}
+
+
+
+
+// ScreenStateStoreTest.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertFalse
+import org.junit.Assert.assertNull
+import org.junit.Assert.assertTrue
+import org.junit.Test
+
+class ScreenStateStoreTest {
+
+    private fun listing(vararg elements: JSONObject): String {
+        val text = "Found these elements on screen: ${JSONArray(elements.toList())}"
+        return JSONObject().put("result", JSONObject().put(
+            "content", JSONArray().put(JSONObject().put("type", "text").put("text", text))
+        )).toString()
+    }
+
+    private fun button(text: String, y: Int = 0, value: String = "") = JSONObject().apply {
+        put("type", "android.widget.Button")
+        put("text", text)
+        put("value", value)
+        put("rect", JSONObject().put("x", 0).put("y", y).put("width", 100).put("height", 40))
+    }
+
+    @Test
+    fun firstListingIsRenderedInFull() {
+        val store = ScreenStateStore()
+
+        val rendered = store.ingest(listing(button("OK"), button("Cancel", y = 50)))!!
+
+        assertTrue(rendered.startsWith("Screen s1 (2 elements):"))
+        assertTrue(rendered.contains("Button \"Cancel\" @0,50 100x40"))
+        assertTrue(store.lastRenderedFull)
+    }
+
+    @Test
+    fun laterListingIsADiffAgainstTheBase() {
+        val store = ScreenStateStore()
+        store.ingest(listing(button("OK"), button("Wi-Fi", y = 50, value = "off")))
+
+        val rendered = store.ingest(listing(button("OK"), button("Wi-Fi", y = 50, value = "on"), button("Next", y = 100)))!!
+
+        assertTrue(rendered.startsWith("Screen s2 (3 elements; vs s1: +1 -0 ~1):"))
+        assertTrue(rendered.contains("+ Button \"Next\""))
+        assertTrue(rendered.contains("(was value=\"off\")"))
+        assertFalse(store.lastRenderedFull)
+    }
+
+    @Test
+    fun diffsStayAgainstTheLastFullListing() {
+        val store = ScreenStateStore()
+        store.ingest(listing(button("OK"), button("Cancel", y = 50)))
+        store.ingest(listing(button("OK"), button("Cancel", y = 60)))
+
+        val rendered = store.ingest(listing(button("OK"), button("Cancel", y = 50)))!!
+
+        assertEquals("Screen s3: unchanged since s1 (2 elements)", rendered)
+    }
+
+    @Test
+    fun invisibleBaseGivesAFullListing() {
+        val store = ScreenStateStore()
+        store.ingest(listing(button("OK"), button("Cancel", y = 50)))
+
+        val rendered = store.ingest(listing(button("OK"), button("Cancel", y = 60)), baseVisible = false)!!
+
+        assertTrue(rendered.startsWith("Screen s2 (2 elements):"))
+        assertTrue(store.lastRenderedFull)
+    }
+
+    @Test
+    fun mostlyNewScreenIsRenderedInFull() {
+        val store = ScreenStateStore()
+        store.ingest(listing(button("OK"), button("Cancel", y = 50)))
+
+        val rendered = store.ingest(listing(button("Back"), button("Search", y = 50)))!!
+
+        assertTrue(rendered.startsWith("Screen s2 (2 elements):"))
+    }
+
+    @Test
+    fun otherResultsAreNotListings() {
+        val store = ScreenStateStore()
+        val text = JSONObject().put("result", JSONObject().put(
+            "content", JSONArray().put(JSONObject().put("type", "text").put("text", "Done: mobile_press_button"))
+        )).toString()
+
+        assertNull(store.ingest(text))
+        assertNull(store.latest)
+    }
+}
+
+
+
+
+
+// JobCheckpointsTest.kt
+
+package com.example.mcpapp
+
+import org.json.JSONObject
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertFalse
+import org.junit.Assert.assertTrue
+import org.junit.Rule
+import org.junit.Test
+import org.junit.rules.TemporaryFolder
+import java.io.File
+
+// Recovery of leftover logs (android.util.Log must be stubbed, e.g. unitTests.returnDefaultValues)
+class JobCheckpointsTest {
+
+    @get:Rule
+    val folder = TemporaryFolder()
+
+    private fun writeLog(name: String, createdAt: Long, tail: String = ""): File {
+        val start = JSONObject().apply {
+            put("type", "start")
+            put("query", "open settings")
+            put("createdAt", createdAt)
+        }
+        return File(folder.root, "$name.jsonl").apply { writeText("$start\n$tail") }
+    }
+
+    private fun recover(maxAgeMs: Long = 30 * 60_000L, maxResumes: Int = 2): List<QueryJobState> {
+        val checkpoints = JobCheckpoints(folder.root, maxAgeMs = maxAgeMs, maxResumes = maxResumes)
+        try {
+            return checkpoints.recover { query -> QueryJobState(query) }
+        } finally {
+            checkpoints.close()
+        }
+    }
+
+    @Test
+    fun staleLogIsDropped() {
+        val log = writeLog("job-1", System.currentTimeMillis() - 2 * 60 * 60_000L)
+
+        assertTrue(recover(maxAgeMs = 60 * 60_000L).isEmpty())
+        assertFalse(log.exists())
+    }
+
+    @Test
+    fun jobIsGivenUpAfterMaxResumes() {
+        val log = writeLog("job-1", System.currentTimeMillis())
+
+        repeat(2) {
+            val resumed = recover(maxResumes = 2)
+            assertEquals(listOf("open settings"), resumed.map { it.query })
+            assertEquals("job-1", resumed[0].checkpointId)
+        }
+        assertTrue(recover(maxResumes = 2).isEmpty())
+        assertFalse(log.exists())
+    }
+
+    @Test
+    fun resumeMarkerReplacesATornLastLine() {
+        val log = writeLog("job-1", System.currentTimeMillis(), tail = "{\"type\": \"st")
+
+        assertEquals(1, recover().size)
+
+        val lines = log.readLines()
+        assertEquals(2, lines.size)
+        assertEquals("resume", JSONObject(lines[1]).getString("type"))
+    }
+}
+
+
+
+
+
+// PlanReplayTest.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.runBlocking
+import okhttp3.OkHttpClient
+import org.json.JSONArray
+import org.json.JSONObject
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertNotEquals
+import org.junit.Rule
+import org.junit.Test
+import org.junit.rules.TemporaryFolder
+import java.util.concurrent.TimeUnit
+
+// Plan lookup and replay against a FakeMcpServer (android.util.Log must be stubbed, e.g.
+// unitTests.returnDefaultValues)
+class PlanReplayTest {
+
+    @get:Rule
+    val folder = TemporaryFolder()
+
+    private val listener = object : AgentListener {
+        override fun onStep(step: Int, maxSteps: Int) {}
+        override fun onCompleted() {}
+        override fun onError(summary: String, message: String) {}
+    }
+
+    // Any turn asked of this model means the replay handed over
+    private val noModel = object : AgentModel {
+        override suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn {
+            throw AssertionError("Replay fell back to the model at step ${state.iteration}")
+        }
+
+        override fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String) {}
+    }
+
+    private fun click(x: Int, y: Int) = ScriptedAgentModel.call(
+        "mobile_click_on_screen_at_coordinates",
+        JSONObject().put("x", x).put("y", y)
+    )
+
+    private fun listing(vararg elements: JSONObject): String {
+        val text = "Found these elements on screen: ${JSONArray(elements.toList())}"
+        return JSONObject().put("result", JSONObject().put(
+            "content", JSONArray().put(JSONObject().put("type", "text").put("text", text))
+        )).toString()
+    }
+
+    private fun element(text: String, x: Int, value: String = "") = JSONObject().apply {
+        put("type", "android.widget.TextView")
+        put("text", text)
+        put("value", value)
+        put("rect", JSONObject().put("x", x).put("y", 0).put("width", 96).put("height", 48))
+    }
+
+    @Test
+    fun signatureIgnoresClockBoundsAndValues() {
+        val before = ScreenStateStore.signature(listing(element("9:41", 24), element("Wi-Fi", 0, "on")))
+        val after = ScreenStateStore.signature(listing(element("10:02", 24), element("Wi-Fi", 12, "off")))
+        val otherScreen = ScreenStateStore.signature(listing(element("10:02", 24), element("Bluetooth", 0)))
+
+        assertEquals(before, after)
+        assertNotEquals(before, otherScreen)
+    }
+
+    @Test
+    fun replaySurvivesAClockChange() {
+        val server = FakeMcpServer(FakeMcpServerConfig(responseLatencyMs = 5, elementsPerScreen = 20, clockTickEvery = 2))
+        server.start()
+        val client = OkHttpClient.Builder().readTimeout(30, TimeUnit.SECONDS).build()
+        val tracer = Tracer()
+        val poster = JsonRpcPoster(client, CircuitBreaker(), tracer, backoff = Backoff(baseMs = 20, maxMs = 200))
+        val session = McpSession(
+            { onNotification -> openMcpTransport(client, server.url, poster, tracer, onNotification, null) },
+            "fake-device",
+            "android"
+        ) { _, _ -> }
+        val cache = PlanCache(folder.root)
+        val script = listOf(click(540, 1200), click(300, 800))
+
+        try {
+            runBlocking {
+                session.connect()
+                val recorded = AgentRunner(ScriptedAgentModel(script, ModelTurnParser(tracer)), tracer, planCache = cache)
+                    .run(session, QueryJobState("open wifi settings"), listener)
+                assertEquals(JobOutcome.COMPLETED, recorded)
+                assertEquals(1, cache.size)
+
+                // Every listing since the recording showed a later time
+                val state = QueryJobState("open wifi settings")
+                val replayed = AgentRunner(noModel, tracer, planCache = cache).run(session, state, listener)
+                assertEquals(JobOutcome.COMPLETED, replayed)
+                assertEquals(script.size, state.iteration)
+                assertEquals(1, cache.size)
+            }
+        } finally {
+            session.close()
+            server.stop()
+            client.dispatcher.executorService.shutdown()
+        }
+    }
+}
+
+
+
+
+
+// ModelRouterTest.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.runBlocking
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertTrue
+import org.junit.Assert.fail
+import org.junit.Test
+import java.io.IOException
+import java.util.concurrent.atomic.AtomicInteger
+
+class ModelRouterTest {
+
+    private val session = McpSession({ throw UnsupportedOperationException() }, "test-device", "android") { _, _ -> }
+
+    // Each nextTurn() takes the next answer: its delay, then the turn or the exception
+    private class SequencedModel(private vararg val answers: Pair<Long, () -> ModelTurn>) : AgentModel {
+        private val calls = AtomicInteger()
+
+        override suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn {
+            val (delayMs, answer) = answers[calls.getAndIncrement()]
+            delay(delayMs)
+            return answer()
+        }
+
+        override fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String) {}
+    }
+
+    private val completed = { ModelTurn("done", null, true) }
+
+    // Hedges every generation after 100 ms, from the first one on
+    private fun router(model: AgentModel): ModelRouter {
+        return ModelRouter(listOf(ModelTier("only", model, timeoutMs = 5_000)), Tracer(), hedgeMinSamples = 0, hedgeMinDelayMs = 100)
+    }
+
+    @Test
+    fun hedgeCoversAFailingFirstRequest() {
+        val router = router(SequencedModel(0L to { throw IOException("first failed") }, 0L to completed))
+
+        val turn = runBlocking { router.nextTurn(session, QueryJobState("open settings")) }
+
+        assertTrue(turn.completed)
+        val stats = router.stats().single()
+        assertEquals(1L, stats.hedged)
+        assertEquals(1L, stats.hedgeWins)
+        assertEquals(0L, stats.errors)
+    }
+
+    @Test
+    fun failingBackupLeavesTheFirstRequestRunning() {
+        val router = router(SequencedModel(300L to completed, 0L to { throw IOException("backup failed") }))
+
+        val turn = runBlocking { router.nextTurn(session, QueryJobState("open settings")) }
+
+        assertTrue(turn.completed)
+        val stats = router.stats().single()
+        assertEquals(1L, stats.hedged)
+        assertEquals(0L, stats.hedgeWins)
+    }
+
+    @Test
+    fun hedgeFailsOnlyWhenBothRequestsFail() {
+        val router = router(SequencedModel(
+            0L to { throw IOException("first failed") },
+            0L to { throw IOException("backup failed") }
+        ))
+
+        try {
+            runBlocking { router.nextTurn(session, QueryJobState("open settings")) }
+            fail("Expected the hedge to fail")
+        } catch (e: IOException) {
+            assertEquals("first failed", e.message)
+        }
+        assertEquals(1L, router.stats().single().errors)
+    }
+}
+
+
+
+
+
+// IncrementalJsonDetectorTest.kt
+
+package com.example.mcpapp
+
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertNull
+import org.junit.Test
+
+class IncrementalJsonDetectorTest {
+
+    private val call = """{"jsonrpc":"2.0","method":"tools/call","params":{"name":"mobile_press_button","arguments":{"button":"HOME"}}}"""
+
+    @Test
+    fun objectCompletesOnItsClosingBrace() {
+        val detector = IncrementalJsonDetector()
+
+        assertNull(detector.feed("Pressing home: "))
+        assertNull(detector.feed(call.substring(0, 40)))
+        assertNull(detector.feed(call.substring(40, call.length - 1)))
+        assertEquals(call, detector.feed(call.substring(call.length - 1) + " and then done"))
+        assertEquals("Pressing home: $call and then done", detector.accumulated.toString())
+    }
+
+    @Test
+    fun anySplitGivesTheSameValue() {
+        val text = "Plan: [$call, {\"note\": \"a } in [text] with \\\" quotes {\"}] trailing"
+        val expected = text.substring(text.indexOf('['), text.lastIndexOf(']') + 1)
+
+        val detector = IncrementalJsonDetector()
+        val found = text.mapNotNull { detector.feed(it.toString()) }
+
+        assertEquals(listOf(expected), found)
+    }
+
+    @Test
+    fun nextSkipsPastACandidateTheCallerRejected() {
+        val detector = IncrementalJsonDetector()
+
+        assertEquals("{maybe}", detector.feed("I would {maybe} answer $call"))
+        assertEquals(call, detector.next())
+        assertNull(detector.next())
+    }
+}
+
+
+
+
+
+// StepHistoryTest.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertFalse
+import org.junit.Assert.assertNull
+import org.junit.Assert.assertTrue
+import org.junit.Rule
+import org.junit.Test
+import org.junit.rules.TemporaryFolder
+
+class StepHistoryTest {
+
+    @get:Rule
+    val folder = TemporaryFolder()
+
+    private fun press(button: String) = JSONObject().apply {
+        put("jsonrpc", "2.0")
+        put("id", 1)
+        put("method", "tools/call")
+        put("params", JSONObject().put("name", "mobile_press_button").put("arguments", JSONObject().put("button", button)))
+    }
+
+    private fun toolResult(text: String) = JSONObject()
+        .put("result", JSONObject().put("content", JSONArray().put(JSONObject().put("type", "text").put("text", text))))
+        .toString()
+
+    @Test
+    fun summaryNamesTheCallSizeDigestAndPreview() {
+        val history = StepHistory()
+        val result = toolResult("Pressed \"HOME\"\n  ok")
+        val bytes = result.toByteArray(Charsets.UTF_8)
+
+        val record = history.record(1, press("HOME"), result)
+        val action = history.record(4, press("BACK"), result, action = 2)
+
+        assertEquals("Step 1", record.label)
+        assertEquals(
+            "Step 1: mobile_press_button {\"button\":\"HOME\"} -> ${bytes.size} B, sha1 ${sha1Hex(bytes, 8)}: \"Pressed 'HOME' ok\"",
+            record.summary
+        )
+        assertEquals("Step 4.2", action.label)
+    }
+
+    @Test
+    fun onlyTheNewestResultsStayRaw() {
+        val history = StepHistory(StepHistoryPolicy(keepRawResults = 2))
+        val records = (1..4).map { history.record(it, press("HOME"), "result $it") }
+
+        assertNull(records[0].result)
+        assertNull(records[1].result)
+        assertEquals(records[0].summary, history.render(records[0]))
+        assertEquals("Step 4: mobile_press_button {\"button\":\"HOME\"} ->\nresult 4", history.render(records[3]))
+        assertFalse(history.isRenderedInFull(records[1]))
+        assertTrue(history.isRenderedInFull(records[2]))
+    }
+
+    @Test
+    fun longResultsAreCutWithAMarker() {
+        val history = StepHistory(StepHistoryPolicy(maxRawResultChars = 10))
+
+        val record = history.record(1, press("HOME"), "a".repeat(25))
+
+        assertTrue(history.render(record).endsWith("\n" + "a".repeat(10) + "…[+15 bytes]"))
+        assertFalse(history.isRenderedInFull(record))
+    }
+
+    @Test
+    fun spilledResultsReferenceTheirBlob() {
+        val store = ResultStore(BlobStore(folder.root), inlineLimitBytes = 16)
+        val history = StepHistory(resultStore = store)
+
+        val record = history.record(1, press("HOME"), "b".repeat(100))
+
+        val blobId = record.result!!.blobId!!
+        assertTrue(history.render(record).endsWith("…[+0 bytes, blob $blobId]"))
+        assertFalse(history.isRenderedInFull(record))
+    }
+
+    @Test
+    fun renderKeepsTheNewestStepsWithinTheBudget() {
+        assertEquals("(none yet)", StepHistory().render())
+
+        val summaryLength = StepHistory(StepHistoryPolicy(keepRawResults = 0)).record(1, press("HOME"), "done").summary.length
+        val history = StepHistory(StepHistoryPolicy(keepRawResults = 0, maxRenderedChars = 2 * (summaryLength + 1)))
+        val records = (1..5).map { history.record(it, press("HOME"), "done") }
+
+        assertEquals("(3 earlier steps omitted)\n${records[3].summary}\n${records[4].summary}", history.render())
+    }
+
+    @Test
+    fun checkpointRoundTripRendersTheSame() {
+        val policy = StepHistoryPolicy(keepRawResults = 2, maxRawResultChars = 40)
+        val history = StepHistory(policy)
+        history.record(1, press("HOME"), "first")
+        history.record(2, press("BACK"), "c".repeat(100))
+        history.record(3, press("HOME"), "third", action = 1)
+
+        val saved = history.steps.map { history.toJson(it) }
+        assertFalse(saved[0].has("result"))
+        assertEquals(40, saved[1].getString("result").length)
+        assertTrue(saved[1].getString("result").endsWith("…[+60 bytes]"))
+
+        val restored = StepHistory(policy)
+        saved.forEach { restored.restore(JSONObject(it.toString())) }
+
+        assertEquals(history.steps.map { it.summary }, restored.steps.map { it.summary })
+        assertEquals("Step 3.1", restored.steps[2].label)
+        assertEquals(history.render(history.steps[2]), restored.render(restored.steps[2]))
+        assertNull(restored.steps[0].result)
+    }
+}
+
+
+
+
+
+// ToolCallValidatorTest.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertNull
+import org.junit.Assert.assertTrue
+import org.junit.Test
+
+class ToolCallValidatorTest {
+
+    private fun tool(name: String, required: List<String>, vararg properties: Pair<String, JSONObject>) = JSONObject().apply {
+        put("name", name)
+        put("description", "Test tool")
+        put("inputSchema", JSONObject().apply {
+            put("type", "object")
+            put("properties", JSONObject().apply { for ((key, schema) in properties) put(key, schema) })
+            put("required", JSONArray(required))
+        })
+    }
+
+    private fun type(name: String) = JSONObject().put("type", name)
+
+    private val validator = ToolCatalog("test-server", "hash", JSONArray()
+        .put(tool("mobile_press_button", listOf("button"), "button" to type("string").put("enum", JSONArray(listOf("BACK", "HOME")))))
+        .put(tool("mobile_click_on_screen_at_coordinates", listOf("x", "y"), "x" to type("number"), "y" to type("number")))
+        .put(tool("mobile_type_keys", listOf("text", "submit"), "text" to type("string"), "submit" to type("boolean")))
+        .put(tool("mobile_launch_app", listOf("packageName"), "packageName" to type("string")))
+        .put(tool("mobile_wait", listOf("seconds"), "seconds" to type("integer")))
+    ).validator
+
+    private fun call(name: String, arguments: JSONObject) = JSONObject().apply {
+        put("jsonrpc", "2.0")
+        put("id", 7)
+        put("method", "tools/call")
+        put("params", JSONObject().put("name", name).put("arguments", arguments))
+    }
+
+    private fun argumentsOf(result: CallValidation): JSONObject = result.call!!.getJSONObject("params").getJSONObject("arguments")
+
+    @Test
+    fun validCallPassesWithoutFixes() {
+        val result = validator.validate(call("mobile_press_button", JSONObject().put("button", "HOME")))
+
+        assertNull(result.error)
+        assertTrue(result.fixes.isEmpty())
+        assertEquals(7, result.call!!.getInt("id"))
+        assertEquals("HOME", argumentsOf(result).getString("button"))
+    }
+
+    @Test
+    fun enumValueCaseIsFixed() {
+        val result = validator.validate(call("mobile_press_button", JSONObject().put("button", "back")))
+
+        assertEquals("BACK", argumentsOf(result).getString("button"))
+        assertEquals(listOf("button back -> BACK"), result.fixes)
+    }
+
+    @Test
+    fun valueOutsideTheEnumIsRejected() {
+        val result = validator.validate(call("mobile_press_button", JSONObject().put("button", "APP_SWITCH")))
+
+        assertNull(result.call)
+        assertEquals("mobile_press_button: \"button\" must be one of \"BACK\"|\"HOME\", got \"APP_SWITCH\"", result.error)
+    }
+
+    @Test
+    fun scalarStringsAreCoerced() {
+        val click = validator.validate(call("mobile_click_on_screen_at_coordinates", JSONObject().put("x", "540").put("y", " 1200.5 ")))
+        assertEquals(540L, argumentsOf(click).get("x"))
+        assertEquals(1200.5, argumentsOf(click).get("y"))
+
+        val typed = validator.validate(call("mobile_type_keys", JSONObject().put("text", 42).put("submit", "TRUE")))
+        assertEquals("42", argumentsOf(typed).get("text"))
+        assertEquals(true, argumentsOf(typed).get("submit"))
+
+        val wait = validator.validate(call("mobile_wait", JSONObject().put("seconds", 3.0)))
+        assertEquals(3L, argumentsOf(wait).get("seconds"))
+    }
+
+    @Test
+    fun valuesThatDoNotFitTheTypeAreRejected() {
+        val wait = validator.validate(call("mobile_wait", JSONObject().put("seconds", "2.5")))
+        assertNull(wait.call)
+        assertTrue(wait.error!!.startsWith("mobile_wait: \"seconds\" must be a integer"))
+
+        val typed = validator.validate(call("mobile_type_keys", JSONObject().put("text", "hi").put("submit", "yes")))
+        assertNull(typed.call)
+    }
+
+    @Test
+    fun toolAndArgumentNamesAreMatchedLoosely() {
+        val result = validator.validate(call("Launch_App", JSONObject().put("package_name", "com.android.settings").put("activity", "Main")))
+
+        assertEquals("mobile_launch_app", result.call!!.getJSONObject("params").getString("name"))
+        assertEquals("com.android.settings", argumentsOf(result).getString("packageName"))
+        assertEquals(
+            setOf("tool \"Launch_App\" -> \"mobile_launch_app\"", "argument \"package_name\" -> \"packageName\"", "dropped unknown argument \"activity\""),
+            result.fixes.toSet()
+        )
+    }
+
+    @Test
+    fun bareCallIsWrappedInAnEnvelope() {
+        val bare = JSONObject().put("name", "mobile_press_button").put("arguments", JSONObject().put("button", "HOME"))
+
+        val result = validator.validate(bare)
+
+        assertEquals("tools/call", result.call!!.getString("method"))
+        assertEquals("2.0", result.call!!.getString("jsonrpc"))
+        assertEquals(1, result.call!!.getInt("id"))
+        assertEquals(listOf("wrapped bare call in a tools/call envelope"), result.fixes)
+    }
+
+    @Test
+    fun missingMethodAndStringArgumentsAreFixed() {
+        val call = JSONObject().put("params", JSONObject()
+            .put("name", "mobile_press_button")
+            .put("arguments", "{\"button\": \"HOME\"}"))
+
+        val result = validator.validate(call)
+
+        assertEquals("HOME", argumentsOf(result).getString("button"))
+        assertEquals(listOf("added method tools/call", "parsed arguments given as a string"), result.fixes)
+    }
+
+    @Test
+    fun missingRequiredArgumentsAreNamed() {
+        val result = validator.validate(call("mobile_click_on_screen_at_coordinates", JSONObject().put("x", 10)))
+
+        assertNull(result.call)
+        assertEquals("mobile_click_on_screen_at_coordinates: missing required \"y\" (a number)", result.error)
+    }
+
+    @Test
+    fun unknownToolGetsASuggestion() {
+        val result = validator.validate(call("mobile_pres_buton", JSONObject()))
+
+        assertEquals("unknown tool \"mobile_pres_buton\", did you mean \"mobile_press_button\"?", result.error)
+    }
+
+    @Test
+    fun otherJsonIsNotACall() {
+        val result = validator.validate(JSONObject().put("status", "thinking"))
+
+        assertNull(result.call)
+        assertTrue(result.error!!.startsWith("expected {\"method\": \"tools/call\""))
+    }
+}
+
+
+
+
+
+// SseDecoderTest.kt
+
+package com.example.mcpapp
+
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertNull
+import org.junit.Test
+import java.io.InputStream
+
+class SseDecoderTest {
+
+    // Hands out one chunk per read(), the way bytes trickle in off a socket
+    private class ChunkedInputStream(private val chunks: List<ByteArray>) : InputStream() {
+        private var index = 0
+        private var offset = 0
+
+        override fun read(b: ByteArray, off: Int, len: Int): Int {
+            while (index < chunks.size && offset == chunks[index].size) {
+                index++
+                offset = 0
+            }
+            if (index >= chunks.size) return -1
+            val count = minOf(len, chunks[index].size - offset)
+            System.arraycopy(chunks[index], offset, b, off, count)
+            offset += count
+            return count
+        }
+
+        override fun read(): Int {
+            val one = ByteArray(1)
+            return if (read(one, 0, 1) < 0) -1 else one[0].toInt() and 0xFF
+        }
+    }
+
+    private fun decode(chunks: List<ByteArray>): List<SseEvent> {
+        val decoder = SseDecoder(ChunkedInputStream(chunks), bufferSize = 64)
+        return generateSequence { decoder.next() }.toList()
+    }
+
+    private fun decodeWhole(text: String) = decode(listOf(text.toByteArray(Charsets.UTF_8)))
+
+    // Every possible split point at once: one byte per read
+    private fun decodeBytewise(bytes: ByteArray) = decode(bytes.map { byteArrayOf(it) })
+
+    private fun decodeBytewise(text: String) = decodeBytewise(text.toByteArray(Charsets.UTF_8))
+
+    @Test
+    fun everyLineEndingEndsALine() {
+        val text = "data: a\r\n\r\ndata: b\r\rdata: c\n\n"
+
+        assertEquals(listOf("a", "b", "c"), decodeWhole(text).map { it.data })
+        assertEquals(listOf("a", "b", "c"), decodeBytewise(text).map { it.data })
+    }
+
+    @Test
+    fun crlfSplitAcrossReadsIsOneLineEnding() {
+        val chunks = listOf("data: a\r", "\n\r", "\ndata: b\r", "\n\r\n").map { it.toByteArray() }
+
+        assertEquals(listOf("a", "b"), decode(chunks).map { it.data })
+    }
+
+    @Test
+    fun dataLinesAreJoinedWithLineFeeds() {
+        val events = decodeBytewise("data: first\ndata:second\ndata:  indented\ndata\n\n")
+
+        assertEquals(listOf("first\nsecond\n indented\n"), events.map { it.data })
+    }
+
+    @Test
+    fun eventTypeResetsAndIdSticks() {
+        val events = decodeWhole("event: endpoint\nid: 7\ndata: /messages?session_id=1\n\ndata: {}\n\n")
+
+        assertEquals(listOf("endpoint", "message"), events.map { it.type })
+        assertEquals(listOf("7", "7"), events.map { it.id })
+    }
+
+    @Test
+    fun idWithNulIsIgnored() {
+        val events = decodeWhole("id: 1\ndata: a\n\nid: 2\u0000x\ndata: b\n\n")
+
+        assertEquals(listOf("1", "1"), events.map { it.id })
+    }
+
+    @Test
+    fun retryTakesOnlyDigits() {
+        val events = decodeWhole("retry: 2500\ndata: a\n\nretry: soon\ndata: b\n\nretry:\ndata: c\n\n")
+
+        assertEquals(listOf(2500L, 2500L, 2500L), events.map { it.retryMs })
+    }
+
+    @Test
+    fun byteOrderMarkIsSkippedEvenWhenSplit() {
+        val bytes = byteArrayOf(0xEF.toByte(), 0xBB.toByte(), 0xBF.toByte()) + "data: a\n\n".toByteArray()
+
+        assertEquals(listOf("a"), decode(listOf(bytes)).map { it.data })
+        assertEquals(listOf("a"), decodeBytewise(bytes).map { it.data })
+    }
+
+    @Test
+    fun commentsUnknownFieldsAndEmptyBlocksDispatchNothing() {
+        val events = decodeWhole(": keepalive\n\nfoo: bar\n\nevent: message\n\ndata: a\n\n")
+
+        assertEquals(listOf("a"), events.map { it.data })
+    }
+
+    @Test
+    fun multiByteCharactersSurviveAnySplit() {
+        val events = decodeBytewise("data: héllo ✓ 日本\n\n")
+
+        assertEquals(listOf("héllo ✓ 日本"), events.map { it.data })
+    }
+
+    @Test
+    fun linesLongerThanTheBufferAreKeptWhole() {
+        val payload = "x".repeat(1_000)
+
+        assertEquals(listOf(payload), decodeWhole("data: $payload\n\n").map { it.data })
+    }
+
+    @Test
+    fun trailingPartialEventIsDropped() {
+        val decoder = SseDecoder(ChunkedInputStream(listOf("data: a\n\ndata: b".toByteArray())))
+
+        assertEquals("a", decoder.next()?.data)
+        assertNull(decoder.next())
+    }
+}
+
+
+
+
+// JsonRpcPeekTest.kt
+
+package com.example.mcpapp
+
+import org.junit.Assert.assertEquals
+import org.junit.Assert.assertFalse
+import org.junit.Assert.assertNull
+import org.junit.Assert.assertTrue
+import org.junit.Test
+
+class JsonRpcPeekTest {
+
+    @Test
+    fun readsNumericAndNumericStringIds() {
+        assertEquals(42, JsonRpcPeek.id("""{"jsonrpc":"2.0","id":42,"result":{}}"""))
+        assertEquals(17, JsonRpcPeek.id("""{"id":"17"}"""))
+        assertEquals(-4, JsonRpcPeek.id("""{ "id" : -4 }"""))
+    }
+
+    @Test
+    fun onlyTheTopLevelIdCounts() {
+        assertEquals(3, JsonRpcPeek.id("""{"result":{"id":5,"items":[{"id":6}]},"id":3}"""))
+        assertNull(JsonRpcPeek.id("""{"result":{"id":5}}"""))
+    }
+
+    @Test
+    fun idInsideAStringIsNotAMember() {
+        assertNull(JsonRpcPeek.id("""{"method":"log","params":{"text":"\"id\": 9"}}"""))
+        assertEquals(2, JsonRpcPeek.id("""{"note":"a \"id\":1, \\","id":2}"""))
+    }
+
+    @Test
+    fun unusableIdsAreNull() {
+        assertNull(JsonRpcPeek.id("""{"id":null}"""))
+        assertNull(JsonRpcPeek.id("""{"id":"abc"}"""))
+        assertNull(JsonRpcPeek.id("""{"id":"12"""))
+        assertNull(JsonRpcPeek.id("""{"id":3000000000}"""))
+    }
+
+    @Test
+    fun hasMemberLooksAtKeysOnly() {
+        assertTrue(JsonRpcPeek.hasMember("""{"jsonrpc":"2.0","method":"notifications/tools/list_changed"}""", "method"))
+        assertFalse(JsonRpcPeek.hasMember("""{"jsonrpc":"2.0","method":"notifications/tools/list_changed"}""", "id"))
+        assertFalse(JsonRpcPeek.hasMember("""{"result":"method"}""", "method"))
+        assertFalse(JsonRpcPeek.hasMember("""{"result":{"method":"x"}}""", "method"))
+    }
+}
+
+
+
+
+
+// SseDecoderBenchmark.kt
+
+package com.example.mcpapp
+
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.BufferedReader
+import java.io.ByteArrayInputStream
+import java.io.InputStreamReader
+import java.lang.management.ManagementFactory
+
+// Plain-JVM microbenchmark (test source set, needs org.json on the classpath):
+// replays large mobile_list_elements_on_screen payloads through the old readLine() loop and
+// through SseDecoder + JsonRpcPeek, and reports throughput and bytes allocated per event.
+//   args: [elementsPerPayload=400] [events=200] [iterations=20]
+object SseDecoderBenchmark {
+
+    private const val WARMUP_ITERATIONS = 10
+
+    @JvmStatic
+    fun main(args: Array<String>) {
+        val elements = args.getOrNull(0)?.toInt() ?: 400
+        val events = args.getOrNull(1)?.toInt() ?: 200
+        val iterations = args.getOrNull(2)?.toInt() ?: 20
+
+        val stream = buildStream(elements, events)
+        println("Stream: $events events, ${stream.size / 1024} KiB, $elements elements per payload")
+
+        repeat(WARMUP_ITERATIONS) {
+            legacyLoop(stream)
+            decoderLoop(stream)
+        }
+
+        val legacy = measure("legacy readLine loop", stream.size, events, iterations) { legacyLoop(stream) }
+        val decoder = measure("SseDecoder + JsonRpcPeek", stream.size, events, iterations) { decoderLoop(stream) }
+        println(String.format("Speed-up: %.2fx, allocation ratio: %.2fx", legacy.first / decoder.first, legacy.second / decoder.second))
+    }
+
+    // Returns (nanoseconds per run, bytes allocated per run)
+    private fun measure(name: String, streamBytes: Int, events: Int, iterations: Int, run: () -> Long): Pair<Double, Double> {
+        val threads = ManagementFactory.getThreadMXBean() as com.sun.management.ThreadMXBean
+        val threadId = Thread.currentThread().id
+        var checksum = 0L
+
+        val allocatedBefore = threads.getThreadAllocatedBytes(threadId)
+        val start = System.nanoTime()
+        repeat(iterations) { checksum += run() }
+        val elapsed = (System.nanoTime() - start).toDouble() / iterations
+        val allocated = (threads.getThreadAllocatedBytes(threadId) - allocatedBefore).toDouble() / iterations
+
+        val mbPerSecond = streamBytes / (elapsed / 1e9) / (1024 * 1024)
+        println(String.format(
+            "%-26s %8.2f ms/run %9.1f MiB/s %10.0f B/event (checksum %d)",
+            name, elapsed / 1e6, mbPerSecond, allocated / events, checksum
+        ))
+        return elapsed to allocated
+    }
+
+    // Mirrors the listener loop GeminiMcpService used before SseDecoder, including the id parse
+    private fun legacyLoop(stream: ByteArray): Long {
+        val reader = BufferedReader(InputStreamReader(ByteArrayInputStream(stream)))
+        var event: String? = null
+        val dataBuilder = StringBuilder()
+        var line: String?
+        var checksum = 0L
+
+        while (reader.readLine().also { line = it } != null) {
+            line = line?.trim()
+            when {
+                line!!.startsWith("event:") -> event = line!!.removePrefix("event:").trim()
+                line!!.startsWith("data:") -> dataBuilder.append(line!!.removePrefix("data:").trim())
+                line!!.isEmpty() -> {
+                    val fullData = dataBuilder.toString()
+                    if (event == "message" && fullData.isNotEmpty()) {
+                        checksum += JSONObject(fullData).optInt("id", -1)
+                    }
+                    event = null
+                    dataBuilder.setLength(0)
+                }
+            }
+        }
+        return checksum
+    }
+
+    private fun decoderLoop(stream: ByteArray): Long {
+        val decoder = SseDecoder(ByteArrayInputStream(stream))
+        var checksum = 0L
+        while (true) {
+            val event = decoder.next() ?: break
+            if (event.type == "message") {
+                checksum += JsonRpcPeek.id(event.data) ?: -1
+            }
+        }
+        return checksum
+    }
+
+    private fun buildStream(elements: Int, events: Int): ByteArray {
+        val builder = StringBuilder()
+        builder.append("event: endpoint\ndata: /messages/?session_id=benchmark\n\n")
+        for (id in 1..events) {
+            builder.append(": keepalive\n")
+            builder.append("event: message\ndata: ").append(elementListResponse(id, elements)).append("\n\n")
+        }
+        return builder.toString().toByteArray(Charsets.UTF_8)
+    }
+
+    private fun elementListResponse(id: Int, elements: Int): String {
+        val list = JSONArray()
+        for (i in 0 until elements) {
+            list.put(JSONObject().apply {
+                put("type", if (i % 3 == 0) "android.widget.Button" else "android.widget.TextView")
+                put("text", "Item $i — ${"lorem ipsum ".repeat(i % 4)}".trim())
+                put("label", "item_$i")
+                put("rect", JSONObject().apply {
+                    put("x", (i * 37) % 1080)
+                    put("y", (i * 53) % 2340)
+                    put("width", 200 + i % 50)
+                    put("height", 48 + i % 20)
+                })
+            })
+        }
+        val text = "Found these elements on screen: $list"
+        return JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("id", id)
+            put("result", JSONObject().apply {
+                put("content", JSONArray().put(JSONObject().apply {
+                    put("type", "text")
+                    put("text", text)
+                }))
+                put("isError", false)
+            })
+        }.toString()
+    }
+}
+
+
+
+
+// FakeMcpServer.kt
+
+package com.example.mcpapp
+
+import com.sun.net.httpserver.HttpExchange
+import com.sun.net.httpserver.HttpServer
+import org.json.JSONArray
+import org.json.JSONObject
+import java.io.IOException
+import java.net.InetSocketAddress
+import java.util.concurrent.Executors
+import java.util.concurrent.LinkedBlockingDeque
+import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicInteger
+
+data class FakeMcpServerConfig(
+    val responseLatencyMs: Long = 20,
+    val elementsPerScreen: Int = 50,
+    // Answer in the POST body instead of on the SSE stream
+    val streamableHttp: Boolean = false,
+    // Close the SSE stream after this many messages; 0 keeps it open
+    val dropStreamEvery: Int = 0,
+    // Answer every n-th POST with 503; 0 never fails
+    val failPostEvery: Int = 0,
+    // Show a status-bar clock that moves on a minute every n-th listing; 0 shows none
+    val clockTickEvery: Int = 0
+)
+
+// Plain-JVM stand-in for the mobile MCP server (test source set). Speaks the legacy SSE + POST
+// protocol, or Streamable HTTP when configured, and answers every tool from generated data.
+// Built for a single client. As on a real legacy server, every stream is its own session: an SSE
+// response goes out only on the stream its request was posted under and is lost with it.
+class FakeMcpServer(private val config: FakeMcpServerConfig) {
+
+    private class Outgoing(val session: Int, val message: String)
+
+    private val server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0)
+    private val handlers = Executors.newCachedThreadPool()
+    private val responder = Executors.newSingleThreadScheduledExecutor()
+    private val outbox = LinkedBlockingDeque<Outgoing>()
+    private val posts = AtomicInteger()
+    private val streamGeneration = AtomicInteger()
+    // Bumped by every tool that changes the screen, so element listings differ between steps
+    private val screenVersion = AtomicInteger()
+    private val listings = AtomicInteger()
+    @Volatile
+    private var running = false
+
+    val url: String
+        get() = "http://127.0.0.1:${server.address.port}/mcp/"
+
+    val postCount: Int
+        get() = posts.get()
+
+    fun start() {
+        server.createContext("/mcp/", ::handle)
+        server.executor = handlers
+        running = true
+        server.start()
+    }
+
+    fun stop() {
+        running = false
+        server.stop(0)
+        handlers.shutdownNow()
+        responder.shutdownNow()
+    }
+
+    private fun handle(exchange: HttpExchange) {
+        try {
+            val isMessagesPath = exchange.requestURI.path.endsWith("/messages")
+            when {
+                exchange.requestMethod == "GET" && !config.streamableHttp -> stream(exchange)
+                exchange.requestMethod == "POST" && isMessagesPath && !config.streamableHttp -> postMessage(exchange)
+                exchange.requestMethod == "POST" && !isMessagesPath && config.streamableHttp -> postStreamable(exchange)
+                else -> respond(exchange, 405, null)
+            }
+        } catch (e: IOException) {
+            exchange.close()
+        }
+    }
+
+    private fun stream(exchange: HttpExchange) {
+        val generation = streamGeneration.incrementAndGet()
+        exchange.responseHeaders.add("Content-Type", "text/event-stream")
+        exchange.sendResponseHeaders(200, 0)
+        val out = exchange.responseBody
+        try {
+            out.write("retry: 100\nevent: endpoint\ndata: /mcp/messages?session_id=$generation\n\n".toByteArray())
+            out.flush()
+            var sent = 0
+            // An older stream stops taking messages as soon as the client has reconnected
+            while (running && generation == streamGeneration.get()) {
+                val outgoing = outbox.poll(5, TimeUnit.SECONDS)
+                if (outgoing == null) {
+                    out.write(": keepalive\n\n".toByteArray())
+                    out.flush()
+                    continue
+                }
+                // Left for the newer stream it belongs to; one for an older stream is dropped
+                if (outgoing.session > generation) {
+                    outbox.addFirst(outgoing)
+                    break
+                }
+                if (outgoing.session < generation) continue
+                out.write("event: message\ndata: ${outgoing.message}\n\n".toByteArray(Charsets.UTF_8))
+                out.flush()
+                sent++
+                if (config.dropStreamEvery > 0 && sent % config.dropStreamEvery == 0) break
+            }
+        } catch (e: InterruptedException) {
+            // stop()
+        } finally {
+            exchange.close()
+        }
+    }
+
+    private fun postMessage(exchange: HttpExchange) {
+        val session = exchange.requestURI.query?.substringAfter("session_id=", "")?.toIntOrNull()
+        val request = JSONObject(exchange.requestBody.readBytes().toString(Charsets.UTF_8))
+        if (session == null) {
+            respond(exchange, 400, null)
+            return
+        }
+        if (shouldFail()) {
+            respond(exchange, 503, null)
+            return
+        }
+        respond(exchange, 202, null)
+        val response = answer(request) ?: return
+        responder.schedule({ outbox.put(Outgoing(session, response)) }, config.responseLatencyMs, TimeUnit.MILLISECONDS)
+    }
+
+    private fun postStreamable(exchange: HttpExchange) {
+        val request = JSONObject(exchange.requestBody.readBytes().toString(Charsets.UTF_8))
+        if (shouldFail()) {
+            respond(exchange, 503, null)
+            return
+        }
+        exchange.responseHeaders.add("Mcp-Session-Id", "fake-session")
+        val response = answer(request)
+        if (response == null) {
+            respond(exchange, 202, null)
+            return
+        }
+        Thread.sleep(config.responseLatencyMs)
+        respond(exchange, 200, response)
+    }
+
+    private fun shouldFail(): Boolean {
+        val count = posts.incrementAndGet()
+        return config.failPostEvery > 0 && count % config.failPostEvery == 0
+    }
+
+    private fun respond(exchange: HttpExchange, code: Int, json: String?) {
+        if (json == null) {
+            exchange.sendResponseHeaders(code, -1)
+        } else {
+            val bytes = json.toByteArray(Charsets.UTF_8)
+            exchange.responseHeaders.add("Content-Type", "application/json")
+            exchange.sendResponseHeaders(code, bytes.size.toLong())
+            exchange.responseBody.write(bytes)
+        }
+        exchange.close()
+    }
+
+    // Null for notifications, which get no answer
+    private fun answer(request: JSONObject): String? {
+        if (!request.has("id")) return null
+        val result = when (request.optString("method")) {
+            "initialize" -> JSONObject().apply {
+                put("protocolVersion", "2025-03-26")
+                put("capabilities", JSONObject().put("tools", JSONObject()))
+                put("serverInfo", JSONObject().put("name", "fake-mcp").put("version", "1.0"))
+            }
+            "tools/list" -> JSONObject().put("tools", toolList())
+            "tools/call" -> callTool(request.optJSONObject("params") ?: JSONObject())
+            else -> JSONObject()
+        }
+        return JSONObject().apply {
+            put("jsonrpc", "2.0")
+            put("id", request.get("id"))
+            put("result", result)
+        }.toString()
+    }
+
+    private fun callTool(params: JSONObject): JSONObject {
+        val name = params.optString("name")
+        val text = when {
+            name == "mobile_list_elements_on_screen" -> "Found these elements on screen: ${elementList()}"
+            name.startsWith("mobile_list_") || name.startsWith("mobile_get_") -> "[]"
+            else -> {
+                screenVersion.incrementAndGet()
+                "Done: $name"
+            }
+        }
+        return JSONObject().apply {
+            put("content", JSONArray().put(JSONObject().put("type", "text").put("text", text)))
+            put("isError", false)
+        }
+    }
+
+    // Most elements are stable across screens; every tenth one reflects the current screen version
+    private fun elementList(): JSONArray {
+        val version = screenVersion.get()
+        val list = JSONArray()
+        if (config.clockTickEvery > 0) {
+            val minutes = 9 * 60 + listings.getAndIncrement() / config.clockTickEvery
+            list.put(JSONObject().apply {
+                put("type", "android.widget.TextView")
+                put("text", String.format("%d:%02d", minutes / 60 % 24, minutes % 60))
+                put("identifier", "com.android.systemui:id/clock")
+                put("rect", JSONObject().put("x", 24).put("y", 0).put("width", 96).put("height", 48))
+            })
+        }
+        for (i in 0 until config.elementsPerScreen) {
+            list.put(JSONObject().apply {
+                put("type", if (i % 3 == 0) "android.widget.Button" else "android.widget.TextView")
+                put("text", if (i % 10 == 0) "Item $i v$version" else "Item $i")
+                put("label", "item_$i")
+                put("rect", JSONObject().apply {
+                    put("x", (i * 37) % 1080)
+                    put("y", (i * 53) % 2340)
+                    put("width", 200 + i % 50)
+                    put("height", 48 + i % 20)
+                })
+            })
+        }
+        return list
+    }
+
+    private fun toolList(): JSONArray {
+        fun tool(name: String, description: String, vararg properties: Pair<String, String>) = JSONObject().apply {
+            put("name", name)
+            put("description", description)
+            put("inputSchema", JSONObject().apply {
+                put("type", "object")
+                put("properties", JSONObject().apply {
+                    for ((property, type) in properties) put(property, JSONObject().put("type", type))
+                })
+                put("required", JSONArray(properties.map { it.first }))
+            })
+        }
+        return JSONArray()
+            .put(tool("mobile_list_elements_on_screen", "List elements on screen"))
+            .put(tool("mobile_click_on_screen_at_coordinates", "Click on the screen", "x" to "number", "y" to "number"))
+            .put(tool("mobile_launch_app", "Launch an app", "packageName" to "string"))
+            .put(tool("mobile_type_keys", "Type text", "text" to "string", "submit" to "boolean"))
+            .put(tool("mobile_press_button", "Press a button", "button" to "string"))
+    }
+}
+
+
+
+
+// ScriptedAgentModel.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.delay
+import org.json.JSONObject
+import java.util.concurrent.atomic.AtomicInteger
+
+// AgentModel that replays a fixed list of answers (test source set). Each answer goes through the
+// same ModelTurnParser as real model output after [latencyMs] of simulated generation; the step
+// history is rendered every turn as a prompt build would. Past the end of the script it completes.
+// With [slowEvery] set, every slowEvery-th generation takes [slowLatencyMs] instead, a latency tail
+// for exercising ModelRouter's hedging.
+class ScriptedAgentModel(
+    private val script: List<String>,
+    private val parser: ModelTurnParser,
+    private val latencyMs: Long = 0,
+    private val slowEvery: Int = 0,
+    private val slowLatencyMs: Long = 0
+) : AgentModel {
+
+    private val generations = AtomicInteger()
+
+    companion object {
+        const val COMPLETED = "{\"status\": \"completed\", \"message\": \"Task completed successfully\"}"
+
+        fun call(tool: String, arguments: JSONObject = JSONObject()): String {
+            return JSONObject().apply {
+                put("jsonrpc", "2.0")
+                put("id", 1)
+                put("method", "tools/call")
+                put("params", JSONObject().apply {
+                    put("name", tool)
+                    put("arguments", arguments)
+                })
+            }.toString()
+        }
+    }
+
+    override suspend fun nextTurn(session: McpSession, state: QueryJobState): ModelTurn {
+        state.stepHistory.render()
+        val slow = slowEvery > 0 && generations.incrementAndGet() % slowEvery == 0
+        val generationMs = if (slow) slowLatencyMs else latencyMs
+        if (generationMs > 0) delay(generationMs)
+        return parser.fromText(script.getOrNull(state.iteration - 1) ?: COMPLETED)
+    }
+
+    override fun onToolResults(state: QueryJobState, turn: ModelTurn, toolResults: String) {
+        // A script does not look at results
+    }
+}
+
+
+
+
+// AgentBenchmark.kt
+
+package com.example.mcpapp
+
+import kotlinx.coroutines.runBlocking
+import okhttp3.OkHttpClient
+import org.json.JSONObject
+import java.lang.management.ManagementFactory
+import java.lang.management.MemoryType
+import java.util.concurrent.TimeUnit
+import kotlin.system.exitProcess
+
+// Plain-JVM end-to-end benchmark of the agent loop (test source set; android.util.Log must be
+// stubbed, e.g. unitTests.returnDefaultValues). Runs AgentRunner with a ScriptedAgentModel
+// against a FakeMcpServer. Per scenario it reports step latency, task time, bytes allocated on
+// the agent thread and peak heap. Exits with status 1 when a scenario breaks its thresholds.
+//   args: [tasksPerScenario=5] [thresholdScale=1.0] [scenario ...]
+object AgentBenchmark {
+
+    class Scenario(
+        val name: String,
+        val server: FakeMcpServerConfig,
+        val script: List<String>,
+        val modelLatencyMs: Long,
+        val maxP99StepMs: Double,
+        val maxTaskMs: Double,
+        val maxAllocatedPerStep: Long,
+        // Every slowModelEvery-th generation takes slowModelLatencyMs; the model then runs behind
+        // a single-tier ModelRouter that hedges
+        val slowModelEvery: Int = 0,
+        val slowModelLatencyMs: Long = 0
+    )
+
+    private class Result(
+        val steps: LatencySummary,
+        val taskP50Ms: Double,
+        val taskMaxMs: Double,
+        val allocatedPerStep: Long,
+        val peakHeapBytes: Long,
+        val failedTasks: Int
+    )
+
+    private val LISTENER = object : AgentListener {
+        override fun onStep(step: Int, maxSteps: Int) {}
+        override fun onCompleted() {}
+        override fun onError(summary: String, message: String) {}
+    }
+
+    private fun list() = ScriptedAgentModel.call("mobile_list_elements_on_screen")
+
+    private fun click(x: Int, y: Int) = ScriptedAgentModel.call(
+        "mobile_click_on_screen_at_coordinates",
+        JSONObject().put("x", x).put("y", y)
+    )
+
+    private fun launch() = ScriptedAgentModel.call(
+        "mobile_launch_app",
+        JSONObject().put("packageName", "com.android.settings")
+    )
+
+    // 14 actions plus the completion turn use the service's whole step budget
+    private fun longScript() = List(14) { if (it % 2 == 0) list() else click(100 + it, 200 + it) }
+
+    val SCENARIOS = listOf(
+        Scenario(
+            "short",
+            FakeMcpServerConfig(responseLatencyMs = 20, elementsPerScreen = 50),
+            listOf(launch(), list(), click(540, 1200)),
+            modelLatencyMs = 50,
+            maxP99StepMs = 1_500.0,
+            maxTaskMs = 4_000.0,
+            maxAllocatedPerStep = 8L * 1024 * 1024
+        ),
+        Scenario(
+            "short-streamable-http",
+            FakeMcpServerConfig(responseLatencyMs = 20, elementsPerScreen = 50, streamableHttp = true),
+            listOf(launch(), list(), click(540, 1200)),
+            modelLatencyMs = 50,
+            maxP99StepMs = 1_500.0,
+            maxTaskMs = 4_000.0,
+            maxAllocatedPerStep = 8L * 1024 * 1024
+        ),
+        Scenario(
+            "fifteen-steps",
+            FakeMcpServerConfig(responseLatencyMs = 20, elementsPerScreen = 200),
+            longScript(),
+            modelLatencyMs = 50,
+            maxP99StepMs = 1_200.0,
+            maxTaskMs = 12_000.0,
+            maxAllocatedPerStep = 16L * 1024 * 1024
+        ),
+        Scenario(
+            "huge-element-lists",
+            FakeMcpServerConfig(responseLatencyMs = 20, elementsPerScreen = 3_000),
+            listOf(list(), click(540, 1200), list(), click(300, 800), list()),
+            modelLatencyMs = 50,
+            maxP99StepMs = 2_500.0,
+            maxTaskMs = 8_000.0,
+            maxAllocatedPerStep = 96L * 1024 * 1024
+        ),
+        Scenario(
+            "flaky-connection",
+            FakeMcpServerConfig(responseLatencyMs = 40, elementsPerScreen = 200, dropStreamEvery = 4, failPostEvery = 5),
+            longScript().take(8),
+            modelLatencyMs = 50,
+            maxP99StepMs = 3_000.0,
+            maxTaskMs = 15_000.0,
+            maxAllocatedPerStep = 16L * 1024 * 1024
+        ),
+        Scenario(
+            "slow-model-tail",
+            FakeMcpServerConfig(responseLatencyMs = 20, elementsPerScreen = 200),
+            longScript(),
+            modelLatencyMs = 50,
+            maxP99StepMs = 1_500.0,
+            maxTaskMs = 12_000.0,
+            maxAllocatedPerStep = 16L * 1024 * 1024,
+            slowModelEvery = 6,
+            slowModelLatencyMs = 5_000
+        )
+    )
+
+    @JvmStatic
+    fun main(args: Array<String>) {
+        val tasks = maxOf(1, args.getOrNull(0)?.toInt() ?: 5)
+        val thresholdScale = args.getOrNull(1)?.toDouble() ?: 1.0
+        val selected = args.drop(2).toSet()
+
+        var regressions = 0
+        for (scenario in SCENARIOS) {
+            if (selected.isNotEmpty() && scenario.name !in selected) continue
+            val result = run(scenario, tasks)
+            println(String.format(
+                "%-22s step p50 %7.1f ms p99 %7.1f ms | task p50 %7.0f ms max %7.0f ms | %6d KiB/step | peak heap %4d MiB | %d failed",
+                scenario.name, result.steps.p50Ms, result.steps.p99Ms, result.taskP50Ms, result.taskMaxMs,
+                result.allocatedPerStep / 1024, result.peakHeapBytes / (1024 * 1024), result.failedTasks
+            ))
+
+            val violations = ArrayList<String>()
+            if (result.steps.p99Ms > scenario.maxP99StepMs * thresholdScale) violations.add("step p99")
+            if (result.taskMaxMs > scenario.maxTaskMs * thresholdScale) violations.add("task time")
+            if (result.allocatedPerStep > scenario.maxAllocatedPerStep * thresholdScale) violations.add("allocations")
+            if (result.failedTasks > 0) violations.add("failed tasks")
+            if (violations.isNotEmpty()) {
+                regressions++
+                println("  REGRESSION: ${violations.joinToString()}")
+            }
+        }
+        exitProcess(if (regressions > 0) 1 else 0)
+    }
+
+    private fun run(scenario: Scenario, tasks: Int): Result {
+        val server = FakeMcpServer(scenario.server)
+        server.start()
+        val client = OkHttpClient.Builder()
+            .readTimeout(30, TimeUnit.SECONDS)
+            .build()
+        val tracer = Tracer()
+        val poster = JsonRpcPoster(client, CircuitBreaker(), tracer, backoff = Backoff(baseMs = 20, maxMs = 200))
+        val session = McpSession(
+            { onNotification -> openMcpTransport(client, server.url, poster, tracer, onNotification, null) },
+            "fake-device",
+            "android"
+        ) { _, _ -> }
+        val scripted = ScriptedAgentModel(
+            scenario.script, ModelTurnParser(tracer), scenario.modelLatencyMs, scenario.slowModelEvery, scenario.slowModelLatencyMs
+        )
+        val model = if (scenario.slowModelEvery > 0) {
+            ModelRouter(listOf(ModelTier("scripted", scripted, timeoutMs = 30_000)), tracer, hedgeMinSamples = 5)
+        } else {
+            scripted
+        }
+        val runner = AgentRunner(model, tracer)
+
+        val threads = ManagementFactory.getThreadMXBean() as com.sun.management.ThreadMXBean
+        val heapPools = ManagementFactory.getMemoryPoolMXBeans().filter { it.type == MemoryType.HEAP }
+        val taskMs = ArrayList<Double>(tasks)
+        var failed = 0
+        var steps = 0
+        var allocated = 0L
+
+        try {
+            // runBlocking keeps the agent loop on this thread, so its allocations can be counted
+            runBlocking {
+                session.connect()
+                runner.run(session, QueryJobState("warm-up"), LISTENER)
+
+                tracer.enabled = true
+                System.gc()
+                heapPools.forEach { it.resetPeakUsage() }
+                val threadId = Thread.currentThread().id
+                val allocatedBefore = threads.getThreadAllocatedBytes(threadId)
+
+                repeat(tasks) {
+                    val state = QueryJobState("benchmark")
+                    val start = System.nanoTime()
+                    if (runner.run(session, state, LISTENER) != JobOutcome.COMPLETED) failed++
+                    taskMs.add((System.nanoTime() - start) / 1e6)
+                    steps += state.iteration
+                }
+                allocated = threads.getThreadAllocatedBytes(threadId) - allocatedBefore
+            }
+        } finally {
+            session.close()
+            server.stop()
+            client.dispatcher.executorService.shutdown()
+            client.connectionPool.evictAll()
+        }
+
+        taskMs.sort()
+        return Result(
+            steps = tracer.latencySummaries()["agent.step"] ?: LatencySummary(0, 0.0, 0.0, 0.0, 0.0),
+            taskP50Ms = taskMs[taskMs.size / 2],
+            taskMaxMs = taskMs.last(),
+            allocatedPerStep = allocated / maxOf(1, steps),
+            peakHeapBytes = heapPools.sumOf { it.peakUsage?.used ?: 0L },
+            failedTasks = failed
+        )
+    }
+}